@@ -0,0 +1,37 @@
+# コード名の正規化の速度: parse_chord_name (初回 / キャッシュ済み) と以前の normalize_chord_name を比べる
+#   python bench/bench_chord_parser.py [回数]   (既定: 200000)
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "tests"))
+import chordthinker as ct
+from test_chord_parser import all_spellings, baseline_normalize
+
+
+def timed(func, inputs):
+    start = time.perf_counter()
+    for text in inputs: func(text)
+    return (time.perf_counter() - start) / len(inputs) * 1e9
+
+
+def main(count):
+    rng = random.Random(0)
+    # AI の回答に出てくる程度の種類 (数百) の表記を繰り返し正規化する
+    vocabulary = [text for text, _ in rng.sample(list(all_spellings()), 400)] + ["C_Maj", "Am", "Bb_Maj7", "N.C."]
+    inputs = [rng.choice(vocabulary) for _ in range(count)]
+    old = timed(baseline_normalize, inputs)
+    ct.parse_chord_name.cache_clear()
+    cold = timed(ct.parse_chord_name.__wrapped__, inputs)
+    warm = timed(ct.parse_chord_name, inputs)
+    accepted_old = sum(baseline_normalize(t) is not None for t in vocabulary)
+    accepted_new = sum(ct.parse_chord_name(t) is not None for t in vocabulary)
+    print(f"{count} names from {len(vocabulary)} spellings")
+    print(f"  baseline normalize   {old:7.0f} ns/name | accepts {accepted_old}/{len(vocabulary)}")
+    print(f"  parse_chord_name     {cold:7.0f} ns/name (no cache) | {warm:5.0f} ns/name (cached) | accepts {accepted_new}/{len(vocabulary)}")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200000)
@@ -0,0 +1,37 @@
+# MIDI 書き出しの速度: render_midi_bytes と以前の mido 経由の書き出しを比べる
+#   python bench/bench_midi.py [コード数 ...]   (既定: 10000 100000)
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "tests"))
+import chordthinker as ct
+
+try: from test_midi import mido_reference, random_events
+except ImportError: mido_reference = None   # mido が無ければ新しい書き出しだけ測る
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
+
+
+def main(sizes):
+    for count in sizes:
+        rng = random.Random(count)
+        names = list(ct.CHORD_BY_NAME)
+        events = [(ct.get_chord(rng.choice(names)).notes, rng.choice(list(ct.DURATION_OPTIONS.values()))) for _ in range(count)]
+        new_time, data = timed(ct.render_midi_bytes, events, 0, 120.0)
+        line = f"{count:>7} chords: render_midi_bytes {new_time * 1000:8.1f} ms"
+        if mido_reference is not None:
+            old_time, old = timed(mido_reference, events, 0, 120.0)
+            assert old == data, "output differs from mido"
+            line += f" | mido {old_time * 1000:8.1f} ms | {old_time / new_time:5.1f}x"
+        print(line)
+
+
+if __name__ == "__main__":
+    main([int(a) for a in sys.argv[1:]] or [10000, 100000])
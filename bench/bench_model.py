@@ -0,0 +1,57 @@
+# コード進行のメモリ量と速度: dict のリスト (以前の形式) と Progression (列データ) を比べる
+#   python bench/bench_model.py [コード数]   (既定: 200000)
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "tests"))
+import chordthinker as ct
+from test_model import random_dicts
+
+
+def measure(func, *args):
+    # (結果, 秒, 確保したまま残ったバイト数)。tracemalloc 中なので時間は参考値
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func(*args)
+    elapsed = time.perf_counter() - start
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, elapsed, size
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    func(*args)
+    return (time.perf_counter() - start) * 1000
+
+
+def main(count):
+    template = random_dicts(random.Random(0), count)
+    dicts, dict_time, dict_mem = measure(lambda: [dict(d, voicing=list(d['voicing'])) if 'voicing' in d else dict(d) for d in template])
+    prog, prog_time, prog_mem = measure(ct.Progression.from_dicts, template)
+    print(f"{count} chords")
+    print(f"  memory         dicts {dict_mem / 2**20:7.1f} MiB | Progression {prog_mem / 2**20:7.1f} MiB | {dict_mem / prog_mem:4.1f}x")
+    print(f"  build          dicts {dict_time * 1000:7.1f} ms  | from_dicts  {prog_time * 1000:7.1f} ms")
+    rows = [
+        ("names", lambda: [d['name'] for d in dicts], prog.names),
+        ("types", lambda: [ct.get_chord(d['name']).type for d in dicts], lambda: [prog.chord(i).type for i in range(len(prog))]),
+        ("events", lambda: [(d['voicing'] if 'voicing' in d else ct.get_chord(d['name']).notes, d['duration']) for d in dicts], lambda: list(prog.events())),
+        ("to_dicts", lambda: [dict(d) for d in dicts], prog.to_dicts),
+    ]
+    for name, old, new in rows:
+        print(f"  {name:<14} dicts {timed(old):7.1f} ms  | Progression {timed(new):7.1f} ms")
+    with tempfile.TemporaryDirectory() as tmp:
+        for ext in (".ctp", ".ctpb"):
+            path = os.path.join(tmp, "song" + ext)
+            save = timed(ct.write_project_file, path, {"bpm": "120", "progression": prog})
+            load = timed(ct.read_project_file, path)
+            print(f"  {ext:<14} save  {save:7.1f} ms  | load        {load:7.1f} ms | {os.path.getsize(path) / 2**20:6.1f} MiB")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200000)
@@ -0,0 +1,52 @@
+# タイムラインの検索と部分更新の速度 (既定 50000 ブロック)
+#   python bench/bench_timeline.py [ブロック数]
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "tests"))
+import chordthinker as ct
+from test_timeline import build, linear_drop_index, linear_index_at_x
+
+
+def per_call(func, args):
+    start = time.perf_counter()
+    results = [func(*a) for a in args]
+    return (time.perf_counter() - start) / len(args), results
+
+
+def main(count):
+    rng = random.Random(0)
+    start = time.perf_counter()
+    index, blocks = build(rng, count)
+    print(f"{count} blocks: build {(time.perf_counter() - start) * 1000:.1f} ms")
+
+    xs = [rng.uniform(0, index.end_x()) for _ in range(200)]
+    for name, fast, slow in (("index_at_x", index.index_at_x, linear_index_at_x),
+                             ("drop_index", index.drop_index, linear_drop_index)):
+        fast_t, fast_r = per_call(fast, [(x,) for x in xs])
+        slow_t, slow_r = per_call(slow, [(blocks, x) for x in xs])
+        assert fast_r == slow_r, f"{name} differs from linear scan"
+        print(f"  {name:<11} bisect {fast_t * 1e6:7.2f} us | linear {slow_t * 1e6:9.1f} us | {slow_t / fast_t:7.0f}x")
+
+    # 末尾付近のブロックの長さ変更: 変化したブロック以降だけ積み直す
+    widths = [e - s for s, e in zip(index.starts, index.ends)]
+    durs = list(index.durations)
+    ks = [rng.randrange(count - 100, count) for _ in range(200)]
+    start = time.perf_counter()
+    for k in ks:
+        index.truncate(k)
+        for w, d in zip(widths[k:], durs[k:]): index.append(w, d)
+    tail_t = (time.perf_counter() - start) / len(ks)
+    start = time.perf_counter()
+    for _ in range(5):
+        index.truncate(0)
+        for w, d in zip(widths, durs): index.append(w, d)
+    full_t = (time.perf_counter() - start) / 5
+    print(f"  edit near end: partial {tail_t * 1e6:7.1f} us | full rebuild {full_t * 1e3:7.1f} ms")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 50000)
@@ -1,16 +1,91 @@
-import tkinter as tk
-from tkinter import messagebox, filedialog, ttk, simpledialog
-import mido
-from mido import Message, MidiFile, MidiTrack, MetaMessage
-import pygame
-import threading
 import time
-import google.generativeai as genai
+STARTUP_CLOCK = time.perf_counter()   # --profile-startup の基準 (モジュール読み込み開始)
+# tkinter の無い Python (サーバーなど) でもヘッドレス変換 (render / wav / convert) は動くようにする
+try:
+    import tkinter as tk
+    from tkinter import messagebox, filedialog, ttk, simpledialog
+except ImportError: tk = None
+import threading
+import queue
+import random
 import os
+import sys
 import re
 import tempfile
+import io
 import json
 import shutil
+import struct
+import hashlib
+import bisect
+import mmap
+import itertools
+import functools
+import heapq
+from array import array
+from collections import Counter, OrderedDict, deque
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import wave
+# GUI/AI/シンセ用の重い依存は初めて使う時に読み込む (load_pygame などを参照)。ヘッドレス変換では不要
+pygame = None
+np = None
+genai = None
+
+# --- Startup Profiling ---
+PROFILE_STARTUP = False   # --profile-startup で有効
+IMPORTS_DONE = time.perf_counter()
+STARTUP_TIMINGS = [("import (stdlib, tkinter)", IMPORTS_DONE - STARTUP_CLOCK)]
+
+def profile_step(label, start):
+    # start からの経過を記録して今の時刻を返す。起動後の遅延読み込みは --profile-startup 時にその場で表示
+    now = time.perf_counter()
+    if STARTUP_TIMINGS is not None: STARTUP_TIMINGS.append((label, now - start))
+    elif PROFILE_STARTUP: print(f"[profile] {label}: {(now - start) * 1000:.1f} ms")
+    return now
+
+def print_startup_profile():
+    global STARTUP_TIMINGS
+    total = time.perf_counter() - STARTUP_CLOCK
+    print(f"Startup profile ({total * 1000:.1f} ms until first idle):")
+    for label, seconds in STARTUP_TIMINGS:
+        print(f"  {seconds * 1000:8.1f} ms {seconds / total * 100:5.1f}%  {label}")
+    STARTUP_TIMINGS = None
+
+# --- Lazy Imports ---
+def load_pygame():
+    # 初回プレビューで読み込む。pygame.init() は全モジュールを初期化して遅いので mixer だけ使う
+    global pygame
+    if pygame is None:
+        start = time.perf_counter()
+        import pygame as module
+        start = profile_step("import pygame", start)
+        module.mixer.init()
+        profile_step("pygame.mixer.init", start)
+        pygame = module
+    return pygame
+
+def load_numpy():
+    # シンセを使う時だけ読み込む (import だけで tkinter の数倍かかる)。無ければ None
+    global np
+    if np is None:
+        start = time.perf_counter()
+        try: import numpy as np
+        except ImportError: return None
+        profile_step("import numpy", start)
+    return np
+
+def load_genai(api_key):
+    # AI を初めて使う時にワーカースレッドから呼ばれる。同時に呼ばれても import は Python 側で1回になる
+    global genai
+    if genai is None:
+        start = time.perf_counter()
+        import google.generativeai as module
+        if api_key: module.configure(api_key=api_key)
+        profile_step("import google.generativeai", start)
+        genai = module
+    return genai
 
 # --- Configuration ---
 C_BG_MAIN = "#1e1e1e"
@@ -31,12 +106,23 @@ C_PR_NOTE = "#ff5555"
 C_PR_NOTE_SEL = "#ffaaaa"
 C_PR_KEY_WHITE = "#dddddd"
 C_PR_KEY_BLACK = "#444444"
+PR_FRAME_MS = 16   # ドラッグ更新は1フレームに1回まで
+PLAYBACK_FRAME_MS = 33   # 再生カーソルの更新間隔
 
 FONT_FAMILY = "Segoe UI"
 FONT_SIZE_UI = 10
 FONT_SIZE_BTN = 10
 
 CONFIG_FILE = "config.json"
+AI_CACHE_FILE = os.path.join(os.path.dirname(CONFIG_FILE), "ai_cache.json")
+AI_CACHE_MAX_ENTRIES = 500
+AI_CACHE_TTL = 30 * 24 * 3600   # 秒
+AI_CONTEXT_CHORDS = 8           # AIに渡す直近のコード数
+AI_PREFETCH_DELAY_MS = 800      # 編集後、先読みを開始するまでの待ち時間
+AI_MODEL_TTL = 7 * 24 * 3600    # 解決済みモデル名の有効期間 (秒)
+AI_WARMUP_DELAY_MS = 5000       # モデル名の先行解決は起動が落ち着いてから
+AI_RETRY_BACKOFF = 1.0          # レート制限時の初回待ち時間 (秒)。以降は倍々
+AI_MAX_RETRIES = 3
 
 TYPE_COLORS = {
     'Maj':  "#007acc", 'Maj7': "#005a9e",
@@ -60,11 +146,6 @@ CHORD_DEFS = {
 ROOTS = ['C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#', 'A', 'A#', 'B']
 NOTE_MAP = {note: i for i, note in enumerate(ROOTS)}
 
-ENHARMONIC_MAP = {
-    'Db': 'C#', 'Eb': 'D#', 'Gb': 'F#', 'Ab': 'G#', 'Bb': 'A#',
-    'DB': 'C#', 'EB': 'D#', 'GB': 'F#', 'AB': 'G#', 'BB': 'A#'
-}
-
 DURATION_OPTIONS = {
     "8分音符": 0.125, "4分音符": 0.25, "2分音符": 0.5,
     "全音符": 1.0, "2小節": 2.0, "4小節": 4.0
@@ -93,9 +174,1546 @@ PRESET_PROGRESSIONS = {
     "J-Popバラード": ["A_Min", "E_Min", "F_Maj", "G_Maj"],
 }
 
-class ChordThinkerApp(tk.Tk):
+# --- Chord Model ---
+# コード名は最初に1回だけ解析して Chord に固める (以降 split しない)。同じ名前は同じ Chord を共有する
+CHORD_TYPES = list(CHORD_DEFS)
+CHORD_TYPE_IDS = {t: i for i, t in enumerate(CHORD_TYPES)}
+
+class Chord:
+    __slots__ = ('id', 'name', 'root', 'type', 'root_id', 'type_id', 'label', 'notes')
+
+    def __init__(self, chord_id, name):
+        self.id = chord_id
+        self.name = name
+        parts = name.split('_')
+        if len(parts) == 2: self.root, self.type = parts
+        else: self.root, self.type = "?", "?"
+        self.root_id = NOTE_MAP.get(self.root, -1)       # 不明なら -1
+        self.type_id = CHORD_TYPE_IDS.get(self.type, -1)
+        self.label = name.replace('_', '\n')
+        if self.root_id >= 0 and self.type_id >= 0: self.notes = tuple(self.root_id + 48 + i for i in CHORD_DEFS[self.type])
+        else: self.notes = ()
+
+CHORDS = []          # chord id -> Chord
+CHORD_BY_NAME = {}
+
+def intern_chord(name):
+    chord = Chord(len(CHORDS), name)
+    CHORDS.append(chord)
+    CHORD_BY_NAME[name] = chord
+    return chord
+
+def build_chord_table():
+    for root in ROOTS:
+        for ctype in CHORD_TYPES:
+            if ctype != 'Rest': intern_chord(f"{root}_{ctype}")
+    intern_chord("Rest_Rest")
+
+build_chord_table()
+
+def get_chord(name):
+    # 表にない名前 (古いファイルや AI の出力など) もそのまま保持して保存できるようにする
+    chord = CHORD_BY_NAME.get(name)
+    if chord is None: chord = intern_chord(name)
+    return chord
+
+# --- Chord Name Parser ---
+# AI の回答などの表記ゆれを CHORD_DEFS のキーへ寄せる。テンション付きは近い基本形に丸める
+CHORD_SUFFIX_ALIASES = {
+    'Maj': ["", "M", "maj", "Maj", "major", "Major", "6", "M6", "maj6", "add6"],
+    'Min': ["m", "mi", "min", "Min", "minor", "Minor", "-", "m6", "min6", "-6"],
+    '7': ["7", "dom", "dom7", "9", "11", "13", "7b9", "7#9", "7#11", "7b13"],
+    'Maj7': ["M7", "maj7", "Maj7", "ma7", "j7", "Δ", "Δ7", "M9", "maj9", "Maj9", "Δ9", "maj13", "maj7#11"],
+    'm7': ["m7", "mi7", "min7", "Min7", "-7", "m9", "min9", "-9", "m11", "m13"],
+    'mM7': ["mM7", "mMaj7", "mmaj7", "minmaj7", "mΔ7", "-Δ7", "-maj7", "mM9"],
+    'm7-5': ["m7-5", "m7b5", "min7b5", "mi7b5", "-7b5", "ø", "ø7", "halfdim"],
+    'dim': ["dim", "Dim", "°", "o", "mb5", "m-5"],
+    'dim7': ["dim7", "Dim7", "°7", "o7"],
+    'aug': ["aug", "Aug", "augmented", "+", "+5", "#5"],
+    'sus4': ["sus4", "Sus4", "sus", "7sus4", "7sus", "9sus4"],
+    'sus2': ["sus2", "Sus2", "7sus2"],
+    'add9': ["add9", "Add9", "add2", "2"],
+}
+CHORD_SUFFIXES = {alias: ctype for ctype, aliases in CHORD_SUFFIX_ALIASES.items() for alias in aliases}
+CHORD_SUFFIXES_LOWER = {}
+# 大文字小文字を無視した照合では、元から小文字の表記を優先する (m7 は M7 ではなくマイナー)
+for alias, ctype in sorted(CHORD_SUFFIXES.items(), key=lambda kv: kv[0] != kv[0].lower()):
+    CHORD_SUFFIXES_LOWER.setdefault(alias.lower(), ctype)
+ROOT_ALIASES = {**{r: r for r in ROOTS}, **{f"{r[0]}b": ROOTS[(i - 1) % 12] for i, r in enumerate(ROOTS) if len(r) == 1},
+                'E#': 'F', 'B#': 'C'}
+# ルート + 臨時記号 (大文字の表記 "DBMAJ7" の B も♭とみなす) + 任意の "_" + 種類 + 任意の "/ベース"
+CHORD_NAME_RE = re.compile(r"([A-G])([#bB])?_?([^/]*)(?:/[A-G][#b]?)?")
+
+@functools.lru_cache(maxsize=4096)
+def parse_chord_name(text):
+    # "Bbmaj7" / "G7sus4" / "F#ø" / "A_m7" などを "A#_Maj7" 形式にする。解釈できなければ None
+    if not text: return None
+    s = text.strip().replace(" ", "").replace("♯", "#").replace("♭", "b").strip(".,。")
+    if not s: return None
+    m = CHORD_NAME_RE.fullmatch(s[0].upper() + s[1:])
+    if m is None: return None
+    root = ROOT_ALIASES.get(m.group(1) + (m.group(2) or "").replace("B", "b"))
+    suffix = m.group(3).replace("(", "").replace(")", "")
+    ctype = CHORD_SUFFIXES.get(suffix) or CHORD_SUFFIXES_LOWER.get(suffix.lower())
+    if root is None or ctype is None: return None
+    return f"{root}_{ctype}"
+
+ITEM_UIDS = itertools.count(1)
+
+class ProgressionItem:
+    __slots__ = ('chord', 'duration', 'voicing', 'uid')
+
+    def __init__(self, chord, duration, voicing=None, uid=0):
+        self.chord = chord
+        self.duration = duration
+        self.voicing = voicing
+        self.uid = uid
+
+    @property
+    def name(self):
+        return self.chord.name
+
+    @property
+    def notes(self):
+        return self.chord.notes if self.voicing is None else self.voicing
+
+    def to_dict(self):
+        data = {'name': self.chord.name, 'duration': self.duration}
+        if self.voicing is not None: data['voicing'] = list(self.voicing)
+        return data
+
+    @staticmethod
+    def from_dict(data):
+        voicing = data.get('voicing')
+        return ProgressionItem(get_chord(data['name']), data['duration'], list(voicing) if voicing is not None else None)
+
+class Progression:
+    # 列ごとの配列で持つ。uid はブロックの同一性 (タイムラインの再利用やリハモ結果) に使う
+    def __init__(self, items=()):
+        self.chord_ids = array('H')
+        self.durations = array('d')
+        self.voicings = []   # None またはノート番号のリスト
+        self.uids = array('I')
+        self.extend(items)
+
+    @staticmethod
+    def from_dicts(dicts):
+        if isinstance(dicts, Progression): return dicts
+        prog = Progression()
+        lookup = CHORD_BY_NAME.get
+        for data in dicts:
+            chord = lookup(data['name']) or get_chord(data['name'])
+            voicing = data.get('voicing')
+            prog.chord_ids.append(chord.id)
+            prog.durations.append(data['duration'])
+            prog.voicings.append(list(voicing) if voicing is not None else None)
+        prog.uids.extend(itertools.islice(ITEM_UIDS, len(prog.durations)))
+        return prog
+
+    def to_dicts(self):
+        return [item.to_dict() for item in self]
+
+    def __len__(self):
+        return len(self.durations)
+
+    def __iter__(self):
+        for chord_id, duration, voicing, uid in zip(self.chord_ids, self.durations, self.voicings, self.uids):
+            yield ProgressionItem(CHORDS[chord_id], duration, voicing, uid)
+
+    def __getitem__(self, i):
+        return ProgressionItem(CHORDS[self.chord_ids[i]], self.durations[i], self.voicings[i], self.uids[i])
+
+    def chord(self, i):
+        return CHORDS[self.chord_ids[i]]
+
+    def names(self):
+        return [CHORDS[c].name for c in self.chord_ids]
+
+    def events(self, start=0, end=None):
+        # (ノート, 長さ) の列。MIDI 書き出し用
+        if end is None: end = len(self.durations)
+        for chord_id, duration, voicing in zip(self.chord_ids[start:end], self.durations[start:end], self.voicings[start:end]):
+            yield (CHORDS[chord_id].notes if voicing is None else voicing), duration
+
+    def insert(self, i, item):
+        self.chord_ids.insert(i, item.chord.id)
+        self.durations.insert(i, item.duration)
+        self.voicings.insert(i, item.voicing)
+        self.uids.insert(i, next(ITEM_UIDS))
+
+    def append(self, item):
+        self.insert(len(self.durations), item)
+
+    def extend(self, items):
+        for item in items: self.append(item)
+
+    def pop(self, i=-1):
+        item = self[i]
+        del self.chord_ids[i], self.durations[i], self.voicings[i], self.uids[i]
+        return item
+
+    def move(self, src, dst):
+        for col in (self.chord_ids, self.durations, self.voicings, self.uids): col.insert(dst, col.pop(src))
+
+    def set_duration(self, i, duration):
+        self.durations[i] = duration
+
+    def set_voicing(self, i, voicing):
+        self.voicings[i] = list(voicing) if voicing is not None else None
+
+# --- Voice Leading ---
+# 自動ボイシング: 転回形 x オクターブの候補から、隣り合うコード間の移動量の合計が最小になる列を Viterbi で選ぶ
+VOICING_RANGE = (48, 76)      # 候補の音域 (C3-E5)。どのコードも基本形 (オクターブ3) がこの中に入る
+VOICING_REGISTER_WEIGHT = 0.05   # 音域の中央から離れるほど少しだけ不利にする (全体が端へ寄るのと同点の揺れを防ぐ)
+VOICING_CHUNK = 2048          # 遷移コストを一度に計算するコード数
+
+@functools.lru_cache(None)
+def voicing_candidates(chord_id, low=VOICING_RANGE[0], high=VOICING_RANGE[1]):
+    # 密集配置の各転回形を、音域に収まるすべてのオクターブに置いたもの。休符や不明なコードは空
+    chord = CHORDS[chord_id]
+    if chord.root_id < 0 or chord.type_id < 0 or not CHORD_DEFS[chord.type]: return ()
+    intervals = sorted(CHORD_DEFS[chord.type])
+    result = set()
+    for k in range(len(intervals)):
+        shape = sorted(intervals[k:] + [i + 12 for i in intervals[:k]])
+        bass_pc = (chord.root_id + shape[0]) % 12
+        for bass in range(low + (bass_pc - low) % 12, high + 1, 12):
+            if bass + shape[-1] - shape[0] <= high: result.add(tuple(bass + i - shape[0] for i in shape))
+    return tuple(sorted(result, key=lambda v: (v[0], v)))
+
+def voice_leading_costs(cands, valid, start, end):
+    # cands[t] から cands[t+1] への移動量 (t = start..end-1)。各音から相手の一番近い音までの距離を両方向に足す
+    # 音の数は高々数個なので、音の組ごとの (t, 候補a, 候補b) 配列を np.minimum で畳む方が軸方向の min より速い
+    a, b = cands[start:end], cands[start + 1:end + 1]
+    va, vb = valid[start:end], valid[start + 1:end + 1]
+    voices = range(cands.shape[2])
+    dist = [[np.abs(a[:, :, None, i] - b[:, None, :, j]) for j in voices] for i in voices]
+    cost = sum(functools.reduce(np.minimum, dist[i]) * va[:, :, None, i] for i in voices)
+    return cost + sum(functools.reduce(np.minimum, [row[j] for row in dist]) * vb[:, None, :, j] for j in voices)
+
+def optimize_voicings(chord_ids, before=None, after=None, low=VOICING_RANGE[0], high=VOICING_RANGE[1]):
+    # 各コードのボイシング (タプル、休符は None) を返す。before / after は範囲の外で固定された前後のボイシング
+    if load_numpy() is None: raise RuntimeError("自動ボイシングには numpy が必要です (pip install numpy)")
+    result = [None] * len(chord_ids)
+    positions = [i for i, cid in enumerate(chord_ids) if voicing_candidates(cid, low, high)]
+    if not positions: return result
+    options = [voicing_candidates(chord_ids[i], low, high) for i in positions]
+    if before: options.insert(0, (tuple(before),))
+    if after: options.append((tuple(after),))
+    count = len(options)
+    width = max(len(o) for o in set(options))
+    voices = max(len(v) for o in set(options) for v in o)
+    # 足りない候補と音は遠くの音 (1000) で埋め、valid で除外する。同じコードの配列は1回だけ作る
+    padded = {}
+    for opts in set(options):
+        block = np.full((width, voices), 1000, dtype=np.int16)
+        for k, v in enumerate(opts): block[k, :len(v)] = v
+        padded[opts] = block
+    cands = np.stack([padded[o] for o in options])
+    valid = (cands < 1000).astype(np.int16)
+    sizes = valid.sum(2)
+    center = (low + high) / 2
+    with np.errstate(invalid="ignore", divide="ignore"):
+        unary = np.abs((cands * valid).sum(2) / sizes - center) * VOICING_REGISTER_WEIGHT
+    unary[sizes == 0] = np.inf
+    back = np.zeros((count, width), dtype=np.int32)
+    score = unary[0]
+    columns = np.arange(width)
+    for start in range(0, count - 1, VOICING_CHUNK):
+        end = min(start + VOICING_CHUNK, count - 1)
+        costs = voice_leading_costs(cands, valid, start, end)
+        for t in range(start, end):
+            total = score[:, None] + costs[t - start]
+            back[t + 1] = total.argmin(0)
+            score = total[back[t + 1], columns] + unary[t + 1]   # total.min(0) より速い
+    k = int(score.argmin())
+    chosen = [0] * count
+    for t in range(count - 1, -1, -1):
+        chosen[t] = k
+        k = back[t, k]
+    offset = 1 if before else 0
+    for i, t in zip(positions, range(offset, offset + len(positions))):
+        result[i] = options[t][chosen[t]]
+    return result
+
+def voice_lead_progression(progression, start=0, end=None):
+    # progression[start:end] のボイシングを選び直した値 (基本形と同じなら None) を返す
+    # 範囲の前後のコードは今のボイシングのまま固定するので、編集した所から後ろだけ実行し直してもつながる
+    end = len(progression) if end is None else end
+    before = next((progression[i].notes for i in range(start - 1, -1, -1) if progression[i].notes), None)
+    after = next((progression[i].notes for i in range(end, len(progression)) if progression[i].notes), None)
+    chord_ids = progression.chord_ids[start:end]
+    result = []
+    for i, cid, v in zip(range(start, end), chord_ids, optimize_voicings(chord_ids, before, after)):
+        if v is None: result.append(progression.voicings[i])   # 休符や表にないコードはそのまま
+        else: result.append(None if v == CHORDS[cid].notes else list(v))
+    return result
+
+# --- MIDI Rendering ---
+def parse_bpm(value):
+    try: return float(value)
+    except: return 120.0
+
+MIDI_TICKS_PER_BEAT = 480
+MIDI_VELOCITY = 90
+VLQ_TABLE = [bytes([i]) for i in range(128)]
+
+def encode_vlq(value):
+    if value < 0: raise ValueError('message time must be non-negative in MIDI file')
+    if value < 128: return VLQ_TABLE[value]
+    out = [value & 0x7f]
+    value >>= 7
+    while value:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    return bytes(reversed(out))
+
+def encode_chord_block(notes, delta, running_status):
+    # running_status: 直前のイベントが note_off (0x80) ならステータスバイトを省略できる
+    for n in notes:
+        if not 0 <= n <= 127: raise ValueError(f"note must be in range 0..127: {n}")
+    if not notes:
+        return delta + (b'\x00\x00' if running_status else b'\x80\x00\x00')
+    vel = MIDI_VELOCITY
+    block = bytearray(b'\x00\x90')
+    block += bytes([notes[0], vel])
+    for n in notes[1:]: block += bytes([0, n, vel])
+    block += delta
+    block += bytes([0x80, notes[0], vel])
+    for n in notes[1:]: block += bytes([0, n, vel])
+    return bytes(block)
+
+def render_midi_bytes(events, program=0, bpm=120.0, ticks_per_beat=MIDI_TICKS_PER_BEAT):
+    # events: (notes, duration) の列。mido.MidiFile.save と同一のバイト列を出力する
+    ticks_per_bar = ticks_per_beat * 4
+    tempo = int(round(60 * 1e6 / bpm))
+    delta_table = {dur: encode_vlq(int(ticks_per_bar * dur)) for dur in DURATION_OPTIONS.values()}
+    block_cache = {}
+    blocks = []
+    running_status = False
+    for notes, dur in events:
+        key = (tuple(notes), dur, running_status)
+        block = block_cache.get(key)
+        if block is None:
+            delta = delta_table.get(dur)
+            if delta is None: delta = delta_table[dur] = encode_vlq(int(ticks_per_bar * dur))
+            block = block_cache[key] = encode_chord_block(key[0], delta, running_status)
+        blocks.append(block)
+        running_status = True
+
+    track_head = b'\x00\xc0' + bytes([program]) + b'\x00\xff\x51\x03' + tempo.to_bytes(3, 'big')
+    track_tail = b'\x00\xff\x2f\x00'
+    track_len = len(track_head) + sum(map(len, blocks)) + len(track_tail)
+    header = b'MThd' + struct.pack('>Lhhh', 6, 1, 1, ticks_per_beat) + b'MTrk' + struct.pack('>L', track_len)
+
+    data = bytearray(len(header) + track_len)
+    pos = len(header)
+    data[:pos] = header
+    data[pos:pos + len(track_head)] = track_head
+    pos += len(track_head)
+    for block in blocks:
+        end = pos + len(block)
+        data[pos:end] = block
+        pos = end
+    data[pos:] = track_tail
+    return bytes(data)
+
+def render_project_midi(data):
+    prog_num = INSTRUMENT_MAP.get(data.get("instrument", "Grand Piano"), 0)
+    bpm = parse_bpm(data.get("bpm", "120"))
+    events = Progression.from_dicts(data.get("progression", [])).events()
+    return render_midi_bytes(events, prog_num, bpm), bpm
+
+# --- Audio Rendering ---
+# numpy による簡易シンセ (加算合成 + ADSR)。WAV 書き出しと、MIDI デバイスに頼らないプレビューに使う
+AUDIO_SAMPLE_RATE = 44100
+AUDIO_CHUNK_CHORDS = 64   # 並列レンダリングの1チャンクあたりのコード数
+AUDIO_NOTE_GAIN = 0.12
+# GM の楽器ファミリー (program // 8) -> (倍音の強さ, attack 秒, decay 秒, sustain, release 秒)
+AUDIO_TIMBRES = {
+    0: ((1.0, 0.5, 0.25, 0.12, 0.06), 0.005, 0.6, 0.25, 0.3),              # Piano
+    1: ((1.0, 0.0, 0.4, 0.0, 0.2), 0.002, 0.4, 0.1, 0.4),                  # Chromatic Perc
+    2: ((1.0, 0.8, 0.6, 0.4, 0.3, 0.2), 0.01, 0.05, 0.9, 0.08),            # Organ
+    3: ((1.0, 0.6, 0.3, 0.2, 0.1), 0.003, 0.5, 0.2, 0.2),                  # Guitar
+    4: ((1.0, 0.4, 0.1), 0.005, 0.3, 0.5, 0.12),                           # Bass
+    5: ((1.0, 0.5, 0.33, 0.25, 0.2, 0.16), 0.12, 0.2, 0.8, 0.35),          # Strings
+    6: ((1.0, 0.45, 0.3, 0.2, 0.15), 0.15, 0.2, 0.8, 0.4),                 # Ensemble
+    7: ((1.0, 0.7, 0.5, 0.35, 0.25), 0.04, 0.15, 0.75, 0.15),              # Brass
+    8: ((1.0, 0.1, 0.5, 0.05, 0.3), 0.03, 0.1, 0.8, 0.12),                 # Reed
+    9: ((1.0, 0.15, 0.05), 0.05, 0.1, 0.85, 0.15),                         # Pipe
+    10: ((1.0, 0.5, 0.33, 0.25, 0.2, 0.16, 0.14), 0.01, 0.1, 0.8, 0.1),    # Synth Lead
+    11: ((1.0, 0.3, 0.15, 0.08), 0.3, 0.4, 0.7, 0.6),                      # Synth Pad
+    12: ((1.0, 0.2, 0.4, 0.1), 0.2, 0.5, 0.6, 0.8),                        # Synth Effects
+    13: ((1.0, 0.7, 0.2, 0.3, 0.1), 0.002, 0.4, 0.15, 0.3),                # Ethnic
+}
+
+def audio_event_offsets(events, bpm, sample_rate=AUDIO_SAMPLE_RATE, ticks_per_beat=MIDI_TICKS_PER_BEAT):
+    # 各コードの開始サンプル (MIDI と同じ tick の丸めとテンポ)。最後の要素は全体の長さ
+    ticks_per_bar = ticks_per_beat * 4
+    samples_per_tick = int(round(60 * 1e6 / bpm)) / 1e6 / ticks_per_beat * sample_rate
+    offsets, tick = [0], 0
+    for _, dur in events:
+        tick += int(ticks_per_bar * dur)
+        offsets.append(int(round(tick * samples_per_tick)))
+    return offsets
+
+def adsr_envelope(length, total, attack, decay, sustain, release_len, sample_rate=AUDIO_SAMPLE_RATE):
+    n = np.arange(total, dtype=np.float64)
+    a = max(1, int(attack * sample_rate))
+    d = max(1, int(decay * sample_rate))
+    env = np.where(n < a, n / a, sustain + (1.0 - sustain) * np.exp(-(n - a) / d))
+    if release_len > 0 and length < total:
+        off_level = env[length - 1] if length > 0 else 0.0
+        env[length:] = off_level * (1.0 - (n[length:] - length) / release_len)
+    return env
+
+def synth_chord(notes, length, timbre, sample_rate=AUDIO_SAMPLE_RATE):
+    # length サンプル鳴らし、release 分の余韻を含めた配列を返す
+    harmonics, attack, decay, sustain, release = timbre
+    total = length + int(release * sample_rate)
+    if not notes or length <= 0: return np.zeros(total, dtype=np.float32)
+    t = np.arange(total, dtype=np.float64) * (2 * np.pi / sample_rate)
+    freqs = 440.0 * 2.0 ** ((np.asarray(notes, dtype=np.float64) - 69) / 12)
+    phase = np.outer(freqs, t)   # (ノート数, サンプル数)
+    # sin(hx) は sin((h+1)x) = 2cos(x)sin(hx) - sin((h-1)x) で求め、sin の呼び出しを基音の1回に抑える
+    two_cos = 2 * np.cos(phase)
+    prev, cur = np.zeros_like(phase), np.sin(phase)
+    samples = np.zeros(total)
+    for h, amp in enumerate(harmonics, 1):
+        audible = freqs * h < sample_rate / 2   # ナイキスト周波数を超える倍音は省く
+        if amp and audible.any(): samples += amp * cur[audible].sum(axis=0)
+        prev, cur = cur, two_cos * cur - prev
+    samples *= adsr_envelope(length, total, attack, decay, sustain, total - length, sample_rate)
+    return (samples * AUDIO_NOTE_GAIN).astype(np.float32)
+
+def render_audio_chunk(events, offsets, timbre, sample_rate=AUDIO_SAMPLE_RATE):
+    # プロセスプールから呼ばれる。offsets はチャンク先頭からの相対位置。余韻込みの配列を返す
+    load_numpy()
+    out = np.zeros(offsets[-1] + int(timbre[4] * sample_rate), dtype=np.float32)
+    cache = {}
+    for (notes, _), start, end in zip(events, offsets, offsets[1:]):
+        key = (notes, end - start)
+        block = cache.get(key)
+        if block is None: block = cache[key] = synth_chord(notes, end - start, timbre, sample_rate)
+        out[start:start + len(block)] += block
+    return out
+
+def render_audio(events, program, bpm, out, workers=1, loop=False, sample_rate=AUDIO_SAMPLE_RATE):
+    # out (パスまたはファイル) に 16bit モノラル WAV を書く。チャンクごとに並列で合成し、順に書き出す
+    # loop=True なら最後の余韻を先頭に重ねて、繰り返し再生したときに継ぎ目が出ないようにする
+    if load_numpy() is None: raise RuntimeError("WAV の書き出しには numpy が必要です (pip install numpy)")
+    events = [(tuple(notes), dur) for notes, dur in events]
+    timbre = AUDIO_TIMBRES.get(program // 8, AUDIO_TIMBRES[0])
+    offsets = audio_event_offsets(events, bpm, sample_rate)
+    bounds = list(range(0, len(events), AUDIO_CHUNK_CHORDS)) + [len(events)]
+    chunks = [(events[a:b], [o - offsets[a] for o in offsets[a:b + 1]]) for a, b in zip(bounds, bounds[1:])]
+    pool = ProcessPoolExecutor(max_workers=workers) if workers > 1 and len(chunks) > 1 else None
+    try:
+        if pool is None: blocks = (render_audio_chunk(ev, offs, timbre, sample_rate) for ev, offs in chunks)
+        else: blocks = pool.map(render_audio_chunk, *zip(*chunks), [timbre] * len(chunks), [sample_rate] * len(chunks))
+        with wave.open(out, "wb") as w:
+            w.setnchannels(1)
+            w.setsampwidth(2)
+            w.setframerate(sample_rate)
+            carry = np.zeros(0, dtype=np.float32)
+            pieces = []
+            for (ev, offs), block in zip(chunks, blocks):
+                if len(carry) > len(block): block = np.concatenate([block, np.zeros(len(carry) - len(block), dtype=np.float32)])
+                block[:len(carry)] += carry
+                head, carry = block[:offs[-1]], block[offs[-1]:]
+                if loop: pieces.append(head)
+                else: w.writeframes(audio_to_pcm(head))
+            if loop:
+                audio = np.concatenate(pieces) if pieces else np.zeros(0, dtype=np.float32)
+                for i in range(0, len(carry), max(1, len(audio))): audio[:len(carry) - i] += carry[i:i + len(audio)]
+                w.writeframes(audio_to_pcm(audio))
+            else: w.writeframes(audio_to_pcm(carry))
+    finally:
+        if pool is not None: pool.shutdown()
+    return offsets[-1] / sample_rate
+
+def audio_to_pcm(samples):
+    return (np.clip(samples, -1.0, 1.0) * 32767).astype('<i2').tobytes()
+
+def render_audio_bytes(events, program, bpm, loop=False):
+    buffer = io.BytesIO()
+    render_audio(events, program, bpm, buffer, loop=loop)
+    return buffer.getvalue()
+
+def render_project_audio(data, path, workers=1):
+    prog_num = INSTRUMENT_MAP.get(data.get("instrument", "Grand Piano"), 0)
+    bpm = parse_bpm(data.get("bpm", "120"))
+    events = Progression.from_dicts(data.get("progression", [])).events()
+    tmp_path = path + ".tmp"
+    seconds = render_audio(events, prog_num, bpm, tmp_path, workers)
+    os.replace(tmp_path, path)
+    return seconds
+
+# --- Project Files ---
+# .ctpb: 固定長の列データ (duration / voicing offset / chord id / voicing / flag) + 小さなヘッダ
+CTPB_MAGIC = b"CTPB"
+CTPB_VERSION = 1
+CTPB_HEADER = struct.Struct("<4sHHIIII")   # magic, version, reserved, count, names, voicing_len, meta_len
+PROJECT_FILETYPES = [("Chord Thinker Project", "*.ctp"), ("Chord Thinker Binary", "*.ctpb"), ("All Files", "*.*")]
+
+def is_binary_project(path):
+    return path.lower().endswith(".ctpb")
+
+def write_binary_project(path, data):
+    names = {}
+    ids, durations, has_voicing = array('I'), array('d'), array('B')
+    offsets, pool = array('I', [0]), array('h')
+    for item in Progression.from_dicts(data.get("progression", [])):
+        ids.append(names.setdefault(item.name, len(names)))
+        durations.append(item.duration)
+        if item.voicing is not None:
+            has_voicing.append(1)
+            pool.extend(item.voicing)
+        else: has_voicing.append(0)
+        offsets.append(len(pool))
+    # progression は列データに置くが、キーの順序を保つため null として残す
+    meta = json.dumps({k: (None if k == "progression" else v) for k, v in data.items()}, ensure_ascii=False).encode("utf-8")
+    name_table = b"".join(struct.pack("<H", len(b)) + b for b in (n.encode("utf-8") for n in names))
+    head = CTPB_HEADER.pack(CTPB_MAGIC, CTPB_VERSION, 0, len(ids), len(names), len(pool), len(meta)) + meta + name_table
+    columns = [durations, offsets, ids, pool, has_voicing]   # アラインメントの大きい順
+    if sys.byteorder == "big":
+        for col in columns: col.byteswap()
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(head + b"\0" * (-len(head) % 8))
+        for col in columns: col.tofile(f)
+    os.replace(tmp_path, path)
+
+class BinaryProject:
+    # mmap した .ctpb の各列をそのまま memoryview として参照する。item(i) で必要な分だけ取り出す
+    def __init__(self, path):
+        self.file = open(path, "rb")
+        self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.views = []
+        try:
+            magic, version, _, count, names_count, voicing_len, meta_len = CTPB_HEADER.unpack_from(self.mm, 0)
+            if magic != CTPB_MAGIC: raise ValueError("Not a Chord Thinker binary project")
+            if version != CTPB_VERSION: raise ValueError(f"Unsupported .ctpb version: {version}")
+            pos = CTPB_HEADER.size
+            self.meta = json.loads(self.mm[pos:pos + meta_len].decode("utf-8"))
+            pos += meta_len
+            self.names = []
+            for _ in range(names_count):
+                (n,) = struct.unpack_from("<H", self.mm, pos)
+                self.names.append(self.mm[pos + 2:pos + 2 + n].decode("utf-8"))
+                pos += 2 + n
+            pos += -pos % 8
+            self.count = count
+            self.durations, pos = self.column(pos, count, 'd')
+            self.offsets, pos = self.column(pos, count + 1, 'I')
+            self.ids, pos = self.column(pos, count, 'I')
+            self.pool, pos = self.column(pos, voicing_len, 'h')
+            self.has_voicing, pos = self.column(pos, count, 'B')
+        except Exception:
+            self.close()
+            raise
+
+    def column(self, pos, n, fmt):
+        size = array(fmt).itemsize * n
+        if pos + size > len(self.mm): raise ValueError("Truncated .ctpb file")
+        if sys.byteorder == "big":
+            col = array(fmt, self.mm[pos:pos + size])
+            col.byteswap()
+            return col, pos + size
+        view = memoryview(self.mm)[pos:pos + size].cast(fmt)
+        self.views.append(view)
+        return view, pos + size
+
+    def __len__(self):
+        return self.count
+
+    def item(self, i):
+        item = {'name': self.names[self.ids[i]], 'duration': self.durations[i]}
+        if self.has_voicing[i]: item['voicing'] = self.pool[self.offsets[i]:self.offsets[i + 1]].tolist()
+        return item
+
+    def to_progression(self):
+        # 行ごとの dict を作らず、列から直接 Progression を組み立てる。名前表はファイル内の番号 -> コード id に1回だけ引く
+        chord_ids = array('H', (get_chord(name).id for name in self.names))
+        prog = Progression()
+        prog.chord_ids = array('H', map(chord_ids.__getitem__, self.ids))
+        prog.durations = array('d', self.durations)
+        prog.voicings = [None] * self.count
+        offsets, pool = self.offsets, self.pool
+        for i in itertools.compress(range(self.count), self.has_voicing):
+            prog.voicings[i] = pool[offsets[i]:offsets[i + 1]].tolist()
+        prog.uids.extend(itertools.islice(ITEM_UIDS, self.count))
+        return prog
+
+    def to_project_data(self):
+        progression = self.to_progression()
+        data = {k: (progression if k == "progression" else v) for k, v in self.meta.items()}
+        data.setdefault("progression", progression)
+        return data
+
+    def close(self):
+        for view in self.views: view.release()
+        self.views = []
+        self.mm.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def read_project_file(path):
+    if is_binary_project(path):
+        with BinaryProject(path) as project: return project.to_project_data()
+    with open(path, "r", encoding="utf-8") as f: return json.load(f)
+
+def write_project_file(path, data):
+    if is_binary_project(path):
+        write_binary_project(path, data)
+        return
+    if isinstance(data.get("progression"), Progression): data = {**data, "progression": data["progression"].to_dicts()}
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=4)
+    os.replace(tmp_path, path)
+
+def file_sha256(path):
+    with open(path, "rb") as f: return hashlib.sha256(f.read()).hexdigest()
+
+# --- Edit Journal ---
+# 操作: insert(index, items) / delete(indices, items) / move(from, to) / resize(index, old, new) / voicing(index, old, new) / meta(old, new)
+JOURNAL_BATCH_OPS = 20      # この数だけ溜まったら fsync
+JOURNAL_FLUSH_MS = 2000     # 溜まらなくても一定時間で fsync
+UNTITLED_JOURNAL = "Untitled.journal"
+
+def apply_edit_op(progression, op):
+    kind = op["op"]
+    if kind == "insert":
+        if "indices" in op:   # delete の逆操作: 元の位置 (昇順) に戻す
+            for i, item in zip(op["indices"], op["items"]): progression.insert(i, ProgressionItem.from_dict(item))
+        else:
+            for i, item in enumerate(op["items"], op["index"]): progression.insert(i, ProgressionItem.from_dict(item))
+    elif kind == "delete":
+        for i in sorted(op["indices"], reverse=True): progression.pop(i)
+    elif kind == "move":
+        progression.move(op["from"], op["to"])
+    elif kind == "resize":
+        progression.set_duration(op["index"], op["new"])
+    elif kind == "voicing":
+        if "indices" in op:   # 自動ボイシングなどでまとめて変更
+            for i, voicing in zip(op["indices"], op["new"]): progression.set_voicing(i, voicing)
+        else: progression.set_voicing(op["index"], op["new"])
+
+def invert_edit_op(op):
+    kind = op["op"]
+    if kind == "insert":
+        indices = op["indices"] if "indices" in op else list(range(op["index"], op["index"] + len(op["items"])))
+        return {"op": "delete", "indices": indices, "items": op["items"]}
+    if kind == "delete": return {"op": "insert", "indices": op["indices"], "items": op["items"]}
+    if kind == "move": return {"op": "move", "from": op["to"], "to": op["from"]}
+    return {**op, "old": op["new"], "new": op["old"]}
+
+def apply_journal_op(data, op):
+    if op["op"] == "meta": data.update(op["new"])
+    else:
+        progression = data["progression"] = Progression.from_dicts(data.get("progression", []))
+        apply_edit_op(progression, op)
+
+class EditJournal:
+    # 追記専用の操作ログ。1行1操作の JSON で、先頭行はヘッダ (元ファイルとそのハッシュ)
+    def __init__(self, path, base_path, base_sha, meta, ops=None):
+        self.path = path
+        self.base_path = base_path
+        self.base_sha = base_sha
+        self.meta = meta
+        self.ops = list(ops or [])   # 元ファイルに未反映の操作
+        self.saved = 0               # ops のうち Ctrl+S で確定済みの数
+        self.pending = []            # ファイルに未書き込みの行
+        self.lock = threading.Lock()
+        self.file = None
+        if self.ops: self.rewrite()
+
+    def header(self):
+        return json.dumps({"journal": 1, "base": self.base_path, "base_sha": self.base_sha, "meta": self.meta}, ensure_ascii=False)
+
+    def append(self, op):
+        with self.lock:
+            self.ops.append(op)
+            self.pending.append(json.dumps(op, ensure_ascii=False))
+            return len(self.pending) >= JOURNAL_BATCH_OPS
+
+    def flush(self):
+        with self.lock: self.flush_locked()
+
+    def flush_locked(self):
+        if not self.pending: return
+        if self.file is None:
+            is_new = not os.path.exists(self.path)
+            self.file = open(self.path, "a", encoding="utf-8")
+            if is_new: self.file.write(self.header() + "\n")
+        self.file.write("\n".join(self.pending) + "\n")
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.pending = []
+
+    def commit(self):
+        with self.lock:
+            self.flush_locked()
+            self.saved = len(self.ops)
+
+    def rewrite(self):
+        # ヘッダ + 未反映の操作だけでファイルを作り直す
+        if self.file is not None: self.file.close(); self.file = None
+        self.pending = []
+        if not self.ops:
+            if os.path.exists(self.path): os.remove(self.path)
+            return
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(self.header() + "\n")
+            for op in self.ops: f.write(json.dumps(op, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def write_marker(self, count, base_sha):
+        with self.lock:
+            self.pending.append(json.dumps({"op": "compacted", "count": count, "base_sha": base_sha}))
+            self.flush_locked()
+
+    def mark_compacted(self, count, base_sha):
+        with self.lock:
+            self.ops = self.ops[count:]
+            self.saved = max(0, self.saved - count)
+            self.base_sha = base_sha
+            self.rewrite()
+
+    def close(self, remove=False):
+        with self.lock:
+            if remove: self.pending = []
+            else: self.flush_locked()
+            if self.file is not None: self.file.close(); self.file = None
+            if remove and os.path.exists(self.path): os.remove(self.path)
+
+def compact_journal(journal):
+    # 確定済みの操作を元ファイルに反映して書き直す。O(プロジェクト) なのでバックグラウンドで呼ぶ
+    with journal.lock: ops = journal.ops[:journal.saved]
+    if not ops or not journal.base_path: return
+    data = read_project_file(journal.base_path)
+    for op in ops: apply_journal_op(data, op)
+    root, ext = os.path.splitext(journal.base_path)
+    tmp_path = f"{root}.compact{ext}"
+    write_project_file(tmp_path, data)
+    new_sha = file_sha256(tmp_path)
+    # 置き換え前に印を残す。ここで落ちても印のハッシュが元ファイルと一致しないので全操作を再適用する
+    journal.write_marker(len(ops), new_sha)
+    os.replace(tmp_path, journal.base_path)
+    journal.mark_compacted(len(ops), new_sha)
+
+# --- Undo History ---
+UNDO_MEMORY_KB = 1024
+
+class UndoHistory:
+    # 1ステップ = 操作のリスト。逆操作はその場で作るのでプロジェクトのコピーは持たない
+    def __init__(self, max_bytes=UNDO_MEMORY_KB * 1024):
+        self.max_bytes = max_bytes
+        self.undo_steps = deque()   # [ops, size]
+        self.redo_steps = []
+        self.total_bytes = 0
+        self.group = None
+
+    def op_size(self, op):
+        return len(json.dumps(op))
+
+    def begin_group(self):
+        self.group = []
+
+    def end_group(self):
+        ops, self.group = self.group, None
+        if ops: self.push_step(ops)
+
+    def push(self, op):
+        if self.group is None: self.push_step([op]); return
+        last = self.group[-1] if self.group else None
+        # ドラッグ中の同じコードへのボイシング変更は1つにまとめる
+        if last is not None and last["op"] == op["op"] == "voicing" and "index" in op and last.get("index") == op["index"]:
+            self.group[-1] = {**last, "new": op["new"]}
+        else: self.group.append(op)
+
+    def push_step(self, ops):
+        for _, size in self.redo_steps: self.total_bytes -= size
+        self.redo_steps = []
+        size = sum(self.op_size(op) for op in ops)
+        self.undo_steps.append([ops, size])
+        self.total_bytes += size
+        while self.total_bytes > self.max_bytes and len(self.undo_steps) > 1:
+            self.total_bytes -= self.undo_steps.popleft()[1]
+
+    def undo(self):
+        # 適用すべき逆操作のリストを返す
+        if not self.undo_steps: return None
+        step = self.undo_steps.pop()
+        self.redo_steps.append(step)
+        return [invert_edit_op(op) for op in reversed(step[0])]
+
+    def redo(self):
+        if not self.redo_steps: return None
+        step = self.redo_steps.pop()
+        self.undo_steps.append(step)
+        return step[0]
+
+    def clear(self):
+        self.undo_steps.clear()
+        self.redo_steps = []
+        self.total_bytes = 0
+        self.group = None
+
+def replay_journal(path):
+    # (復元した project data, 元ファイルのパス, 元ファイルに未反映の操作) を返す
+    with open(path, "r", encoding="utf-8") as f: lines = f.read().splitlines()
+    header = json.loads(lines[0])
+    entries = []
+    for line in lines[1:]:
+        try: entries.append(json.loads(line))
+        except ValueError: break   # クラッシュで途中まで書かれた行
+    base_path = header.get("base")
+    if base_path and os.path.exists(base_path):
+        data = read_project_file(base_path)
+        current_sha = file_sha256(base_path)
+    else:
+        data = {**header.get("meta", {}), "progression": Progression()}
+        current_sha = None
+    ops, start = [], 0
+    for entry in entries:
+        if entry.get("op") == "compacted":
+            if current_sha is not None and entry.get("base_sha") == current_sha: start = entry.get("count", 0)
+        else: ops.append(entry)
+    for op in ops[start:]: apply_journal_op(data, op)
+    return data, base_path, ops[start:]
+
+# --- Theory Engine ---
+# (度数, タイプ) はキーの主音からの半音数
+THEORY_START = {
+    "Major": [(0, 'Maj'), (5, 'Maj'), (7, 'Maj'), (9, 'Min')],
+    "Minor": [(0, 'Min'), (5, 'Min'), (7, 'Maj'), (8, 'Maj')],
+}
+THEORY_RULES = {
+    "Major": {
+        0: ([(7, 'Maj'), (5, 'Maj'), (9, 'Min')], [(1, 'dim7')], "I度。展開へ。"),
+        2: ([(7, 'Maj')], [(7, '7')], "ii度。V度へ。"),
+        4: ([(9, 'Min'), (5, 'Maj')], [], "iii度。vi度へ。"),
+        5: ([(7, 'Maj'), (0, 'Maj'), (2, 'Min')], [(6, 'dim7'), (5, 'Min')], "IV度。展開。"),
+        7: ([(0, 'Maj'), (9, 'Min')], [(7, 'aug'), (7, 'sus4')], "V度。解決か偽終止。"),
+        9: ([(5, 'Maj'), (2, 'Min'), (4, 'Min')], [], "vi度。IVやiiへ。"),
+    },
+    "Minor": {
+        0: ([(5, 'Min'), (8, 'Maj'), (10, 'Maj')], [], "i度。展開へ。"),
+        7: ([(0, 'Min')], [(7, 'aug')], "V度。i度へ解決。"),
+        None: ([(7, 'Maj')], [], "ドミナントを目指して。"),
+    },
+}
+# コードタイプごとの解決先: (コードのルートからの半音数, Majorキーでのタイプ, Minorキーでのタイプ)
+THEORY_TYPE_RULES = {
+    '7': (5, 'Maj', 'Min'), 'aug': (5, 'Maj', 'Min'), 'sus4': (5, 'Maj', 'Min'),
+    'dim': (1, 'Min', 'Maj'), 'dim7': (1, 'Min', 'Maj'),
+}
+CHORD_NAMES = [{t: f"{root}_{t}" for t in CHORD_DEFS} for root in ROOTS]
+
+def build_suggestion_table():
+    # (scale, degree, type) -> 12キー分の (main, spice, advice)。type=None はタイプ規則なし
+    table = {}
+    for scale, rules in THEORY_RULES.items():
+        for degree in range(12):
+            main_rel, spice_rel, advice = rules.get(degree, rules.get(None, ([], [], "")))
+            for type_key in list(CHORD_DEFS) + [None]:
+                per_key = []
+                for key in range(12):
+                    main = {CHORD_NAMES[(key + d) % 12][t] for d, t in main_rel}
+                    spice = {CHORD_NAMES[(key + d) % 12][t] for d, t in spice_rel}
+                    if type_key in THEORY_TYPE_RULES:
+                        step, major_type, minor_type = THEORY_TYPE_RULES[type_key]
+                        target = (key + degree + step) % 12
+                        main.add(CHORD_NAMES[target][major_type if scale == "Major" else minor_type])
+                    per_key.append((frozenset(main), frozenset(spice), "理論ロジック: " + advice))
+                table[(scale, degree, type_key)] = tuple(per_key)
+        start = THEORY_START[scale]
+        table[(scale, None, None)] = tuple(
+            (frozenset(CHORD_NAMES[(key + d) % 12][t] for d, t in start), frozenset(), "理論ロジック: キーの主要コードから開始。")
+            for key in range(12))
+    return table
+
+SUGGESTION_TABLE = build_suggestion_table()
+SUGGESTION_UNKNOWN = (frozenset(), frozenset(), "特殊なコードです。")
+
+def suggest_chords(last_chord, key_root, scale_mode):
+    scale = "Major" if scale_mode == "Major" else "Minor"
+    key = NOTE_MAP.get(key_root, 0)
+    if not last_chord or last_chord == "Rest_Rest":
+        return SUGGESTION_TABLE[(scale, None, None)][key]
+    chord = get_chord(last_chord)
+    if chord.root_id < 0: return SUGGESTION_UNKNOWN
+    degree = (chord.root_id - key) % 12
+    type_key = chord.type if chord.type_id >= 0 else None
+    return SUGGESTION_TABLE[(scale, degree, type_key)][key]
+
+# --- Phrase Generator ---
+# 理論エンジンの遷移をビームサーチで N 個先まで展開し、完成した進行を点数順に返す (オフライン)
+PHRASE_CONTEXT = 4             # 繰り返しの判定に使う直前のコード数
+PHRASE_FLOW = {"main": 1.0, "spice": 0.3, "restart": -0.5}   # 機能的な流れ。restart は行き先が無くキーの主要コードへ戻る
+PHRASE_SPICE_BONUS = 0.6       # spice=1 の時にスパイス遷移へ足す点
+PHRASE_VOICE_WEIGHT = 0.05     # ボイスリーディングの移動 1 半音あたりの減点
+PHRASE_REPEAT_PENALTY = 0.6    # 句の中 (と直前) に同じコードが再登場
+PHRASE_CADENCE_BONUS = 1.5     # 主和音で終わる
+TONIC_TYPES = {"Major": ('Maj', 'Maj7'), "Minor": ('Min', 'm7')}
+
+def voicing_distance(a, b):
+    # optimize_voicings の遷移コストと同じ: 各音から相手の一番近い音までの距離を両方向に足す
+    return sum(min(abs(x - y) for y in b) for x in a) + sum(min(abs(x - y) for x in a) for y in b)
+
+@functools.lru_cache(None)
+def chord_transition_cost(a_id, b_id):
+    # 候補のボイシング同士で一番滑らかにつないだ時の移動量
+    a, b = voicing_candidates(a_id), voicing_candidates(b_id)
+    if not a or not b: return 0
+    return min(voicing_distance(x, y) for x in a for y in b)
+
+@functools.lru_cache(4096)
+def phrase_transitions(last_chord, key_root, scale_mode, spice):
+    # 直前のコード -> ((次のコード, 1歩の点数), ...)。ビーム幅や長さを変えても使い回す
+    main, spice_set, _ = suggest_chords(last_chord, key_root, scale_mode)
+    moves = [(c, "main") for c in main] + [(c, "spice") for c in spice_set - main]
+    if not moves: moves = [(c, "restart") for c in suggest_chords(None, key_root, scale_mode)[0]]
+    last_id = get_chord(last_chord).id if last_chord else None
+    result = []
+    for name, kind in moves:
+        score = PHRASE_FLOW[kind] + (spice * PHRASE_SPICE_BONUS if kind == "spice" else 0.0)
+        if last_id is not None: score -= PHRASE_VOICE_WEIGHT * chord_transition_cost(last_id, get_chord(name).id)
+        result.append((name, score))
+    return tuple(sorted(result, key=lambda m: (-m[1], m[0])))
+
+PHRASE_TREES = OrderedDict()   # (context, key_root, scale_mode, spice) -> {進行: ((点数, 1つ伸ばした進行), ...)}
+PHRASE_TREE_MAX = 32
+
+def phrase_tree(context, key_root, scale_mode, spice):
+    # 展開済みの探索木。点数は進行だけで決まるので、ビーム幅や長さを変えても同じ節点の展開を使い回せる
+    key = (context, key_root, scale_mode, spice)
+    tree = PHRASE_TREES.get(key)
+    if tree is None: tree = PHRASE_TREES[key] = {}
+    PHRASE_TREES.move_to_end(key)
+    while len(PHRASE_TREES) > PHRASE_TREE_MAX: PHRASE_TREES.popitem(last=False)
+    return tree
+
+def generate_phrases(context, key_root, scale_mode, length=4, beam=8, top_k=5, spice=0.5):
+    # context (直前までのコード名) の続きを length 個作り、上位 top_k の (点数, 進行) を返す
+    context = tuple(c for c in context if c != "Rest_Rest")[-PHRASE_CONTEXT:]
+    beam = max(beam, top_k)
+    tree = phrase_tree(context, key_root, scale_mode, spice)
+    level = [(0.0, ())]
+    for _ in range(length):
+        expanded = []
+        for score, path in level:
+            children = tree.get(path)
+            if children is None:
+                last = path[-1] if path else (context[-1] if context else None)
+                recent = context + path
+                children = tree[path] = tuple((score + step - (PHRASE_REPEAT_PENALTY if name in recent else 0.0), path + (name,))
+                                              for name, step in phrase_transitions(last, key_root, scale_mode, spice) if name != last)
+            expanded.extend(children)
+        level = heapq.nlargest(beam, expanded, key=lambda e: e[0])
+    key = NOTE_MAP.get(key_root, 0)
+    tonic = {f"{ROOTS[key]}_{t}" for t in TONIC_TYPES["Major" if scale_mode == "Major" else "Minor"]}
+    finished = [(score + (PHRASE_CADENCE_BONUS if path[-1] in tonic else 0.0), path) for score, path in level if path]
+    return heapq.nlargest(top_k, finished, key=lambda e: e[0])
+
+# --- AI Suggestions ---
+def parse_suggestion_text(text):
+    main_raw, spice_raw, reason = None, None, ""
+    for line in text.strip().split('\n'):
+        if "Main:" in line: main_raw = line.split(':')[1].strip()
+        if "Spice:" in line: spice_raw = line.split(':')[1].strip()
+        if "Reason:" in line: reason = line.split(':')[1].strip()
+    return {"main": main_raw, "spice": spice_raw, "reason": reason}
+
+def build_suggestion_prompt(key_info, context):
+    current_chords = [name.replace('_', '') for name in context]
+    if not current_chords: current_chords = ["(None)"]
+    return f"""
+        Music Composition Task. Key: {key_info}.
+        Chords: {', '.join(current_chords)}
+        Task: Suggest 2 next chords.
+        1. Main (Standard) 2. Spice (dim7/aug/sus4/modal)
+        Format:
+        Main: G_7
+        Spice: C#_dim7
+        Reason: (Reason in Japanese)
+        """
+
+def build_reharm_prompt(key_info, names):
+    chords = ', '.join(f"{i + 1}:{name}" for i, name in enumerate(names))
+    return f"""
+        Music Reharmonization Task. Key: {key_info}.
+        Progression: {chords}
+        Task: For EVERY position, suggest 2 alternative chords that could replace it.
+        1. main (Standard substitute) 2. spice (dim7/aug/sus4/modal)
+        Chord format: Root_Type (e.g. G_7, C#_dim7, F_Maj7)
+        Answer ONLY with a JSON array, one object per position:
+        [{{"pos": 1, "main": "A_m7", "spice": "F#_m7-5", "reason": "(Reason in Japanese)"}}]
+        """
+
+def parse_reharm_response(text, count):
+    # 位置ごとの {"main", "spice", "reason"}。欠けた位置は None
+    start, end = text.find('['), text.rfind(']')
+    if start < 0 or end < start: raise ValueError("JSON array not found")
+    results = [None] * count
+    for entry in json.loads(text[start:end + 1]):
+        if not isinstance(entry, dict): continue
+        try: pos = int(entry.get("pos", 0)) - 1
+        except (TypeError, ValueError): continue
+        if 0 <= pos < count:
+            # 文字列以外 (リストや数値) のコード名は欠けたものとして扱う
+            main, spice = entry.get("main"), entry.get("spice")
+            results[pos] = {"main": main if isinstance(main, str) else None, "spice": spice if isinstance(spice, str) else None,
+                            "reason": str(entry.get("reason", ""))}
+    return results
+
+def is_model_not_found(error):
+    msg = str(error).lower()
+    return type(error).__name__ == "NotFound" or "404" in msg or "not found" in msg
+
+def is_rate_limited(error):
+    msg = str(error).lower()
+    return type(error).__name__ in ("ResourceExhausted", "TooManyRequests") or "429" in msg or "rate limit" in msg or "quota" in msg
+
+class StubRateLimitError(Exception):
+    pass
+
+class LocalStubBackend:
+    # ネットワークなしで動作確認するための疑似バックエンド。理論エンジンの結果を Gemini と同じ形式で返す
+    def __init__(self, latency=0.5, error_rate=0.0, rate_limit_rate=0.0, seed=None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.rng = random.Random(seed)
+        self.calls = 0
+
+    def generate(self, prompt, timeout):
+        self.calls += 1
+        if self.latency > timeout:
+            time.sleep(timeout)
+            raise TimeoutError("Stub request timed out")
+        time.sleep(self.latency)
+        roll = self.rng.random()
+        if roll < self.rate_limit_rate: raise StubRateLimitError("429 Resource has been exhausted (stub)")
+        if roll < self.rate_limit_rate + self.error_rate: raise Exception("Stub backend error")
+        key_match = re.search(r"Key: (\S+) (\S+)\.", prompt)
+        key_root, key_scale = key_match.groups() if key_match else ("C", "Major")
+        progression_match = re.search(r"Progression: (.*)", prompt)
+        if progression_match:
+            names = [c.split(':', 1)[1].strip() for c in progression_match.group(1).split(',')]
+            entries = []
+            for i in range(len(names)):
+                # 直前のコードから見た候補を、その位置の代替案とする
+                main, spice, advice = suggest_chords(names[i - 1] if i else None, key_root, key_scale)
+                main = sorted(main - {names[i]})
+                spice = sorted(spice - {names[i]}) or main[1:]
+                entries.append({"pos": i + 1, "main": main[0] if main else "", "spice": spice[0] if spice else "", "reason": "(ローカルスタブ) " + advice.split(': ', 1)[-1]})
+            return json.dumps(entries, ensure_ascii=False)
+        chords_match = re.search(r"Chords: (.*)", prompt)
+        last = chords_match.group(1).split(',')[-1].strip() if chords_match else ""
+        if len(last) > 1 and last[1] == '#': last = f"{last[:2]}_{last[2:]}"
+        elif last and last[0] in NOTE_MAP: last = f"{last[:1]}_{last[1:]}"
+        else: last = None
+        main, spice, advice = suggest_chords(last, key_root, key_scale)
+        main = sorted(main)
+        spice = sorted(spice) or main[1:]
+        return f"Main: {main[0] if main else ''}\nSpice: {spice[0] if spice else ''}\nReason: (ローカルスタブ) {advice.split(': ', 1)[-1]}"
+
+class GeminiBackend:
+    def __init__(self, app):
+        self.app = app
+
+    def generate(self, prompt, timeout):
+        return self.app.request_suggestion(prompt, timeout)
+
+class AIRequest:
+    def __init__(self, prompt, callback, deadline):
+        self.prompt = prompt
+        self.callback = callback
+        self.deadline = deadline
+        self.cancelled = False
+        self.done = False
+        self.finished = threading.Event()   # 結果・タイムアウト・キャンセルでセット。バックオフ中の待ちを打ち切る
+        self.lock = threading.Lock()
+        self.timer = None
+
+    def cancel(self):
+        self.cancelled = True
+        self.finish(None, None)
+
+    def finish(self, text, error):
+        # 結果・タイムアウト・キャンセルのうち最初の1つだけが有効
+        with self.lock:
+            if self.done: return False
+            self.done = True
+        self.finished.set()
+        if self.timer is not None: self.timer.cancel()
+        if not self.cancelled: self.callback(text, error)
+        return True
+
+class AIRequestExecutor:
+    # 固定数のワーカーでAIリクエストを処理する。callback(text, error) はワーカー/タイマースレッドから呼ばれる
+    def __init__(self, backend, workers=2, timeout=30.0, max_retries=AI_MAX_RETRIES, backoff=AI_RETRY_BACKOFF):
+        self.backend = backend
+        self.workers = max(1, workers)
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.queue = queue.Queue()
+        self.threads = []
+
+    def submit(self, prompt, callback, timeout=None):
+        timeout = timeout or self.timeout
+        request = AIRequest(prompt, callback, time.monotonic() + timeout)
+        request.timer = threading.Timer(timeout, request.finish, args=(None, TimeoutError("AI request timed out")))
+        request.timer.daemon = True
+        request.timer.start()
+        if not self.threads:
+            for _ in range(self.workers):
+                t = threading.Thread(target=self.run_worker, daemon=True)
+                t.start()
+                self.threads.append(t)
+        self.queue.put(request)
+        return request
+
+    def run_worker(self):
+        while True:
+            request = self.queue.get()
+            if not request.done: self.execute(request)
+
+    def execute(self, request):
+        attempt = 0
+        while not request.done:
+            remaining = request.deadline - time.monotonic()
+            if remaining <= 0:
+                request.finish(None, TimeoutError("AI request timed out"))
+                return
+            try:
+                text = self.backend.generate(request.prompt, remaining)
+                request.finish(text, None)
+                return
+            except Exception as e:
+                delay = self.backoff * (2 ** attempt)
+                if not is_rate_limited(e) or attempt >= self.max_retries or time.monotonic() + delay >= request.deadline:
+                    request.finish(None, e)
+                    return
+                attempt += 1
+                request.finished.wait(delay)
+
+class SuggestionCache:
+    # キー+直近コードで引くAI提案のLRUキャッシュ (ai_cache.json に永続化)
+    def __init__(self, path=AI_CACHE_FILE, max_entries=AI_CACHE_MAX_ENTRIES, ttl=AI_CACHE_TTL):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()   # key -> [保存時刻, result]
+        self.hits = 0
+        self.misses = 0
+        self.dirty = False
+        self.load()
+
+    @staticmethod
+    def make_key(key_root, key_scale, chords):
+        return f"{key_root} {key_scale}|{','.join(chords[-AI_CONTEXT_CHORDS:])}"
+
+    def contains(self, key):
+        entry = self.entries.get(key)
+        return entry is not None and time.time() - entry[0] <= self.ttl
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is not None and time.time() - entry[0] > self.ttl:
+            del self.entries[key]
+            self.dirty = True
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.dirty = True
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key, result):
+        self.entries[key] = [time.time(), result]
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries: self.entries.popitem(last=False)
+        self.dirty = True
+        self.save()
+
+    def clear(self):
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+        self.dirty = True
+        self.save()
+
+    def load(self):
+        if not os.path.exists(self.path): return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f: data = json.load(f)
+            now = time.time()
+            for key, entry in data.get("entries", []):
+                if now - entry[0] <= self.ttl: self.entries[key] = entry
+        except Exception as e:
+            print(f"Warning: Could not load AI cache: {e}")
+
+    def save(self):
+        if not self.dirty: return
+        try:
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"entries": list(self.entries.items())}, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+            self.dirty = False
+        except Exception as e:
+            print(f"Warning: Could not save AI cache: {e}")
+
+# --- Timeline ---
+class PositionIndex:
+    # ブロックの開始位置 (x座標・小節) の累積和。検索は二分探索、更新は最初に変化したブロック以降だけ
+    def __init__(self, start_x=0, gap=0):
+        self.start_x = start_x
+        self.gap = gap
+        self.starts = []
+        self.ends = []
+        self.times = []
+        self.durations = []
+
+    def __len__(self):
+        return len(self.starts)
+
+    def end_x(self):
+        return self.ends[-1] + self.gap if self.ends else self.start_x
+
+    def total_time(self):
+        return self.times[-1] + self.durations[-1] if self.times else 0.0
+
+    def truncate(self, k):
+        del self.starts[k:], self.ends[k:], self.times[k:], self.durations[k:]
+
+    def append(self, width, duration):
+        x = self.end_x()
+        self.times.append(self.total_time())
+        self.starts.append(x)
+        self.ends.append(x + width)
+        self.durations.append(duration)
+
+    def index_at_x(self, x):
+        i = bisect.bisect_right(self.starts, x) - 1
+        if i >= 0 and x <= self.ends[i]: return i
+        return -1
+
+    def index_at_time(self, t):
+        if t < 0 or t >= self.total_time(): return -1
+        return bisect.bisect_right(self.times, t) - 1
+
+    def drop_index(self, x):
+        # ブロック中心より右ならその後ろへ挿入
+        i = bisect.bisect_right(self.starts, x) - 1
+        if i < 0: return 0
+        if x > (self.starts[i] + self.ends[i]) / 2: return i + 1
+        return i
+
+class TimelineView:
+    # 各ブロックのキャンバスアイテムを保持し、変化した属性だけを更新する
+    START_X = 20
+    Y = 40
+    HEIGHT = 100
+    BASE_PX = 80
+    GAP = 2
+
+    def __init__(self, canvas):
+        self.canvas = canvas
+        self.blocks = []   # [uid, rect_id, text_id, x, style]
+        self.progression = None
+        self.selection = set()
+        self.active_index = -1
+        self.scroll_end = None
+        self.index = PositionIndex(self.START_X, self.GAP)
+
+    def block_style(self, chord, dur, selected, active):
+        if chord.name == "Rest_Rest":
+            base_color = TYPE_COLORS['Rest']
+            disp_name = "休"
+            text_col = "#888888"
+        else:
+            ctype = chord.type
+            base_color = TYPE_COLORS.get(ctype, "#555555")
+            disp_name = chord.label
+            if dur < 0.25: disp_name = chord.root
+            text_col = "white" if ctype not in ['add9', 'sus4'] else "black"
+
+        width = max(20, self.BASE_PX * dur)
+        outline = C_SELECTION if selected else base_color
+        line_width = 3 if selected else 0
+        if active: fill = "#ffffff"; text_col = "#000000"
+        else: fill = base_color
+        return (width, fill, outline, line_width, disp_name, text_col)
+
+    def place(self, rec, x, width):
+        y, height = self.Y, self.HEIGHT
+        self.canvas.coords(rec[1], x, y, x + width, y + height)
+        self.canvas.coords(rec[2], x + width/2, y + height/2)
+        rec[3] = x
+
+    def restyle(self, rec, style):
+        old = rec[4]
+        rect_opts = {}
+        if old[1] != style[1]: rect_opts['fill'] = style[1]
+        if old[2] != style[2]: rect_opts['outline'] = style[2]
+        if old[3] != style[3]: rect_opts['width'] = style[3]
+        if rect_opts: self.canvas.itemconfigure(rec[1], **rect_opts)
+        text_opts = {}
+        if old[4] != style[4]: text_opts['text'] = style[4]
+        if old[5] != style[5]: text_opts['fill'] = style[5]
+        if text_opts: self.canvas.itemconfigure(rec[2], **text_opts)
+        rec[4] = style
+
+    def update(self, progression, selection, active_index=-1):
+        self.selection = set(selection)
+        self.active_index = active_index
+        self.progression = progression
+        old_blocks = {rec[0]: rec for rec in self.blocks}
+        blocks = []
+        index = self.index
+        synced = 0
+        y, height = self.Y, self.HEIGHT
+        current_x = self.START_X
+        for i, (chord_id, dur, uid) in enumerate(zip(progression.chord_ids, progression.durations, progression.uids)):
+            style = self.block_style(CHORDS[chord_id], dur, i in self.selection, i == active_index)
+            width = style[0]
+            rec = old_blocks.pop(uid, None)
+            if rec is None:
+                rect = self.canvas.create_rectangle(current_x, y, current_x + width, y + height, fill=style[1], outline=style[2], width=style[3])
+                text = self.canvas.create_text(current_x + width/2, y + height/2, text=style[4], fill=style[5], font=(FONT_FAMILY, 9, "bold"), justify=tk.CENTER)
+                rec = [uid, rect, text, current_x, style]
+            else:
+                if rec[3] != current_x or rec[4][0] != width: self.place(rec, current_x, width)
+                if rec[4] != style: self.restyle(rec, style)
+            blocks.append(rec)
+            if synced == i and i < len(index) and index.starts[i] == current_x and index.ends[i] == current_x + width and index.durations[i] == dur:
+                synced += 1
+            else:
+                if synced == i: index.truncate(i)
+                index.append(width, dur)
+            current_x += width + self.GAP
+        for rec in old_blocks.values():
+            self.canvas.delete(rec[1], rec[2])
+        self.blocks = blocks
+        if synced == len(blocks): index.truncate(synced)
+
+        scroll_end = current_x if blocks else None
+        if scroll_end != self.scroll_end:
+            self.scroll_end = scroll_end
+            if blocks: self.canvas.configure(scrollregion=(self.START_X - 2, y - 2, current_x, y + height + 2))
+            else: self.canvas.configure(scrollregion=(0, 0, 0, 0))
+
+    def set_active(self, index):
+        prev = self.active_index
+        self.active_index = index
+        for i in (prev, index):
+            if 0 <= i < len(self.blocks):
+                rec = self.blocks[i]
+                style = self.block_style(self.progression.chord(i), self.progression.durations[i], i in self.selection, i == index)
+                if rec[4] != style: self.restyle(rec, style)
+
+    def drag_block(self, index, dx):
+        rec = self.blocks[index]
+        self.canvas.move(rec[1], dx, 0)
+        self.canvas.move(rec[2], dx, 0)
+        rec[3] = None  # 次回の update で元の位置へ戻す
+
+class ChordPalette:
+    # コード表を1枚のキャンバスに描く。クリック位置は行と列の計算で求め、強調はタグでまとめて色を変える
+    LABEL_W = 70
+    HEADER_H = 28
+    CELL_W = 48
+    CELL_H = 38
+    GAP = 4
+
+    def __init__(self, canvas, types, on_select):
+        self.canvas = canvas
+        self.types = types
+        self.on_select = on_select
+        self.cells = {f"{root}_{t}": (row, col) for row, t in enumerate(types) for col, root in enumerate(ROOTS)}
+        self.states = {}    # 強調中のコード -> "main" / "spice"
+        self.pressed = None
+        self.pressed_inside = False
+        self.draw()
+        canvas.bind("<Button-1>", self.on_press)
+        canvas.bind("<B1-Motion>", self.on_drag)
+        canvas.bind("<ButtonRelease-1>", self.on_release)
+
+    def __contains__(self, chord_name):
+        return chord_name in self.cells
+
+    def draw(self):
+        c = self.canvas
+        for col, root in enumerate(ROOTS):
+            x = self.LABEL_W + col * (self.CELL_W + self.GAP) + self.CELL_W / 2
+            c.create_text(x, self.HEADER_H / 2, text=root, fill="#aaaaaa", font=(FONT_FAMILY, 11, "bold"))
+        for row, type_key in enumerate(self.types):
+            color = TYPE_COLORS.get(type_key, "#ffffff")
+            y = self.HEADER_H + row * (self.CELL_H + self.GAP)
+            c.create_text(self.LABEL_W - 10, y + self.CELL_H / 2, text=type_key, fill=color, anchor=tk.E, font=(FONT_FAMILY, 11, "bold"))
+            for col, root in enumerate(ROOTS):
+                x = self.LABEL_W + col * (self.CELL_W + self.GAP)
+                tag = self.cell_tag(f"{root}_{type_key}")
+                c.create_rectangle(x, y, x + self.CELL_W, y + self.CELL_H, fill=C_BTN_DEFAULT_BG, width=0, tags=("cell", tag))
+                c.create_text(x + self.CELL_W / 2, y + self.CELL_H / 2, text="▪", fill=color, font=(FONT_FAMILY, 10), tags=("mark", f"type{row}", tag))
+        c.configure(scrollregion=c.bbox("all"))
+
+    def cell_tag(self, chord_name):
+        row, col = self.cells[chord_name]
+        return f"c{row}_{col}"
+
+    def cell_at(self, x, y):
+        # セルの間の隙間は None (ボタンの外と同じ)
+        col, dx = divmod(x - self.LABEL_W, self.CELL_W + self.GAP)
+        row, dy = divmod(y - self.HEADER_H, self.CELL_H + self.GAP)
+        if not (0 <= col < len(ROOTS) and 0 <= row < len(self.types)) or dx >= self.CELL_W or dy >= self.CELL_H: return None
+        return f"{ROOTS[int(col)]}_{self.types[int(row)]}"
+
+    def event_cell(self, event):
+        return self.cell_at(self.canvas.canvasx(event.x), self.canvas.canvasy(event.y))
+
+    def set_states(self, states):
+        # 変わったセルのタグだけ付け替え、色は main / spice / 解除したセル の単位でまとめて設定する
+        c = self.canvas
+        old = self.states
+        cleared = [name for name in old if states.get(name) != old[name]]
+        for name in cleared: c.dtag(self.cell_tag(name), old[name])
+        for name, state in states.items():
+            if old.get(name) != state: c.addtag_withtag(state, self.cell_tag(name))
+        if cleared:
+            for name in cleared: c.addtag_withtag("reset", self.cell_tag(name))
+            c.itemconfigure("reset&&cell", fill=C_BTN_DEFAULT_BG)
+            for row in {self.cells[name][0] for name in cleared}:
+                c.itemconfigure(f"reset&&type{row}", fill=TYPE_COLORS.get(self.types[row], "#ffffff"), font=(FONT_FAMILY, 10))
+            c.dtag("reset", "reset")
+        c.itemconfigure("main&&cell", fill=C_SUGGEST_BG)
+        c.itemconfigure("main&&mark", fill=C_SUGGEST_FG, font=(FONT_FAMILY, 10, "bold"))
+        c.itemconfigure("spice&&cell", fill=C_SPICE_BG)
+        c.itemconfigure("spice&&mark", fill=C_SPICE_FG, font=(FONT_FAMILY, 10, "bold"))
+        self.states = states
+
+    def show_pressed(self, chord_name, pressed):
+        # tk.Button の activebackground と同じく、押している間はタイプの色で塗る
+        color = TYPE_COLORS.get(self.types[self.cells[chord_name][0]], "#ffffff")
+        state = self.states.get(chord_name)
+        if pressed: bg, fg, weight = color, "white", "bold" if state else "normal"
+        elif state == "main": bg, fg, weight = C_SUGGEST_BG, C_SUGGEST_FG, "bold"
+        elif state == "spice": bg, fg, weight = C_SPICE_BG, C_SPICE_FG, "bold"
+        else: bg, fg, weight = C_BTN_DEFAULT_BG, color, "normal"
+        tag = self.cell_tag(chord_name)
+        self.canvas.itemconfigure(f"{tag}&&cell", fill=bg)
+        self.canvas.itemconfigure(f"{tag}&&mark", fill=fg, font=(FONT_FAMILY, 10, weight))
+
+    def on_press(self, event):
+        self.pressed = self.event_cell(event)
+        self.pressed_inside = True
+        if self.pressed: self.show_pressed(self.pressed, True)
+
+    def on_drag(self, event):
+        if self.pressed is None: return
+        inside = self.event_cell(event) == self.pressed
+        if inside != self.pressed_inside:
+            self.pressed_inside = inside
+            self.show_pressed(self.pressed, inside)
+
+    def on_release(self, event):
+        # ボタンと同じく、押したセルの上で離した時だけ選ぶ
+        name, self.pressed = self.pressed, None
+        if name is None: return
+        self.show_pressed(name, False)
+        if self.event_cell(event) == name: self.on_select(name)
+
+# --- Playback ---
+class PlaybackSnapshot:
+    # 再生開始時点のプログレッションを固めたもの。再生中に編集されても影響を受けない
+    # 各コードの開始位置を秒で持つ (tick は MIDI と同じ丸めで数えてから換算)。シークは index_at で時刻 -> コードを引くだけ
+    # start / end を指定するとその区間だけを固める (ループ再生用)。base はタイムライン上の先頭位置
+    # kind は "mid" (MIDI デバイスで再生) か "wav" (内蔵シンセ)
+    def __init__(self, progression, bpm, program, start=0, end=None, kind="mid", ticks_per_beat=MIDI_TICKS_PER_BEAT):
+        ticks_per_bar = ticks_per_beat * 4
+        sec_per_tick = int(round(60 * 1e6 / bpm)) / 1e6 / ticks_per_beat   # MIDI に書くテンポ (整数 µs) と合わせる
+        self.bpm = bpm
+        self.program = program
+        self.base = start
+        self.kind = kind
+        self.events = tuple((tuple(notes), dur) for notes, dur in progression.events(start, end))
+        ticks = [0]
+        for _, dur in self.events: ticks.append(ticks[-1] + int(ticks_per_bar * dur))
+        self.starts = [tick * sec_per_tick for tick in ticks]
+        self.total = self.starts.pop()
+
+    def __len__(self):
+        return len(self.events)
+
+    def index_at(self, seconds):
+        if not self.events or seconds >= self.total: return -1
+        return max(0, bisect.bisect_right(self.starts, seconds) - 1)
+
+    def render(self, start_index=0, loop=False):
+        if self.kind == "wav": return render_audio_bytes(self.events[start_index:], self.program, self.bpm, loop)
+        return render_midi_bytes(self.events[start_index:], self.program, self.bpm)
+
+    def cache_key(self):
+        return (self.events, self.bpm, self.program, self.kind)
+
+class PlaybackClock:
+    # 単調増加の時計で再生位置 (秒) を求める。sleep の積み重ねと違って遅れが蓄積しない
+    def __init__(self, now=time.perf_counter):
+        self.now = now
+        self.origin = None
+        self.offset = 0.0
+
+    @property
+    def running(self):
+        return self.origin is not None
+
+    def start(self, offset=0.0):
+        self.offset = offset
+        self.origin = self.now()
+
+    def pause(self):
+        if self.origin is None: return
+        self.offset = self.position()
+        self.origin = None
+
+    def resume(self):
+        if self.origin is None: self.origin = self.now()
+
+    def position(self):
+        if self.origin is None: return self.offset
+        return self.offset + self.now() - self.origin
+
+def remove_temp_files(temp_dir, before=None):
+    # プレビュー用の一時ファイルを消す。before (time.time()) を渡すとそれより古いものだけ
+    if not os.path.isdir(temp_dir): return
+    for f in os.listdir(temp_dir):
+        if not f.endswith((".mid", ".wav")): continue
+        path = os.path.join(temp_dir, f)
+        try:
+            if before is None or os.path.getmtime(path) < before: os.remove(path)
+        except: pass
+
+class ChordThinkerApp(tk.Tk if tk is not None else object):
     def __init__(self):
+        start = time.perf_counter()
         super().__init__()
+        start = profile_step("Tk()", start)
         
         self.project_name = "Untitled"
         self.current_file_path = None
@@ -104,20 +1722,27 @@ class ChordThinkerApp(tk.Tk):
         self.update_title()
         self.geometry("1300x950")
         self.configure(bg=C_BG_MAIN)
-        
-        pygame.init()
-        pygame.mixer.init()
-        self.cleanup_temp_files(force=True)
 
         self.config = self.load_config()
+        start = profile_step("load_config", start)
 
-        self.progression = []
+        self.progression = Progression()
         self.selection = set()
         self.clipboard = []
-        self.chord_buttons = {}   
+        self.palette = None   # ChordPalette
         self.is_playing = False
-        self.block_coords = []
         self.current_temp_file = None
+        self.playback = None          # PlaybackSnapshot
+        self.playback_clock = PlaybackClock()
+        self.playback_job = None
+        self.playback_index = -1
+        self.loop_uids = None         # ループ区間の先頭と末尾のブロック (uid)
+        self.loop_cache = None        # (cache_key, MIDI bytes)
+        self.loop_generation = 0
+        self.loop_swap_job = None
+        self.loop_pending = None      # 一時停止中に書き出しが終わったループ
+        self.preview_buffer = None
+        self.preview_from_buffer = True
         
         self.drag_item_index = None
         self.drag_start_x = 0
@@ -130,23 +1755,58 @@ class ChordThinkerApp(tk.Tk):
         self.pr_key_height = 14
         self.pr_min_note = 24   # C1
         self.pr_max_note = 96   # C7
+        self.pr_static_layout = None
+        self.pr_note_items = []   # [item_id, note_index, y]
+        self.pr_drag_y = 0
+        self.pr_drag_job = None
+        self.pr_drag_old_voicing = None
         
         self.api_key = self.config.get("api_key", "").strip()
         self.is_thinking = False
         self.cached_model_name = None
-
-        if self.api_key:
-            try: genai.configure(api_key=self.api_key)
-            except: pass
+        self.model_lock = threading.Lock()
+        model_age = time.time() - float(self.config.get("ai_model_resolved_at") or 0)
+        if self.config.get("ai_model") and model_age < AI_MODEL_TTL:
+            self.cached_model_name = self.config["ai_model"]
+        self.ai_cache = SuggestionCache()
+        self.use_stub_model = self.config.get("ai_backend") == "stub" or bool(os.environ.get("CHORDTHINKER_AI_STUB"))
+        self.prefetch_job = None
+        self.prefetch_generation = 0
+        self.prefetch_inflight = None   # (generation, cache_key, AIRequest)
+        try: ai_workers, ai_timeout = int(self.config.get("ai_workers", 2)), float(self.config.get("ai_timeout", 30))
+        except: ai_workers, ai_timeout = 2, 30.0
+        backend = LocalStubBackend() if self.use_stub_model else GeminiBackend(self)
+        self.ai_executor = AIRequestExecutor(backend, workers=ai_workers, timeout=ai_timeout)
+        self.ai_waiting_key = None
+        self.reharm_results = {}   # uid -> (uid, name, key_info, result)
+        self.journal = None
+        self.journal_meta = None
+        self.journal_flush_job = None
+        self.loading_project = False
+        self.compact_thread = None
+        try: undo_kb = int(self.config.get("undo_memory_kb", UNDO_MEMORY_KB))
+        except: undo_kb = UNDO_MEMORY_KB
+        self.history = UndoHistory(undo_kb * 1024)
+        start = profile_step("app state, AI executor, cache", start)
 
         self.setup_ui()
+        start = profile_step("setup_ui", start)
         self.bind_keys()
         self.update_suggestions_logic(None)
+        start = profile_step("bind_keys, first suggestions", start)
+        self.after_idle(self.recover_or_start_journal)
+        # 前回の一時ファイル掃除とモデル名の解決は起動後に回す
+        self.after_idle(self.cleanup_stale_temp_files)
+        self.after(AI_WARMUP_DELAY_MS, self.warm_up_model)
+        if PROFILE_STARTUP: self.after_idle(profile_step, "mainloop until first idle", start)
+        if PROFILE_STARTUP: self.after_idle(print_startup_profile)
         
         self.protocol("WM_DELETE_WINDOW", self.on_closing)
 
     def on_closing(self):
         self.cleanup_temp_files(force=True)
+        self.ai_cache.save()
+        self.close_journal()
         self.destroy()
 
     def update_title(self):
@@ -158,7 +1818,18 @@ class ChordThinkerApp(tk.Tk):
             "api_key": "",
             "default_bpm": "120",
             "default_instrument": "Grand Piano",
-            "default_duration": "全音符"
+            "default_duration": "全音符",
+            "ai_prefetch": False,
+            "ai_backend": "gemini",
+            "ai_model": "",
+            "ai_model_resolved_at": 0,
+            "ai_workers": 2,
+            "ai_timeout": 30,
+            "undo_memory_kb": UNDO_MEMORY_KB,
+            "phrase_length": 4,
+            "phrase_beam": 8,
+            "phrase_spice": 0.5,
+            "preview_engine": "midi"
         }
         if os.path.exists(CONFIG_FILE):
             try:
@@ -181,7 +1852,18 @@ class ChordThinkerApp(tk.Tk):
             "api_key": "",
             "default_bpm": "120",
             "default_instrument": "Grand Piano",
-            "default_duration": "全音符"
+            "default_duration": "全音符",
+            "ai_prefetch": False,
+            "ai_backend": "gemini",
+            "ai_model": "",
+            "ai_model_resolved_at": 0,
+            "ai_workers": 2,
+            "ai_timeout": 30,
+            "undo_memory_kb": UNDO_MEMORY_KB,
+            "phrase_length": 4,
+            "phrase_beam": 8,
+            "phrase_spice": 0.5,
+            "preview_engine": "midi"
         }
         if os.path.exists(CONFIG_FILE):
             try:
@@ -197,24 +1879,26 @@ class ChordThinkerApp(tk.Tk):
         except Exception as e:
             messagebox.showerror("Error", f"設定の保存に失敗: {e}")
 
-    def get_temp_dir(self):
+    def get_temp_dir(self, create=True):
         base = os.getcwd()
         temp_dir = os.path.join(base, "temp")
-        if not os.path.exists(temp_dir): os.makedirs(temp_dir)
+        if create and not os.path.exists(temp_dir): os.makedirs(temp_dir)
         return temp_dir
 
     def cleanup_temp_files(self, force=False):
-        temp_dir = self.get_temp_dir()
+        temp_dir = self.get_temp_dir(create=False)
         if force:
             try:
                 pygame.mixer.music.stop()
                 pygame.mixer.music.unload()
             except: pass
-            
-        for f in os.listdir(temp_dir):
-            if f.endswith(".mid"):
-                try: os.remove(os.path.join(temp_dir, f))
-                except: pass
+        self.preview_buffer = None
+        remove_temp_files(temp_dir)
+
+    def cleanup_stale_temp_files(self):
+        # 前回の起動で残ったファイルを裏で消す。今回作ったファイルは消さない
+        started = time.time()
+        threading.Thread(target=remove_temp_files, args=(self.get_temp_dir(create=False), started), daemon=True).start()
     
     def manual_cleanup(self):
         self.cleanup_temp_files(force=True)
@@ -223,10 +1907,10 @@ class ChordThinkerApp(tk.Tk):
     def open_settings(self):
         win = tk.Toplevel(self)
         win.title("環境設定")
-        win.geometry("450x350")
+        win.geometry("450x450")
         win.configure(bg=C_BG_PANEL)
         x = self.winfo_rootx() + self.winfo_width()//2 - 225
-        y = self.winfo_rooty() + self.winfo_height()//2 - 175
+        y = self.winfo_rooty() + self.winfo_height()//2 - 225
         win.geometry(f"+{x}+{y}")
         lbl_font = (FONT_FAMILY, 10)
         tk.Label(win, text="Google Gemini API Key:", bg=C_BG_PANEL, fg="white", font=lbl_font).pack(anchor="w", padx=20, pady=(20, 5))
@@ -242,14 +1926,38 @@ class ChordThinkerApp(tk.Tk):
         combo_inst = ttk.Combobox(win, values=list(INSTRUMENT_MAP.keys()), state="readonly", width=30)
         combo_inst.set(self.config.get("default_instrument", "Grand Piano"))
         combo_inst.pack(anchor="w", padx=20)
+        tk.Label(win, text="AI提案キャッシュ:", bg=C_BG_PANEL, fg="white", font=lbl_font).pack(anchor="w", padx=20, pady=(15, 5))
+        cache_row = tk.Frame(win, bg=C_BG_PANEL)
+        cache_row.pack(anchor="w", padx=20)
+        cache_info = tk.Label(cache_row, bg=C_BG_PANEL, fg="#888888", font=(FONT_FAMILY, 9))
+        def refresh_cache_info():
+            c = self.ai_cache
+            cache_info.config(text=f"{len(c.entries)}件  (hit {c.hits} / miss {c.misses})")
+        def clear_cache():
+            self.ai_cache.clear()
+            refresh_cache_info()
+        tk.Button(cache_row, text="キャッシュを削除", command=clear_cache, bg="#444444", fg="white", relief=tk.FLAT).pack(side=tk.LEFT)
+        cache_info.pack(side=tk.LEFT, padx=10)
+        refresh_cache_info()
+        prefetch_var = tk.BooleanVar(value=bool(self.config.get("ai_prefetch", False)))
+        tk.Checkbutton(win, text="編集後にAI提案を先読みする", variable=prefetch_var, bg=C_BG_PANEL, fg="white", selectcolor="#333333", activebackground=C_BG_PANEL, activeforeground="white", font=lbl_font).pack(anchor="w", padx=15, pady=(10, 0))
         def save_and_close():
             new_key = entry_key.get().strip()
             self.config["api_key"] = new_key
             self.config["default_bpm"] = entry_bpm.get()
             self.config["default_instrument"] = combo_inst.get()
+            self.config["ai_prefetch"] = prefetch_var.get()
+            if new_key != self.api_key:
+                self.config["ai_model"] = ""
+                self.config["ai_model_resolved_at"] = 0
+                self.cached_model_name = None
             self.save_config_file()
             self.api_key = new_key
-            self.cached_model_name = None 
+            if self.api_key:
+                if genai is not None:
+                    try: genai.configure(api_key=self.api_key)
+                    except: pass
+                self.warm_up_model()
             msg = "設定保存: APIキー有効" if self.api_key else "設定保存: APIキーなし"
             self.advice_label.config(text=msg)
             messagebox.showinfo("保存", "設定を保存しました。")
@@ -263,8 +1971,10 @@ class ChordThinkerApp(tk.Tk):
         tk.Label(header, text="CHORD THINKER", bg=C_BG_MAIN, fg="#aaaaaa", font=(FONT_FAMILY, 14, "bold")).pack(side=tk.LEFT)
         right_frame = tk.Frame(header, bg=C_BG_MAIN)
         right_frame.pack(side=tk.RIGHT)
-        tk.Button(right_frame, text="🗑️", command=self.manual_cleanup, width=3, bg="#444444", fg="white", relief=tk.FLAT).pack(side=tk.RIGHT, padx=2)
-        tk.Button(right_frame, text="？", command=self.show_help, width=3, bg="#444444", fg="white", relief=tk.FLAT).pack(side=tk.RIGHT, padx=2)
+        # 🗑️ はバッファ再生に非対応な環境 (一時ファイル方式) でのみ表示
+        self.cleanup_btn = tk.Button(right_frame, text="🗑️", command=self.manual_cleanup, width=3, bg="#444444", fg="white", relief=tk.FLAT)
+        self.help_btn = tk.Button(right_frame, text="？", command=self.show_help, width=3, bg="#444444", fg="white", relief=tk.FLAT)
+        self.help_btn.pack(side=tk.RIGHT, padx=2)
         tk.Button(right_frame, text="⚙ 設定", command=self.open_settings, bg="#007acc", fg="white", relief=tk.FLAT).pack(side=tk.RIGHT, padx=2)
         tk.Label(right_frame, text=" | ", bg=C_BG_MAIN, fg="#555555").pack(side=tk.RIGHT, padx=2)
         self.save_btn = tk.Menubutton(right_frame, text="💾 保存 ▼", bg="#555555", fg="white", relief=tk.FLAT, direction='below')
@@ -293,11 +2003,14 @@ class ChordThinkerApp(tk.Tk):
         self.canvas.bind("<B1-Motion>", self.on_canvas_drag)
         self.canvas.bind("<ButtonRelease-1>", self.on_canvas_release)
         self.canvas.bind("<Double-Button-1>", self.on_canvas_double_click)
+        self.canvas.bind("<Control-Button-1>", self.on_canvas_ctrl_click)   # クリックした位置から再生
+        self.timeline = TimelineView(self.canvas)
         
         toggle_frame = tk.Frame(self, bg=C_BG_MAIN)
         toggle_frame.pack(fill=tk.X, padx=20)
         self.pr_toggle_btn = tk.Button(toggle_frame, text="🎹 ピアノロール (開く)", command=self.toggle_piano_roll, bg="#333333", fg="white", relief=tk.FLAT, font=(FONT_FAMILY, 9))
         self.pr_toggle_btn.pack(side=tk.LEFT)
+        tk.Button(toggle_frame, text="🎼 自動ボイシング", command=self.auto_voice_lead, bg="#333333", fg="white", relief=tk.FLAT, font=(FONT_FAMILY, 9)).pack(side=tk.LEFT, padx=5)
         self.pr_frame = tk.Frame(self.middle_container, bg=C_PR_BG, height=250)
         self.pr_scrollbar = tk.Scrollbar(self.pr_frame, orient="vertical")
         self.pr_canvas = tk.Canvas(self.pr_frame, bg=C_PR_BG, highlightthickness=0, height=250, yscrollcommand=self.pr_scrollbar.set)
@@ -330,17 +2043,26 @@ class ChordThinkerApp(tk.Tk):
         self.key_scale_combo.pack(side=tk.LEFT, padx=5)
         self.key_root_combo.bind("<<ComboboxSelected>>", lambda e: self.update_suggestions_logic(self.get_last_selected_chord_name()))
         self.key_scale_combo.bind("<<ComboboxSelected>>", lambda e: self.update_suggestions_logic(self.get_last_selected_chord_name()))
+        for var in (self.inst_var, self.bpm_var, self.key_root_var, self.key_scale_var): var.trace_add("write", self.on_meta_changed)
         self.make_btn(ctrl, "▶ 再生", self.play_preview, bg=TYPE_COLORS['sus4'], fg="black")
+        self.make_btn(ctrl, "⏸ 一時停止", self.pause_preview, bg="#555555")
+        self.make_btn(ctrl, "▶ 選択から", self.play_from_selection, bg="#555555")
+        self.make_btn(ctrl, "🔁 ループ", self.toggle_loop, bg="#555555")
         self.make_btn(ctrl, "■ 停止", self.stop_preview, bg=TYPE_COLORS['aug'])
         self.make_btn(ctrl, "１つ削除", self.delete_selection, bg="#555555", side=tk.RIGHT)
         self.make_btn(ctrl, "全消去", self.reset_progression, bg="#333333", side=tk.RIGHT)
         self.make_btn(ctrl, "MIDI出力", self.export_midi, bg=TYPE_COLORS['Maj'], fg="black", side=tk.RIGHT)
+        self.make_btn(ctrl, "WAV出力", self.export_wav, bg=TYPE_COLORS['Maj'], fg="black", side=tk.RIGHT)
 
         advice_frame = tk.Frame(self, bg="#222222", bd=1, relief=tk.SUNKEN, height=60)
         advice_frame.pack(fill=tk.X, padx=20, pady=5)
         advice_frame.pack_propagate(False)
         self.ai_btn = tk.Button(advice_frame, text="🤖 AIに聞く", command=self.ask_gemini, bg="#720e9e", fg="white", font=(FONT_FAMILY, 10, "bold"), relief=tk.RAISED)
         self.ai_btn.pack(side=tk.LEFT, padx=10, pady=10)
+        self.reharm_btn = tk.Button(advice_frame, text="🤖 全体リハモ", command=self.ask_gemini_reharm, bg="#4b0a68", fg="white", font=(FONT_FAMILY, 10, "bold"), relief=tk.RAISED)
+        self.reharm_btn.pack(side=tk.LEFT, pady=10)
+        self.phrase_btn = tk.Button(advice_frame, text="🎲 続きを生成", command=self.show_phrase_menu, bg="#444444", fg="white", font=(FONT_FAMILY, 10, "bold"), relief=tk.RAISED)
+        self.phrase_btn.pack(side=tk.LEFT, padx=(10, 0), pady=10)
         initial_msg = "APIキー設定済み" if self.api_key else "設定ボタンからAPIキーを設定してください"
         self.advice_label = tk.Label(advice_frame, text=f"理論モード: {initial_msg}", bg="#222222", fg="white", font=(FONT_FAMILY, 10), anchor="w", justify="left", wraplength=900)
         self.advice_label.pack(side=tk.LEFT, padx=10, fill=tk.BOTH, expand=True)
@@ -354,39 +2076,26 @@ class ChordThinkerApp(tk.Tk):
         tk.Label(legend_row, text=" ■ 王道 ", bg=C_SUGGEST_BG, fg="black", font=(FONT_FAMILY, 9)).pack(side=tk.LEFT, padx=2)
         tk.Label(legend_row, text=" ■ スパイス ", bg=C_SPICE_BG, fg="black", font=(FONT_FAMILY, 9)).pack(side=tk.LEFT, padx=2)
 
-        canvas_scroll = tk.Canvas(container_frame, bg=C_BG_MAIN, highlightthickness=0)
-        scrollbar = ttk.Scrollbar(container_frame, orient="vertical", command=canvas_scroll.yview)
-        scrollable_frame = tk.Frame(canvas_scroll, bg=C_BG_MAIN)
-        scrollable_frame.bind("<Configure>", lambda e: canvas_scroll.configure(scrollregion=canvas_scroll.bbox("all")))
-        canvas_scroll.create_window((0, 0), window=scrollable_frame, anchor="nw")
-        canvas_scroll.configure(yscrollcommand=scrollbar.set)
-        canvas_scroll.pack(side="left", fill="both", expand=True)
+        # コード表は1枚のキャンバス (ボタンを並べるとコードの種類が増えるほど起動と再描画が重くなる)
+        palette_canvas = tk.Canvas(container_frame, bg=C_BG_MAIN, highlightthickness=0)
+        scrollbar = ttk.Scrollbar(container_frame, orient="vertical", command=palette_canvas.yview)
+        palette_canvas.configure(yscrollcommand=scrollbar.set)
+        palette_canvas.pack(side="left", fill="both", expand=True)
         scrollbar.pack(side="right", fill="y")
-
-        for col, root in enumerate(ROOTS):
-            tk.Label(scrollable_frame, text=root, bg=C_BG_MAIN, fg="#aaaaaa", font=(FONT_FAMILY, 11, "bold"), width=6).grid(row=0, column=col+1, pady=(0,5))
-        display_types = [k for k in CHORD_DEFS.keys() if k != 'Rest']
-        for row, type_key in enumerate(display_types):
-            color = TYPE_COLORS.get(type_key, "#ffffff")
-            tk.Label(scrollable_frame, text=type_key, bg=C_BG_MAIN, fg=color, font=(FONT_FAMILY, 11, "bold"), anchor=tk.E, width=6).grid(row=row+1, column=0, padx=(0,10), pady=2)
-            for col, root in enumerate(ROOTS):
-                chord_name = f"{root}_{type_key}"
-                btn = tk.Button(scrollable_frame, text="▪", bg=C_BTN_DEFAULT_BG, fg=color, activebackground=color, activeforeground="white", bd=0, relief=tk.FLAT, width=5, height=2, font=(FONT_FAMILY, 10), command=lambda c=chord_name: self.add_chord(c))
-                btn.grid(row=row+1, column=col+1, padx=2, pady=2)
-                self.chord_buttons[chord_name] = btn
+        self.palette = ChordPalette(palette_canvas, [k for k in CHORD_DEFS.keys() if k != 'Rest'], self.add_chord)
 
     def make_label(self, parent, text):
         lbl = tk.Label(parent, text=text, bg=C_BG_PANEL, fg=C_TEXT_MAIN, font=(FONT_FAMILY, 10))
         lbl.pack(side=tk.LEFT, padx=(15,2))
         return lbl
 
-    def make_btn(self, parent, text, cmd, bg="#555555", fg="white", side=tk.LEFT):
+    def make_btn(self, parent, text, cmd, bg="#555555", fg="white", side="left"):
         btn = tk.Button(parent, text=text, command=cmd, bg=bg, fg=fg, relief=tk.FLAT, font=(FONT_FAMILY, 10, "bold"), padx=15, pady=2)
         btn.pack(side=side, padx=5)
         return btn
 
     def show_help(self):
-        messagebox.showinfo("ガイド", "・ブロック移動：ドラッグで並べ替え\n・ダブルクリック：長さ変更\n・AIボタン：Geminiに相談\n・プロジェクト保存：作業を保存\n・ゴミ箱：キャッシュ削除")
+        messagebox.showinfo("ガイド", "・ブロック移動：ドラッグで並べ替え\n・ダブルクリック：長さ変更\n・Ctrl+クリック：そのブロックから再生\n・Ctrl+Z / Ctrl+Y：取り消し / やり直し\n・自動ボイシング：選択範囲 (なければ全体) の声部の動きを最小に\n・続きを生成：理論ロジックで数個先までの進行を提案 (オフライン)\n・AIボタン：Geminiに相談\n・プロジェクト保存：作業を保存\n・ゴミ箱：キャッシュ削除")
 
     def bind_keys(self):
         self.bind("<Control-c>", self.copy_selection)
@@ -395,6 +2104,9 @@ class ChordThinkerApp(tk.Tk):
         self.bind("<BackSpace>", self.delete_selection)
         self.bind("<Control-a>", self.select_all)
         self.bind("<Control-s>", lambda e: self.save_project_overwrite())
+        self.bind("<Control-z>", self.undo)
+        self.bind("<Control-y>", self.redo)
+        self.bind("<Control-Z>", self.redo)
 
     def get_project_dir(self):
         base = os.getcwd()
@@ -403,22 +2115,155 @@ class ChordThinkerApp(tk.Tk):
         return proj_dir
 
     def get_project_data(self):
+        return {"progression": self.progression, **self.get_project_meta()}
+
+    def get_project_meta(self):
         return {
-            "progression": self.progression,
             "bpm": self.bpm_var.get(),
             "instrument": self.inst_var.get(),
             "key_root": self.key_root_var.get(),
             "key_scale": self.key_scale_var.get()
         }
 
+    def get_journal_path(self, file_path):
+        # 編集ログはプロジェクトフォルダにまとめて置く (起動時にここだけ見れば復元できる)
+        if not file_path: return os.path.join(self.get_project_dir(), UNTITLED_JOURNAL)
+        path_hash = hashlib.sha1(os.path.abspath(file_path).encode("utf-8")).hexdigest()[:8]
+        return os.path.join(self.get_project_dir(), f"{os.path.basename(file_path)}.{path_hash}.journal")
+
+    def start_journal(self, ops=None):
+        self.history.clear()
+        if self.journal is not None:
+            # Ctrl+S で確定した操作は捨てる前に元ファイルへ反映する。未確定の操作だけを捨てる
+            if self.journal_flush_job is not None: self.after_cancel(self.journal_flush_job); self.journal_flush_job = None
+            if self.compact_thread is not None: self.compact_thread.join()
+            try:
+                compact_journal(self.journal)
+                self.journal.close(remove=True)
+            except Exception as e:
+                print(f"Journal compaction failed: {e}")
+                self.journal.close()   # 次回起動時に復元できるよう残す
+        path = self.get_journal_path(self.current_file_path)
+        base_sha = None
+        if self.current_file_path and os.path.exists(self.current_file_path): base_sha = file_sha256(self.current_file_path)
+        self.journal_meta = self.get_project_meta()
+        if not ops and os.path.exists(path): os.remove(path)
+        self.journal = EditJournal(path, self.current_file_path, base_sha, self.journal_meta, ops)
+
+    def close_journal(self):
+        if self.journal is None: return
+        if self.journal_flush_job is not None: self.after_cancel(self.journal_flush_job); self.journal_flush_job = None
+        if self.compact_thread is not None: self.compact_thread.join()
+        try: compact_journal(self.journal)
+        except Exception as e: print(f"Journal compaction failed: {e}")
+        # 未保存の操作が残っていれば次回起動時に復元を提案する
+        self.journal.close(remove=not self.journal.ops)
+
+    def recover_or_start_journal(self):
+        project_dir = self.get_project_dir()
+        candidates = [os.path.join(project_dir, f) for f in os.listdir(project_dir) if f.endswith(".journal")]
+        if candidates:
+            path = max(candidates, key=os.path.getmtime)
+            if self.recover_journal(path): return
+        self.start_journal()
+
+    def recover_journal(self, path):
+        try: data, base_path, ops = replay_journal(path)
+        except Exception as e:
+            print(f"Warning: Could not read journal {path}: {e}")
+            return False
+        if not ops:
+            os.remove(path)
+            return False
+        name = os.path.basename(base_path) if base_path else "Untitled"
+        if not messagebox.askyesno("復元", f"保存されていない編集が残っています ({name}, {len(ops)}件)。\n復元しますか？"):
+            os.remove(path)
+            return False
+        self.set_project_data(data, base_path)
+        self.start_journal(ops)
+        self.is_modified = True
+        self.update_title()
+        return True
+
+    def set_project_data(self, data, file_path):
+        self.progression = Progression.from_dicts(data.get("progression", []))
+        self.reharm_results.clear()
+        self.loading_project = True   # 読み込みによる変更は編集ログに残さない
+        try:
+            self.bpm_var.set(data.get("bpm", "120"))
+            self.inst_var.set(data.get("instrument", "Grand Piano"))
+            self.key_root_var.set(data.get("key_root", "C"))
+            self.key_scale_var.set(data.get("key_scale", "Major"))
+        finally: self.loading_project = False
+        self.current_file_path = file_path
+        self.project_name = os.path.basename(file_path) if file_path else "Untitled"
+        self.draw_progression()
+        self.update_suggestions_logic(self.get_last_selected_chord_name())
+
+    def apply_edit(self, op):
+        apply_edit_op(self.progression, op)
+        self.record_edit(op)
+
+    def on_meta_changed(self, *args):
+        # BPM・楽器・キーの変更もその場で編集ログへ (元に戻す対象にはしない)
+        if self.journal is None or self.loading_project: return
+        meta = self.get_project_meta()
+        if meta == self.journal_meta: return
+        op = {"op": "meta", "old": self.journal_meta, "new": meta}
+        self.journal_meta = meta
+        self.record_edit(op, undoable=False)
+
+    def record_edit(self, op, undoable=True):
+        if undoable: self.history.push(op)
+        self.mark_modified()
+        if self.loop_uids is not None: self.refresh_loop()
+        if self.journal is None: return
+        if self.journal.append(op): self.flush_journal()
+        elif self.journal_flush_job is None: self.journal_flush_job = self.after(JOURNAL_FLUSH_MS, self.flush_journal)
+
+    def undo(self, event=None):
+        if isinstance(self.focus_get(), tk.Entry): return
+        self.replay_history(self.history.undo())
+
+    def redo(self, event=None):
+        if isinstance(self.focus_get(), tk.Entry): return
+        self.replay_history(self.history.redo())
+
+    def replay_history(self, ops):
+        if ops is None: return
+        for op in ops:
+            apply_edit_op(self.progression, op)
+            self.record_edit(op, undoable=False)
+        self.selection.clear()
+        self.draw_progression()
+        self.draw_piano_roll()
+        self.update_suggestions_logic(self.progression.chord(-1).name if self.progression else None)
+
+    def flush_journal(self):
+        if self.journal_flush_job is not None: self.after_cancel(self.journal_flush_job); self.journal_flush_job = None
+        try: self.journal.flush()
+        except Exception as e: print(f"Warning: Could not write journal: {e}")
+
+    def compact_in_background(self):
+        # 前回の反映がまだ走っていれば、その後に続けて今回の分を反映する (保存を取りこぼさない)
+        journal, previous = self.journal, self.compact_thread
+        def run_compaction():
+            if previous is not None: previous.join()
+            try: compact_journal(journal)
+            except Exception as e: print(f"Journal compaction failed: {e}")
+        self.compact_thread = threading.Thread(target=run_compaction, daemon=True)
+        self.compact_thread.start()
+
     def new_project(self):
         if self.progression:
             if not messagebox.askyesno("確認", "現在の作業内容は消えますが、新規作成しますか？"):
                 return
-        self.progression = []
+        self.progression = Progression()
+        self.reharm_results.clear()
         self.current_file_path = None
         self.project_name = "Untitled"
         self.is_modified = False
+        self.start_journal()
         self.draw_progression()
         self.update_title()
         self.update_suggestions_logic(None)
@@ -427,8 +2272,14 @@ class ChordThinkerApp(tk.Tk):
         if not self.progression: return
         if self.current_file_path:
             try:
-                with open(self.current_file_path, "w", encoding="utf-8") as f:
-                    json.dump(self.get_project_data(), f, indent=4)
+                if self.journal is not None and self.journal.base_path == self.current_file_path and os.path.exists(self.current_file_path):
+                    # 編集ログを確定させるだけ (O(前回保存以降の編集))。本体ファイルへの反映は裏で行う
+                    if self.journal_flush_job is not None: self.after_cancel(self.journal_flush_job); self.journal_flush_job = None
+                    self.journal.commit()
+                    self.compact_in_background()
+                else:
+                    write_project_file(self.current_file_path, self.get_project_data())
+                    self.start_journal()
                 self.is_modified = False
                 self.update_title()
             except Exception as e:
@@ -443,16 +2294,17 @@ class ChordThinkerApp(tk.Tk):
         file_path = filedialog.asksaveasfilename(
             initialdir=self.get_project_dir(),
             defaultextension=".ctp",
-            filetypes=[("Chord Thinker Project", "*.ctp"), ("All Files", "*.*")],
+            filetypes=PROJECT_FILETYPES,
             title="名前を付けて保存"
         )
         if file_path:
             try:
-                with open(file_path, "w", encoding="utf-8") as f:
-                    json.dump(self.get_project_data(), f, indent=4)
+                write_project_file(file_path, self.get_project_data())
                 self.current_file_path = file_path
                 self.project_name = os.path.basename(file_path)
                 self.is_modified = False
+                if self.compact_thread is not None: self.compact_thread.join()
+                self.start_journal()
                 self.update_title()
                 messagebox.showinfo("保存", "保存しました。")
             except Exception as e:
@@ -463,13 +2315,12 @@ class ChordThinkerApp(tk.Tk):
         file_path = filedialog.asksaveasfilename(
             initialdir=self.get_project_dir(),
             defaultextension=".ctp",
-            filetypes=[("Chord Thinker Project", "*.ctp"), ("All Files", "*.*")],
+            filetypes=PROJECT_FILETYPES,
             title="コピーを保存"
         )
         if file_path:
             try:
-                with open(file_path, "w", encoding="utf-8") as f:
-                    json.dump(self.get_project_data(), f, indent=4)
+                write_project_file(file_path, self.get_project_data())
                 messagebox.showinfo("保存", "コピーを保存しました。")
             except Exception as e:
                 messagebox.showerror("Error", f"保存失敗: {e}")
@@ -477,32 +2328,25 @@ class ChordThinkerApp(tk.Tk):
     def load_project(self):
         file_path = filedialog.askopenfilename(
             initialdir=self.get_project_dir(),
-            filetypes=[("Chord Thinker Project", "*.ctp"), ("All Files", "*.*")],
+            filetypes=PROJECT_FILETYPES,
             title="プロジェクトを開く"
         )
         if file_path:
             try:
-                with open(file_path, "r", encoding="utf-8") as f: data = json.load(f)
-                self.progression = data.get("progression", [])
-                self.bpm_var.set(data.get("bpm", "120"))
-                self.inst_var.set(data.get("instrument", "Grand Piano"))
-                self.key_root_var.set(data.get("key_root", "C"))
-                self.key_scale_var.set(data.get("key_scale", "Major"))
-                self.current_file_path = file_path
-                self.project_name = os.path.basename(file_path)
+                if self.compact_thread is not None: self.compact_thread.join()
+                journal_path = self.get_journal_path(file_path)
+                if os.path.exists(journal_path) and self.recover_journal(journal_path): return
+                data = read_project_file(file_path)
+                self.set_project_data(data, file_path)
                 self.is_modified = False
+                self.start_journal()
                 self.update_title()
-                self.draw_progression()
-                self.update_suggestions_logic(self.get_last_selected_chord_name())
                 messagebox.showinfo("Success", "読み込みました。")
             except Exception as e: messagebox.showerror("Error", f"読み込み失敗: {e}")
 
     def on_canvas_click(self, event):
         clicked_x = event.x
-        clicked_index = -1
-        for idx, (x1, x2) in enumerate(self.block_coords):
-            if x1 <= clicked_x <= x2: clicked_index = idx; break
-        
+        clicked_index = self.timeline.index.index_at_x(clicked_x)
         if clicked_index != -1:
             self.drag_item_index = clicked_index
             self.drag_start_x = clicked_x
@@ -510,7 +2354,8 @@ class ChordThinkerApp(tk.Tk):
             else: 
                 self.selection.clear()
                 self.selection.add(clicked_index)
-            self.update_suggestions_logic(self.progression[clicked_index]['name'])
+            self.update_suggestions_logic(self.progression.chord(clicked_index).name)
+            if clicked_index in self.selection: self.show_reharm_suggestion(clicked_index)
         else:
             self.selection.clear()
             self.update_suggestions_logic(None)
@@ -520,27 +2365,21 @@ class ChordThinkerApp(tk.Tk):
     def on_canvas_drag(self, event):
         if self.drag_item_index is not None:
             dx = event.x - self.drag_start_x
-            self.canvas.move(f"group_{self.drag_item_index}", dx, 0)
+            self.timeline.drag_block(self.drag_item_index, dx)
             self.drag_start_x = event.x
 
     def on_canvas_release(self, event):
         if self.drag_item_index is not None:
             drop_x = event.x
-            new_index = 0
-            for i, (x1, x2) in enumerate(self.block_coords):
-                center = (x1 + x2) / 2
-                if drop_x > center: new_index = i + 1
-                else: break
+            new_index = self.timeline.index.drop_index(drop_x)
             if new_index > len(self.progression): new_index = len(self.progression)
             
             if new_index != self.drag_item_index and new_index != self.drag_item_index + 1:
-                item = self.progression.pop(self.drag_item_index)
                 if new_index > self.drag_item_index: new_index -= 1
-                self.progression.insert(new_index, item)
+                self.apply_edit({"op": "move", "from": self.drag_item_index, "to": new_index})
                 if self.drag_item_index in self.selection:
                     self.selection.remove(self.drag_item_index)
                     self.selection.add(new_index)
-                self.mark_modified()
             self.drag_item_index = None
             self.draw_progression()
             self.draw_piano_roll()
@@ -551,15 +2390,12 @@ class ChordThinkerApp(tk.Tk):
             self.update_title()
 
     def on_canvas_double_click(self, event):
-        clicked_x = event.x
-        clicked_index = -1
-        for idx, (x1, x2) in enumerate(self.block_coords):
-            if x1 <= clicked_x <= x2: clicked_index = idx; break
+        clicked_index = self.timeline.index.index_at_x(event.x)
         if clicked_index != -1: self.open_duration_editor(clicked_index)
 
     def open_duration_editor(self, index):
         current_data = self.progression[index]
-        current_dur_val = current_data['duration']
+        current_dur_val = current_data.duration
         current_label = "全音符"
         for k, v in DURATION_OPTIONS.items():
             if v == current_dur_val: current_label = k; break
@@ -572,7 +2408,7 @@ class ChordThinkerApp(tk.Tk):
         y = self.winfo_rooty() + self.winfo_height()//2 - 75
         edit_win.geometry(f"+{x}+{y}")
 
-        tk.Label(edit_win, text=f"Change: {current_data['name'].replace('_', '')}", 
+        tk.Label(edit_win, text=f"Change: {current_data.name.replace('_', '')}", 
                  bg=C_BG_PANEL, fg="white", font=(FONT_FAMILY, 10)).pack(pady=10)
         combo = ttk.Combobox(edit_win, values=list(DURATION_OPTIONS.keys()), state="readonly")
         combo.set(current_label)
@@ -581,9 +2417,11 @@ class ChordThinkerApp(tk.Tk):
         def apply_change():
             new_label = combo.get()
             if new_label in DURATION_OPTIONS:
-                self.progression[index]['duration'] = DURATION_OPTIONS[new_label]
-                self.draw_progression()
-                self.mark_modified()
+                new_dur = DURATION_OPTIONS[new_label]
+                old_dur = self.progression.durations[index]
+                if new_dur != old_dur:
+                    self.apply_edit({"op": "resize", "index": index, "old": old_dur, "new": new_dur})
+                    self.draw_progression()
                 edit_win.destroy()
         tk.Button(edit_win, text="変更", command=apply_change, bg=TYPE_COLORS['sus4'], fg="black", relief=tk.FLAT).pack(pady=15)
 
@@ -600,30 +2438,63 @@ class ChordThinkerApp(tk.Tk):
             # Auto scroll to middle (C4=0.5)
             self.pr_canvas.yview_moveto(0.4)
 
+    def auto_voice_lead(self):
+        # 選択範囲 (なければ全体) の転回形とオクターブを選び直す。範囲の前後のコードは動かさない
+        if not self.progression: return
+        if load_numpy() is None:
+            messagebox.showerror("Error", "自動ボイシングには numpy が必要です (pip install numpy)")
+            return
+        first, last = (min(self.selection), max(self.selection)) if self.selection else (0, len(self.progression) - 1)
+        start = time.perf_counter()
+        voicings = voice_lead_progression(self.progression, first, last + 1)
+        changed = [i for i, v in enumerate(voicings, first) if v != self.progression.voicings[i]]
+        if changed:
+            self.apply_edit({"op": "voicing", "indices": changed, "old": [self.progression.voicings[i] for i in changed], "new": [voicings[i - first] for i in changed]})
+            self.draw_progression()
+            self.draw_piano_roll()
+        self.advice_label.config(text=f"自動ボイシング: {len(changed)} 個のコードを変更 ({(time.perf_counter() - start) * 1000:.0f} ms)", fg="white")
+
     def draw_piano_roll(self):
-        self.pr_canvas.delete("all")
         if not self.show_piano_roll: return
+        self.draw_pr_background()
+        self.draw_pr_notes()
+
+    def draw_pr_background(self):
+        layout = (self.pr_min_note, self.pr_max_note, self.pr_key_height)
+        if layout == self.pr_static_layout: return
+        self.pr_static_layout = layout
+        self.pr_canvas.delete("pr_static")
         total_height = (self.pr_max_note - self.pr_min_note + 1) * self.pr_key_height
         self.pr_canvas.configure(scrollregion=(0, 0, 1000, total_height))
-        
+
         for note_num in range(self.pr_max_note, self.pr_min_note - 1, -1):
             y = (self.pr_max_note - note_num) * self.pr_key_height
             is_black = (note_num % 12) in [1, 3, 6, 8, 10]
             color = C_PR_KEY_BLACK if is_black else C_PR_KEY_WHITE
-            self.pr_canvas.create_rectangle(0, y, 40, y + self.pr_key_height, fill=color, outline="#888888")
-            if note_num % 12 == 0: self.pr_canvas.create_text(20, y + self.pr_key_height/2, text=f"C{note_num//12 - 1}", font=("Arial", 8))
+            self.pr_canvas.create_rectangle(0, y, 40, y + self.pr_key_height, fill=color, outline="#888888", tags="pr_static")
+            if note_num % 12 == 0: self.pr_canvas.create_text(20, y + self.pr_key_height/2, text=f"C{note_num//12 - 1}", font=("Arial", 8), tags="pr_static")
             line_col = "#222222" if is_black else "#2a2a2a"
-            self.pr_canvas.create_rectangle(40, y, 2000, y + self.pr_key_height, fill=line_col, outline="")
-            self.pr_canvas.create_line(40, y, 2000, y, fill="#333333")
+            self.pr_canvas.create_rectangle(40, y, 2000, y + self.pr_key_height, fill=line_col, outline="", tags="pr_static")
+            self.pr_canvas.create_line(40, y, 2000, y, fill="#333333", tags="pr_static")
+        self.pr_canvas.tag_lower("pr_static")
+
+    def draw_pr_notes(self):
         sel_idx = self.get_selected_index()
-        if sel_idx is not None:
-            chord = self.progression[sel_idx]
-            notes = chord.get('voicing', self.get_default_notes(chord['name']))
-            for i, note_num in enumerate(notes):
-                if self.pr_min_note <= note_num <= self.pr_max_note:
-                    y = (self.pr_max_note - note_num) * self.pr_key_height
-                    tag = f"note_{i}"
-                    self.pr_canvas.create_rectangle(60, y + 2, 200, y + self.pr_key_height - 2, fill=C_PR_NOTE, outline="white", tags=tag)
+        notes = self.get_notes(self.progression[sel_idx]) if sel_idx is not None else []
+        visible = [(i, n) for i, n in enumerate(notes) if self.pr_min_note <= n <= self.pr_max_note]
+        items = self.pr_note_items
+        for slot, (i, note_num) in enumerate(visible):
+            y = (self.pr_max_note - note_num) * self.pr_key_height
+            tags = ("pr_note", f"note_{i}")
+            if slot < len(items):
+                rec = items[slot]
+                if rec[1] != i: self.pr_canvas.itemconfigure(rec[0], tags=tags); rec[1] = i
+                if rec[2] != y: self.pr_canvas.coords(rec[0], 60, y + 2, 200, y + self.pr_key_height - 2); rec[2] = y
+            else:
+                item_id = self.pr_canvas.create_rectangle(60, y + 2, 200, y + self.pr_key_height - 2, fill=C_PR_NOTE, outline="white", tags=tags)
+                items.append([item_id, i, y])
+        for rec in items[len(visible):]: self.pr_canvas.delete(rec[0])
+        del items[len(visible):]
 
     def on_pr_click(self, event):
         self.pr_note_drag_index = None
@@ -636,398 +2507,560 @@ class ChordThinkerApp(tk.Tk):
             if tag.startswith("note_"):
                 self.pr_note_drag_index = int(tag.split("_")[1])
                 self.pr_start_y = canvas_y
+                self.pr_drag_y = canvas_y
                 chord = self.progression[sel_idx]
-                notes = chord.get('voicing', self.get_default_notes(chord['name']))
-                self.pr_start_pitch = notes[self.pr_note_drag_index]
+                self.pr_start_pitch = chord.notes[self.pr_note_drag_index]
+                self.pr_drag_old_voicing = list(chord.voicing) if chord.voicing is not None else None
+                self.history.begin_group()
                 break
 
     def on_pr_drag(self, event):
         if self.pr_note_drag_index is not None:
-            canvas_y = self.pr_canvas.canvasy(event.y)
-            dy = canvas_y - self.pr_start_y
-            semitones = -int(dy / self.pr_key_height)
-            sel_idx = self.get_selected_index()
-            chord = self.progression[sel_idx]
-            current_notes = list(chord.get('voicing', self.get_default_notes(chord['name'])))
-            new_pitch = self.pr_start_pitch + semitones
-            if new_pitch < 0: new_pitch = 0
-            if new_pitch > 127: new_pitch = 127
-            current_notes[self.pr_note_drag_index] = new_pitch
-            chord['voicing'] = current_notes
-            self.draw_piano_roll()
-            self.mark_modified()
+            self.pr_drag_y = self.pr_canvas.canvasy(event.y)
+            if self.pr_drag_job is None:
+                self.pr_drag_job = self.after(PR_FRAME_MS, self.flush_pr_drag)
+
+    def flush_pr_drag(self):
+        if self.pr_drag_job is not None:
+            self.after_cancel(self.pr_drag_job)
+            self.pr_drag_job = None
+        if self.pr_note_drag_index is None: return
+        dy = self.pr_drag_y - self.pr_start_y
+        semitones = -int(dy / self.pr_key_height)
+        sel_idx = self.get_selected_index()
+        if sel_idx is None: return
+        chord = self.progression[sel_idx]
+        current_notes = list(chord.notes)
+        new_pitch = self.pr_start_pitch + semitones
+        if new_pitch < 0: new_pitch = 0
+        if new_pitch > 127: new_pitch = 127
+        if current_notes[self.pr_note_drag_index] == new_pitch: return
+        current_notes[self.pr_note_drag_index] = new_pitch
+        self.progression.set_voicing(sel_idx, current_notes)
+        self.draw_pr_notes()
 
     def on_pr_release(self, event):
         if self.pr_note_drag_index is not None:
+            self.pr_drag_y = self.pr_canvas.canvasy(event.y)
+            self.flush_pr_drag()
+            sel_idx = self.get_selected_index()
+            if sel_idx is not None:
+                # ドラッグ中はその場で書き換え、離した時点で1つの操作として記録する
+                new_voicing = self.progression.voicings[sel_idx]
+                old_notes = self.pr_drag_old_voicing if self.pr_drag_old_voicing is not None else list(self.progression.chord(sel_idx).notes)
+                if new_voicing is not None and list(new_voicing) != list(old_notes):
+                    self.record_edit({"op": "voicing", "index": sel_idx, "old": self.pr_drag_old_voicing, "new": list(new_voicing)})
+                else: self.progression.set_voicing(sel_idx, self.pr_drag_old_voicing)   # 元の音に戻しただけなら変更なし
+            self.history.end_group()
             self.play_single_chord_preview()
             self.pr_note_drag_index = None
 
     def play_single_chord_preview(self):
-        self.cleanup_temp_files()
         sel_idx = self.get_selected_index()
         if sel_idx is None: return
-        temp_dir = self.get_temp_dir()
-        fd, temp_path = tempfile.mkstemp(suffix=".mid", dir=temp_dir)
-        os.close(fd)
-        mid = MidiFile()
-        track = MidiTrack()
-        mid.tracks.append(track)
-        inst_name = self.inst_var.get()
-        prog_num = INSTRUMENT_MAP.get(inst_name, 0)
-        track.append(Message('program_change', program=prog_num, time=0))
-        chord = self.progression[sel_idx]
-        notes = chord.get('voicing', self.get_default_notes(chord['name']))
-        for n in notes: track.append(Message('note_on', note=n, velocity=90, time=0))
-        track.append(Message('note_off', note=notes[0], velocity=90, time=480))
-        for n in notes[1:]: track.append(Message('note_off', note=n, velocity=90, time=0))
-        mid.save(temp_path)
-        try: pygame.mixer.music.load(temp_path); pygame.mixer.music.play()
+        prog_num = INSTRUMENT_MAP.get(self.inst_var.get(), 0)
+        notes = self.get_notes(self.progression[sel_idx])
+        kind = self.get_preview_kind()
+        try:
+            if kind == "wav": data = render_audio_bytes([(notes, 0.25)], prog_num, 120.0)
+            else: data = render_midi_bytes([(notes, 0.25)], prog_num)
+            self.load_preview(data, kind)
+            pygame.mixer.music.play()
         except: pass
 
+    def get_preview_kind(self):
+        # config の preview_engine が "synth" なら OS の MIDI 音源を使わず内蔵シンセで鳴らす
+        return "wav" if self.config.get("preview_engine") == "synth" and load_numpy() is not None else "mid"
+
+    def load_preview(self, data, kind="mid"):
+        load_pygame()
+        if self.preview_from_buffer:
+            try:
+                buffer = io.BytesIO(data)
+                pygame.mixer.music.load(buffer, kind)
+                self.preview_buffer = buffer
+                return
+            except Exception as e:
+                # ファイル経由でも読めない場合はバックエンド自体の問題なのでバッファ方式を維持する
+                self.load_preview_file(data, kind)
+                print(f"Buffer preview unavailable, falling back to temp files: {e}")
+                self.preview_from_buffer = False
+                self.cleanup_btn.pack(side=tk.RIGHT, padx=2, before=self.help_btn)
+                return
+        self.load_preview_file(data, kind)
+
+    def load_preview_file(self, data, kind="mid"):
+        self.cleanup_temp_files()
+        fd, temp_path = tempfile.mkstemp(suffix="." + kind, dir=self.get_temp_dir())
+        with os.fdopen(fd, "wb") as f: f.write(data)
+        self.current_temp_file = temp_path
+        pygame.mixer.music.load(temp_path)
+
     def get_selected_index(self):
         if self.selection: return list(self.selection)[0]
         return None
 
     def get_default_notes(self, chord_name):
-        if chord_name == "Rest_Rest": return []
-        try:
-            root_str, type_str = chord_name.split('_')
-            root_base = NOTE_MAP[root_str] + 48 
-            intervals = CHORD_DEFS[type_str]
-            return [root_base + interval for interval in intervals]
-        except: return []
+        return get_chord(chord_name).notes
 
     def get_notes(self, chord_data):
-        if 'voicing' in chord_data: return chord_data['voicing']
-        return self.get_default_notes(chord_data['name'])
+        return chord_data.notes
 
     def get_key_offset(self):
         return NOTE_MAP.get(self.key_root_var.get(), 0)
 
     def update_suggestions_logic(self, last_chord):
-        for c_name, btn in self.chord_buttons.items():
-            type_key = c_name.split('_')[1]
-            orig_color = TYPE_COLORS.get(type_key, "#ffffff")
-            btn.configure(bg=C_BTN_DEFAULT_BG, fg=orig_color, font=(FONT_FAMILY, 10))
-
-        key_offset = self.get_key_offset()
-        scale_mode = self.key_scale_var.get()
-        sug_main = set()
-        sug_spice = set()
-        advice_text = "理論ロジック: "
-
-        if not last_chord or last_chord == "Rest_Rest":
-            if scale_mode == "Major":
-                for d, t in [(0, 'Maj'), (5, 'Maj'), (7, 'Maj'), (9, 'Min')]: sug_main.add(f"{ROOTS[(key_offset+d)%12]}_{t}")
-                advice_text += "キーの主要コードから開始。"
-            else:
-                for d, t in [(0, 'Min'), (5, 'Min'), (7, 'Maj'), (8, 'Maj')]: sug_main.add(f"{ROOTS[(key_offset+d)%12]}_{t}")
-                advice_text += "キーの主要コードから開始。"
-        else:
-            try:
-                root_str, type_str = last_chord.split('_')
-                if root_str not in NOTE_MAP: raise ValueError
-                root_idx = NOTE_MAP[root_str]
-                degree = (root_idx - key_offset) % 12
-
-                if scale_mode == "Major":
-                    if degree == 0:
-                        sug_main.update([f"{ROOTS[(key_offset+d)%12]}_{t}" for d,t in [(7,'Maj'),(5,'Maj'),(9,'Min')]])
-                        sug_spice.add(f"{ROOTS[(key_offset+1)%12]}_dim7")
-                        advice_text += "I度。展開へ。"
-                    elif degree == 2:
-                        sug_main.add(f"{ROOTS[(key_offset+7)%12]}_Maj")
-                        sug_spice.add(f"{ROOTS[(key_offset+7)%12]}_7")
-                        advice_text += "ii度。V度へ。"
-                    elif degree == 4:
-                        sug_main.add(f"{ROOTS[(key_offset+9)%12]}_Min")
-                        sug_main.add(f"{ROOTS[(key_offset+5)%12]}_Maj")
-                        advice_text += "iii度。vi度へ。"
-                    elif degree == 5:
-                        sug_main.update([f"{ROOTS[(key_offset+d)%12]}_{t}" for d,t in [(7,'Maj'),(0,'Maj'),(2,'Min')]])
-                        sug_spice.add(f"{ROOTS[(key_offset+6)%12]}_dim7")
-                        sug_spice.add(f"{ROOTS[(key_offset+5)%12]}_Min")
-                        advice_text += "IV度。展開。"
-                    elif degree == 7:
-                        sug_main.update([f"{ROOTS[(key_offset+d)%12]}_{t}" for d,t in [(0,'Maj'),(9,'Min')]])
-                        sug_spice.add(f"{root_str}_aug")
-                        sug_spice.add(f"{root_str}_sus4")
-                        advice_text += "V度。解決か偽終止。"
-                    elif degree == 9:
-                        sug_main.update([f"{ROOTS[(key_offset+d)%12]}_{t}" for d,t in [(5,'Maj'),(2,'Min'),(4,'Min')]])
-                        advice_text += "vi度。IVやiiへ。"
-                else: 
-                    if degree == 0:
-                        sug_main.update([f"{ROOTS[(key_offset+d)%12]}_{t}" for d,t in [(5,'Min'),(8,'Maj'),(10,'Maj')]])
-                        advice_text += "i度。展開へ。"
-                    elif degree == 7:
-                        sug_main.add(f"{ROOTS[(key_offset+0)%12]}_Min")
-                        sug_spice.add(f"{root_str}_aug")
-                        advice_text += "V度。i度へ解決。"
-                    else:
-                        sug_main.add(f"{ROOTS[(key_offset+7)%12]}_Maj")
-                        advice_text += "ドミナントを目指して。"
-
-                if type_str in ['7', 'aug', 'sus4']:
-                    target_root = ROOTS[(root_idx + 5) % 12]
-                    sug_main.add(f"{target_root}_{'Min' if scale_mode=='Minor' else 'Maj'}")
-                if type_str in ['dim', 'dim7']:
-                    target_root = ROOTS[(root_idx + 1) % 12]
-                    sug_main.add(f"{target_root}_{'Min' if scale_mode=='Major' else 'Maj'}")
-            except:
-                advice_text = "特殊なコードです。"
-
-        for s in sug_main:
-            if s in self.chord_buttons: self.chord_buttons[s].configure(bg=C_SUGGEST_BG, fg=C_SUGGEST_FG, font=(FONT_FAMILY, 10, "bold"))
-        for s in sug_spice:
-            if s in self.chord_buttons: self.chord_buttons[s].configure(bg=C_SPICE_BG, fg=C_SPICE_FG, font=(FONT_FAMILY, 10, "bold"))
+        sug_main, sug_spice, advice_text = suggest_chords(last_chord, self.key_root_var.get(), self.key_scale_var.get())
+        self.apply_button_states(sug_main, sug_spice)
         self.advice_label.config(text=advice_text, fg="white")
 
+    def apply_button_states(self, main, spice):
+        states = {c: "main" for c in main if c in self.palette}
+        states.update((c, "spice") for c in spice if c in self.palette)
+        self.palette.set_states(states)
+
+    def get_ai_context(self):
+        context = self.progression.names()[-AI_CONTEXT_CHORDS:]
+        key_info = f"{self.key_root_var.get()} {self.key_scale_var.get()}"
+        cache_key = SuggestionCache.make_key(self.key_root_var.get(), self.key_scale_var.get(), context)
+        return key_info, context, cache_key
+
+    def resolve_model_name(self):
+        # ワーカースレッドから呼ぶ。起動時の先行解決と同時に走っても list_models は1回だけ
+        with self.model_lock:
+            if self.cached_model_name: return self.cached_model_name
+            model_to_use = None
+            available = [m.name for m in load_genai(self.api_key).list_models() if 'generateContent' in m.supported_generation_methods]
+            for m in available:
+                if 'gemini-1.5-flash' in m: model_to_use = m; break
+            if not model_to_use:
+                for m in available:
+                    if 'gemini-pro' in m: model_to_use = m; break
+            if not model_to_use and available: model_to_use = available[0]
+            
+            if not model_to_use: raise Exception("No valid models")
+            self.cached_model_name = model_to_use
+            self.after(0, self.store_model_name, model_to_use)
+            return model_to_use
+
+    def store_model_name(self, model_name):
+        self.config["ai_model"] = model_name or ""
+        self.config["ai_model_resolved_at"] = time.time() if model_name else 0
+        self.save_config_file()
+
+    def warm_up_model(self):
+        if not self.api_key or self.use_stub_model or self.cached_model_name: return
+        def run_discovery():
+            try: self.resolve_model_name()
+            except Exception as e: print(f"Model discovery failed: {e}")
+        threading.Thread(target=run_discovery, daemon=True).start()
+
+    def get_ai_model(self):
+        return load_genai(self.api_key).GenerativeModel(self.resolve_model_name())
+
+    def request_suggestion(self, prompt, timeout):
+        # ワーカースレッドから呼ぶ
+        model_name = self.cached_model_name
+        options = {"timeout": timeout}
+        try: response = self.get_ai_model().generate_content(prompt, request_options=options)
+        except Exception as e:
+            if not is_model_not_found(e): raise
+            # 保存済みのモデルが廃止された場合は選び直して1回だけ再試行
+            with self.model_lock:
+                if model_name is None or self.cached_model_name == model_name: self.cached_model_name = None
+            response = self.get_ai_model().generate_content(prompt, request_options=options)
+        if response and response.text: return response.text
+        raise Exception("Empty Response")
+
     def ask_gemini(self):
-        if not self.api_key:
+        if self.is_thinking: return 
+        key_info, context, cache_key = self.get_ai_context()
+        cached = self.ai_cache.get(cache_key)
+        if cached is not None:
+            self.show_ai_suggestion(cached, from_cache=True)
+            return
+        if not self.api_key and not self.use_stub_model:
             messagebox.showwarning("API Error", "APIキーが設定されていません。")
             return
-        if self.is_thinking: return 
         self.is_thinking = True
         self.advice_label.config(text="Geminiが思考中... 🧠", fg=TYPE_COLORS['sus4'])
+        if self.prefetch_inflight and self.prefetch_inflight[1] == cache_key:
+            self.ai_waiting_key = cache_key   # 先読み中の結果を待つ
+            return
 
-        current_chords = [item['name'].replace('_', '') for item in self.progression]
-        if not current_chords: current_chords = ["(None)"]
-        key_info = f"{self.key_root_var.get()} {self.key_scale_var.get()}"
-        
-        prompt = f"""
-        Music Composition Task. Key: {key_info}.
-        Chords: {', '.join(current_chords)}
-        Task: Suggest 2 next chords.
-        1. Main (Standard) 2. Spice (dim7/aug/sus4/modal)
-        Format:
-        Main: G_7
-        Spice: C#_dim7
-        Reason: (Reason in Japanese)
-        """
-
-        def run_api():
-            try:
-                model_to_use = self.cached_model_name
-                if not model_to_use:
-                    available = [m.name for m in genai.list_models() if 'generateContent' in m.supported_generation_methods]
-                    for m in available:
-                        if 'gemini-1.5-flash' in m: model_to_use = m; break
-                    if not model_to_use:
-                        for m in available:
-                            if 'gemini-pro' in m: model_to_use = m; break
-                    if not model_to_use and available: model_to_use = available[0]
-                    
-                    if not model_to_use: raise Exception("No valid models")
-                    self.cached_model_name = model_to_use
-
-                model = genai.GenerativeModel(model_to_use)
-                response = model.generate_content(prompt)
-                
-                if response and response.text:
-                    self.after(0, self.parse_gemini_response, response.text)
-                else: raise Exception("Empty Response")
-            except Exception as e:
-                self.after(0, lambda: self.show_api_error(str(e)))
-        threading.Thread(target=run_api, daemon=True).start()
+        prompt = build_suggestion_prompt(key_info, context)
+        def on_done(text, error):
+            if error is not None: self.after(0, self.show_api_error, str(error))
+            else: self.after(0, self.parse_gemini_response, text, cache_key)
+        self.ai_executor.submit(prompt, on_done)
+
+    def schedule_prefetch(self):
+        if not self.config.get("ai_prefetch"): return
+        if not self.api_key and not self.use_stub_model: return
+        if self.prefetch_job is not None: self.after_cancel(self.prefetch_job)
+        self.prefetch_generation += 1
+        inflight = self.prefetch_inflight
+        if inflight and inflight[1] != self.ai_waiting_key:
+            inflight[2].cancel()   # 古い文脈の先読みは取り消す
+            self.prefetch_inflight = None
+        self.prefetch_job = self.after(AI_PREFETCH_DELAY_MS, self.start_prefetch)
+
+    def start_prefetch(self):
+        self.prefetch_job = None
+        key_info, context, cache_key = self.get_ai_context()
+        if self.ai_cache.contains(cache_key): return
+        if self.prefetch_inflight and self.prefetch_inflight[1] == cache_key: return
+        generation = self.prefetch_generation
+        prompt = build_suggestion_prompt(key_info, context)
+        def on_done(text, error):
+            self.after(0, self.finish_prefetch, generation, cache_key, text, None if error is None else str(error))
+        request = self.ai_executor.submit(prompt, on_done)
+        self.prefetch_inflight = (generation, cache_key, request)
+
+    def finish_prefetch(self, generation, cache_key, text, error):
+        if self.prefetch_inflight and self.prefetch_inflight[0] == generation: self.prefetch_inflight = None
+        waiting = self.ai_waiting_key == cache_key
+        if not waiting and generation != self.prefetch_generation: return
+        if waiting: self.ai_waiting_key = None
+        if error is not None:
+            if waiting: self.show_api_error(error)
+            return
+        if waiting:
+            self.parse_gemini_response(text, cache_key)
+            return
+        try: result = parse_suggestion_text(text)
+        except Exception: return
+        if result["main"] or result["spice"]: self.ai_cache.put(cache_key, result)
 
     def show_api_error(self, error_msg):
         self.is_thinking = False
         self.advice_label.config(text=f"AI Error: {error_msg[:30]}", fg="red")
 
-    def parse_gemini_response(self, text):
+    def parse_gemini_response(self, text, cache_key=None):
         self.is_thinking = False
-        main_raw, spice_raw, reason = None, None, ""
         try:
-            lines = text.strip().split('\n')
-            for line in lines:
-                if "Main:" in line: main_raw = line.split(':')[1].strip()
-                if "Spice:" in line: spice_raw = line.split(':')[1].strip()
-                if "Reason:" in line: reason = line.split(':')[1].strip()
-            
-            main_chord = self.normalize_chord_name(main_raw)
-            spice_chord = self.normalize_chord_name(spice_raw)
-            self.highlight_ai_buttons(main_chord, spice_chord)
-            
-            d_main = main_chord.replace('_', '') if main_chord else f"({main_raw}?)"
-            d_spice = spice_chord.replace('_', '') if spice_chord else f"({spice_raw}?)"
-            self.advice_label.config(text=f"🤖 AI: {reason}\n王道:{d_main}  攻め:{d_spice}", fg="#ffccff")
+            result = parse_suggestion_text(text)
         except Exception:
             self.advice_label.config(text="解析エラー", fg="red")
+            return
+        if cache_key is not None and (result["main"] or result["spice"]):
+            self.ai_cache.put(cache_key, result)
+        self.show_ai_suggestion(result)
 
-    def normalize_chord_name(self, chord_str):
-        if not chord_str: return None
-        s = chord_str.strip().replace(" ", "")
-        for flat, sharp in ENHARMONIC_MAP.items():
-            if s.startswith(flat): s = s.replace(flat, sharp, 1); break
+    def ask_gemini_reharm(self):
+        if self.is_thinking or not self.progression: return
+        names = self.progression.names()
+        key_info = f"{self.key_root_var.get()} {self.key_scale_var.get()}"
+        cache_key = f"reharm|{key_info}|{','.join(names)}"
+        items = list(self.progression.uids)
+        cached = self.ai_cache.get(cache_key)
+        if cached is not None:
+            self.store_reharm_results(items, names, key_info, cached)
+            return
+        if not self.api_key and not self.use_stub_model:
+            messagebox.showwarning("API Error", "APIキーが設定されていません。")
+            return
+        self.is_thinking = True
+        self.advice_label.config(text=f"Geminiが{len(names)}箇所のリハモを思考中... 🧠", fg=TYPE_COLORS['sus4'])
+        def on_done(text, error):
+            if error is not None: self.after(0, self.show_api_error, str(error))
+            else: self.after(0, self.finish_reharm, items, names, key_info, cache_key, text)
+        self.ai_executor.submit(build_reharm_prompt(key_info, names), on_done, timeout=self.ai_executor.timeout * 2)
+
+    def finish_reharm(self, items, names, key_info, cache_key, text):
+        self.is_thinking = False
+        try: results = parse_reharm_response(text, len(names))
+        except Exception:
+            self.advice_label.config(text="解析エラー", fg="red")
+            return
+        if any(results): self.ai_cache.put(cache_key, results)
+        self.store_reharm_results(items, names, key_info, results)
+
+    def store_reharm_results(self, items, names, key_info, results):
+        for uid, name, result in zip(items, names, results):
+            if result is not None: self.reharm_results[uid] = (uid, name, key_info, result)
+        found = sum(1 for r in results if r is not None)
+        self.advice_label.config(text=f"🤖 リハモ案を{found}/{len(names)}箇所取得しました。ブロックをクリックで表示", fg="#ffccff")
+
+    def show_reharm_suggestion(self, index):
+        entry = self.reharm_results.get(self.progression.uids[index])
+        if entry is None: return
+        key_info = f"{self.key_root_var.get()} {self.key_scale_var.get()}"
+        if entry[1] != self.progression.chord(index).name or entry[2] != key_info: return
+        self.show_ai_suggestion(entry[3], title=f"🤖 リハモ案 #{index + 1}")
+
+    def show_ai_suggestion(self, result, from_cache=False, title="🤖 AI"):
+        main_raw, spice_raw, reason = result["main"], result["spice"], result["reason"]
+        main_chord = self.normalize_chord_name(main_raw)
+        spice_chord = self.normalize_chord_name(spice_raw)
+        self.highlight_ai_buttons(main_chord, spice_chord)
         
-        if "_" not in s:
-            if len(s) > 1 and s[1] == '#': root = s[:2]; type_part = s[2:]
-            else: root = s[:1]; type_part = s[1:]
-            
-            if type_part.lower() == "dim7": type_part = "dim7"
-            elif type_part.lower() == "dim": type_part = "dim"
-            elif type_part.lower() in ["maj", "major"]: type_part = "Maj"
-            elif type_part.lower() in ["min", "minor", "m"]: type_part = "Min"
-            elif type_part == "7": type_part = "7"
-            elif type_part.lower() == "aug": type_part = "aug"
-            s = f"{root}_{type_part}"
-        if s in self.chord_buttons: return s
+        d_main = main_chord.replace('_', '') if main_chord else f"({main_raw}?)"
+        d_spice = spice_chord.replace('_', '') if spice_chord else f"({spice_raw}?)"
+        mark = " (キャッシュ)" if from_cache else ""
+        self.advice_label.config(text=f"{title}{mark}: {reason}\n王道:{d_main}  攻め:{d_spice}", fg="#ffccff")
+
+    def normalize_chord_name(self, chord_str):
+        if not isinstance(chord_str, str): return None   # 以前のキャッシュに残った不正な値
+        s = parse_chord_name(chord_str)
+        if s in self.palette: return s
         return None
 
     def highlight_ai_buttons(self, main, spice):
-        for c_name, btn in self.chord_buttons.items():
-            type_key = c_name.split('_')[1]
-            orig_color = TYPE_COLORS.get(type_key, "#ffffff")
-            btn.configure(bg=C_BTN_DEFAULT_BG, fg=orig_color, font=(FONT_FAMILY, 10))
-        if main and main in self.chord_buttons:
-            self.chord_buttons[main].configure(bg=C_SUGGEST_BG, fg=C_SUGGEST_FG, font=(FONT_FAMILY, 10, "bold"))
-        if spice and spice in self.chord_buttons:
-            self.chord_buttons[spice].configure(bg=C_SPICE_BG, fg=C_SPICE_FG, font=(FONT_FAMILY, 10, "bold"))
+        self.apply_button_states([main] if main else [], [spice] if spice else [])
 
     def get_last_selected_chord_name(self):
         if self.selection:
             idx = sorted(list(self.selection))[-1]
-            return self.progression[idx]['name']
+            return self.progression.chord(idx).name
         if self.progression:
-            return self.progression[-1]['name']
+            return self.progression.chord(-1).name
         return None
 
     def add_chord(self, chord_name):
         label = self.dur_var.get()
         duration = DURATION_OPTIONS.get(label, 1.0)
-        self.progression.append({'name': chord_name, 'duration': duration})
+        self.apply_edit({"op": "insert", "index": len(self.progression), "items": [{'name': chord_name, 'duration': duration}]})
         new_index = len(self.progression) - 1
         self.selection.clear() 
         self.selection.add(new_index)
         self.draw_progression()
-        self.mark_modified()
         self.update_suggestions_logic(chord_name)
+        self.schedule_prefetch()
 
     def load_preset(self):
         preset_name = self.preset_var.get()
         chords = PRESET_PROGRESSIONS.get(preset_name, [])
         label = self.dur_var.get()
         duration = DURATION_OPTIONS.get(label, 1.0)
+        items = []
         for c in chords:
-            if c in self.chord_buttons or c == "Rest_Rest":
-                self.progression.append({'name': c, 'duration': duration})
+            if c in self.palette or c == "Rest_Rest":
+                items.append({'name': c, 'duration': duration})
             else:
                 print(f"Skipped: {c}")
+        if items: self.apply_edit({"op": "insert", "index": len(self.progression), "items": items})
         self.draw_progression()
-        self.mark_modified()
         self.update_suggestions_logic(chords[-1] if chords else None)
 
+    def show_phrase_menu(self):
+        # 理論エンジンだけで数小節先までの候補を作り、選んだものを末尾に追加する
+        try:
+            length = max(1, int(self.config.get("phrase_length", 4)))
+            beam = max(1, int(self.config.get("phrase_beam", 8)))
+            spice = float(self.config.get("phrase_spice", 0.5))
+        except: length, beam, spice = 4, 8, 0.5
+        start = time.perf_counter()
+        phrases = generate_phrases(self.progression.names()[-PHRASE_CONTEXT:], self.key_root_var.get(), self.key_scale_var.get(), length, beam, spice=spice)
+        self.advice_label.config(text=f"理論ロジック: {len(phrases)} 通りの続きを生成 ({(time.perf_counter() - start) * 1000:.1f} ms)", fg="white")
+        if not phrases: return
+        menu = tk.Menu(self, tearoff=0)
+        for score, path in phrases:
+            label = " → ".join(name.replace('_', '') for name in path)
+            menu.add_command(label=f"{label}   ({score:.1f})", command=lambda p=path: self.add_phrase(p))
+        menu.tk_popup(self.phrase_btn.winfo_rootx(), self.phrase_btn.winfo_rooty() + self.phrase_btn.winfo_height())
+
+    def add_phrase(self, chords):
+        duration = DURATION_OPTIONS.get(self.dur_var.get(), 1.0)
+        self.apply_edit({"op": "insert", "index": len(self.progression), "items": [{'name': c, 'duration': duration} for c in chords]})
+        self.selection.clear()
+        self.draw_progression()
+        self.update_suggestions_logic(chords[-1])
+        self.schedule_prefetch()
+
     def copy_selection(self, event=None):
         if not self.selection: return
-        self.clipboard = []
-        for i in sorted(list(self.selection)):
-            item = self.progression[i]
-            data = {'name': item['name'], 'duration': item['duration']}
-            if 'voicing' in item: data['voicing'] = list(item['voicing'])
-            self.clipboard.append(data)
+        self.clipboard = [self.progression[i].to_dict() for i in sorted(list(self.selection))]
 
     def paste_selection(self, event=None):
         if not self.clipboard: return
-        for item in self.clipboard: 
-            new_item = {'name': item['name'], 'duration': item['duration']}
-            if 'voicing' in item: new_item['voicing'] = list(item['voicing'])
-            self.progression.append(new_item)
+        self.apply_edit({"op": "insert", "index": len(self.progression), "items": self.clipboard})
         self.selection.clear()
         start_idx = len(self.progression) - len(self.clipboard)
         for i in range(len(self.clipboard)): self.selection.add(start_idx + i)
         self.draw_progression()
-        self.mark_modified()
-        if self.progression: self.update_suggestions_logic(self.progression[-1]['name'])
+        if self.progression: self.update_suggestions_logic(self.progression.chord(-1).name)
+        self.schedule_prefetch()
 
     def delete_selection(self, event=None):
         focused = self.focus_get()
         if isinstance(focused, tk.Entry) or isinstance(focused, ttk.Combobox): return
         if not self.selection: 
             if self.progression:
-                self.progression.pop()
+                last = len(self.progression) - 1
+                self.apply_edit({"op": "delete", "indices": [last], "items": [self.progression[last].to_dict()]})
                 self.draw_progression()
-                if self.progression: self.update_suggestions_logic(self.progression[-1]['name'])
+                if self.progression: self.update_suggestions_logic(self.progression.chord(-1).name)
                 else: self.update_suggestions_logic(None)
-                self.mark_modified()
+                self.schedule_prefetch()
             return
-        for i in sorted(list(self.selection), reverse=True): del self.progression[i]
+        indices = sorted(self.selection)
+        self.apply_edit({"op": "delete", "indices": indices, "items": [self.progression[i].to_dict() for i in indices]})
         self.selection.clear()
         self.draw_progression()
-        self.mark_modified()
-        if self.progression: self.update_suggestions_logic(self.progression[-1]['name'])
+        if self.progression: self.update_suggestions_logic(self.progression.chord(-1).name)
         else: self.update_suggestions_logic(None)
+        self.schedule_prefetch()
 
     def select_all(self, event=None):
         self.selection = set(range(len(self.progression)))
         self.draw_progression()
 
+    def render_progression_midi(self):
+        return render_project_midi(self.get_project_data())
+
     def generate_midi(self, filename):
-        mid = MidiFile()
-        track = MidiTrack()
-        mid.tracks.append(track)
-        inst_name = self.inst_var.get()
-        prog_num = INSTRUMENT_MAP.get(inst_name, 0)
-        track.append(Message('program_change', program=prog_num, time=0))
-        try: bpm = float(self.bpm_var.get())
-        except: bpm = 120.0
-        track.append(MetaMessage('set_tempo', tempo=mido.bpm2tempo(bpm)))
-        ticks_per_bar = mid.ticks_per_beat * 4
-        
-        for item in self.progression:
-            notes = self.get_notes(item)
-            dur = item['duration']
-            vel = 90
-            if not notes: 
-                wait_ticks = int(ticks_per_bar * dur)
-                track.append(Message('note_off', note=0, velocity=0, time=wait_ticks))
-                continue
-            for n in notes: track.append(Message('note_on', note=n, velocity=vel, time=0))
-            wait_ticks = int(ticks_per_bar * dur)
-            track.append(Message('note_off', note=notes[0], velocity=vel, time=wait_ticks))
-            for n in notes[1:]: track.append(Message('note_off', note=n, velocity=vel, time=0))
-        mid.save(filename)
+        data, bpm = self.render_progression_midi()
+        with open(filename, "wb") as f: f.write(data)
         return filename, bpm
 
     def play_preview(self):
-        if not self.progression or self.is_playing: return
-        
-        local_temp_dir = os.path.join(os.getcwd(), "temp")
-        if not os.path.exists(local_temp_dir): os.makedirs(local_temp_dir)
-        
-        self.cleanup_temp_files() # Clean old files
-        fd, temp_path = tempfile.mkstemp(suffix=".mid", dir=local_temp_dir)
-        os.close(fd)
-        self.current_temp_file = temp_path
-        
-        _, bpm = self.generate_midi(temp_path)
-        
+        if self.is_playing and not self.playback_clock.running:
+            self.pause_preview()   # 一時停止中なら続きから
+            return
+        if self.is_playing: return
+        self.play_from(0)
+
+    def play_from_selection(self):
+        self.play_from(min(self.selection) if self.selection else 0)
+
+    def play_from(self, index):
+        # 指定したコード以降だけを書き出して再生する
+        if not self.progression or not 0 <= index < len(self.progression): return
+        if self.is_playing: self.stop_preview()
+        bpm = parse_bpm(self.bpm_var.get())
+        self.playback = PlaybackSnapshot(self.progression, bpm, INSTRUMENT_MAP.get(self.inst_var.get(), 0), kind=self.get_preview_kind())
+        self.seek_preview(self.playback.starts[index])
+
+    def on_canvas_ctrl_click(self, event):
+        index = self.timeline.index.index_at_x(self.canvas.canvasx(event.x))
+        if index != -1: self.play_from(index)
+
+    def seek_preview(self, seconds):
+        # MIDI は途中から再生できないので、その時刻を含むコードの頭から書き出し直す
+        if self.playback is None: return
+        index = self.playback.index_at(seconds)
+        if index < 0: self.stop_preview(); return
         try:
-            pygame.mixer.music.load(temp_path)
+            self.load_preview(self.playback.render(index), self.playback.kind)
             pygame.mixer.music.play()
-            self.is_playing = True
-            threading.Thread(target=self.animate, args=(bpm,), daemon=True).start()
-        except Exception as e: messagebox.showerror("Error", str(e))
-
-    def animate(self, bpm):
-        beat_sec = 60 / bpm
-        bar_sec = beat_sec * 4
-        for i, item in enumerate(self.progression):
-            if not self.is_playing: break
-            wait = bar_sec * item['duration']
-            self.after(0, self.draw_progression, i)
-            time.sleep(wait)
-        self.is_playing = False
-        self.after(0, self.draw_progression, -1)
-        pygame.mixer.music.stop()
+        except Exception as e:
+            self.stop_preview()
+            messagebox.showerror("Error", str(e))
+            return
+        self.is_playing = True
+        self.playback_clock.start(self.playback.starts[index])
+        self.playback_index = -1
+        if self.playback_job is not None: self.after_cancel(self.playback_job)
+        self.tick_playback()
+
+    def pause_preview(self):
+        if not self.is_playing: return
+        if self.playback_clock.running:
+            self.playback_clock.pause()
+            pygame.mixer.music.pause()
+            if self.playback_job is not None: self.after_cancel(self.playback_job); self.playback_job = None
+        elif self.loop_pending is not None:
+            snapshot, data = self.loop_pending
+            self.loop_pending = None
+            self.start_loop(snapshot, data)
+        else:
+            self.playback_clock.resume()
+            pygame.mixer.music.unpause()
+            self.tick_playback()
+
+    def tick_playback(self):
+        # UI スレッドで1フレームごとに位置を見る。カーソルはコードが変わった時だけ動かす
+        self.playback_job = None
+        position = self.playback_clock.position()
+        if self.loop_uids is not None: position %= self.playback.total
+        index = self.playback.index_at(position)
+        if index < 0: self.stop_preview(); return
+        index += self.playback.base
+        if index != self.playback_index:
+            self.playback_index = index
+            self.timeline.set_active(index)
+        self.playback_job = self.after(PLAYBACK_FRAME_MS, self.tick_playback)
+
+    # --- Loop Playback ---
+    def toggle_loop(self):
+        if self.loop_uids is not None:
+            self.stop_preview()
+            return
+        if not self.progression: return
+        if self.is_playing: self.stop_preview()
+        first, last = (min(self.selection), max(self.selection)) if self.selection else (0, len(self.progression) - 1)
+        self.loop_uids = (self.progression.uids[first], self.progression.uids[last])
+        snapshot = self.make_loop_snapshot()
+        if self.loop_cache is not None and self.loop_cache[0] == snapshot.cache_key(): data = self.loop_cache[1]
+        else:
+            data = snapshot.render(loop=True)
+            self.loop_cache = (snapshot.cache_key(), data)
+        self.start_loop(snapshot, data)
+
+    def make_loop_snapshot(self):
+        # 区間の両端ブロックを uid で探す。端が削除されていれば None
+        try: first, last = (self.progression.uids.index(uid) for uid in self.loop_uids)
+        except ValueError: return None
+        if last < first: first, last = last, first
+        bpm = parse_bpm(self.bpm_var.get())
+        return PlaybackSnapshot(self.progression, bpm, INSTRUMENT_MAP.get(self.inst_var.get(), 0), first, last + 1, self.get_preview_kind())
+
+    def start_loop(self, snapshot, data):
         try:
-            if self.current_temp_file: pass
-        except: pass
+            self.load_preview(data, snapshot.kind)
+            pygame.mixer.music.play(loops=-1)   # 同じデータを継ぎ目なく繰り返す
+        except Exception as e:
+            self.stop_preview()
+            messagebox.showerror("Error", str(e))
+            return
+        self.playback = snapshot
+        self.is_playing = True
+        self.playback_clock.start(0.0)
+        self.playback_index = -1
+        if self.playback_job is not None: self.after_cancel(self.playback_job)
+        self.tick_playback()
+
+    def refresh_loop(self):
+        # 編集後に呼ぶ。区間の中身が変わった時だけ区間分を裏で書き出し、今のループは鳴らし続ける
+        snapshot = self.make_loop_snapshot()
+        if snapshot is None or not snapshot.events: self.stop_preview(); return
+        if snapshot.cache_key() == self.playback.cache_key():
+            self.playback.base = snapshot.base   # 区間より前の編集で位置だけずれた
+            return
+        self.loop_generation += 1
+        generation = self.loop_generation
+        def render_loop():
+            data = snapshot.render(loop=True)
+            self.after(0, self.finish_loop_render, generation, snapshot, data)
+        threading.Thread(target=render_loop, daemon=True).start()
+
+    def finish_loop_render(self, generation, snapshot, data):
+        if generation != self.loop_generation or self.loop_uids is None: return
+        self.loop_cache = (snapshot.cache_key(), data)
+        if self.loop_swap_job is not None: self.after_cancel(self.loop_swap_job)
+        # 途中で切り替えると音が飛ぶので、今のループが一周し終わる時に差し替える
+        remaining = self.playback.total - self.playback_clock.position() % self.playback.total
+        self.loop_swap_job = self.after(int(remaining * 1000), self.swap_loop, generation, snapshot, data)
+
+    def swap_loop(self, generation, snapshot, data):
+        self.loop_swap_job = None
+        if generation != self.loop_generation or self.loop_uids is None: return
+        if not self.playback_clock.running: self.loop_pending = (snapshot, data); return   # 一時停止中なら再開時に差し替える
+        self.start_loop(snapshot, data)
 
     def stop_preview(self):
         self.is_playing = False
-        pygame.mixer.music.stop()
-        self.draw_progression(-1)
+        if self.playback_job is not None: self.after_cancel(self.playback_job); self.playback_job = None
+        if self.loop_swap_job is not None: self.after_cancel(self.loop_swap_job); self.loop_swap_job = None
+        self.loop_uids = None
+        self.loop_pending = None
+        self.loop_generation += 1
+        self.playback_clock.pause()
+        self.playback_index = -1
+        try: pygame.mixer.music.stop()
+        except: pass
+        self.timeline.set_active(-1)
 
     def reset_progression(self):
         self.new_project()
@@ -1039,43 +3072,160 @@ class ChordThinkerApp(tk.Tk):
             self.generate_midi(path)
             messagebox.showinfo("Saved", path)
 
-    def draw_progression(self, active_index=-1):
-        self.canvas.delete("all")
-        self.block_coords = []
-        start_x = 20; y = 40; height = 100; base_px = 80; gap = 2
-        current_x = start_x
-        for i, item in enumerate(self.progression):
-            name = item['name']
-            dur = item['duration']
-            
-            if name == "Rest_Rest":
-                root, ctype = "Rest", "Rest"
-                base_color = TYPE_COLORS['Rest']
-                disp_name = "休"
-                text_col = "#888888"
-            else:
-                parts = name.split('_')
-                if len(parts) == 2: root, ctype = parts
-                else: root, ctype = "?", "?"
-                base_color = TYPE_COLORS.get(ctype, "#555555")
-                disp_name = name.replace('_', '\n')
-                if dur < 0.25: disp_name = root
-                text_col = "white" if ctype not in ['add9', 'sus4'] else "black"
-
-            width = max(20, base_px * dur)
-            outline = C_SELECTION if i in self.selection else base_color
-            line_width = 3 if i in self.selection else 0
-            if i == active_index: fill = "#ffffff"; text_col = "#000000"
-            else: fill = base_color
-            
-            tag_group = f"group_{i}"
-            self.canvas.create_rectangle(current_x, y, current_x + width, y + height, fill=fill, outline=outline, width=line_width, tags=tag_group)
-            self.canvas.create_text(current_x + width/2, y + height/2, text=disp_name, fill=text_col, font=(FONT_FAMILY, 9, "bold"), justify=tk.CENTER, tags=tag_group)
-            self.block_coords.append((current_x, current_x + width))
-            current_x += width + gap
-        
-        self.canvas.configure(scrollregion=self.canvas.bbox("all"))
+    def export_wav(self):
+        if not self.progression: return
+        if load_numpy() is None:
+            messagebox.showerror("Error", "WAV の書き出しには numpy が必要です (pip install numpy)")
+            return
+        path = filedialog.asksaveasfilename(defaultextension=".wav", filetypes=[("WAV", "*.wav")])
+        if not path: return
+        data = {**self.get_project_meta(), "progression": Progression(self.progression)}
+        self.advice_label.config(text="WAV を書き出し中...", fg="white")
+        def run_export():
+            try:
+                render_project_audio(data, path, workers=os.cpu_count() or 1)
+                self.after(0, self.advice_label.config, {"text": f"WAV 出力: {path}"})
+            except Exception as e: self.after(0, messagebox.showerror, "Error", f"WAV 出力失敗: {e}")
+        threading.Thread(target=run_export, daemon=True).start()
+
+    def draw_progression(self):
+        # 再生中 (一時停止中を含む) は再生位置のカーソルを残す。停止中の playback_index は -1
+        self.timeline.update(self.progression, self.selection, self.playback_index)
+
+# --- Headless CLI ---
+def render_ctp_file(src, dst, check="mtime", force=False):
+    # プロセスプールから呼ばれる。(src, dst, 状態, 秒) を返す
+    start = time.perf_counter()
+    if not force and check == "mtime" and os.path.exists(dst) and os.path.getmtime(dst) >= os.path.getmtime(src):
+        return src, dst, "skip", time.perf_counter() - start
+    data = read_project_file(src)
+    midi, _ = render_project_midi(data)
+    if not force and check == "hash" and os.path.exists(dst):
+        with open(dst, "rb") as f:
+            if hashlib.sha256(f.read()).digest() == hashlib.sha256(midi).digest():
+                return src, dst, "skip", time.perf_counter() - start
+    os.makedirs(os.path.dirname(dst) or ".", exist_ok=True)
+    with open(dst, "wb") as f: f.write(midi)
+    return src, dst, "render", time.perf_counter() - start
+
+def collect_render_jobs(paths, out_dir=None, ext=".mid"):
+    # song.ctp と song.ctpb が並ぶ場合 (convert の後など) は出力名に元の拡張子を残す: song.ctp.mid / song.ctpb.mid
+    sources = {}   # 同じファイルが2回指定されても1回だけ書き出す
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, files in os.walk(path):
+                for name in sorted(files):
+                    if not name.endswith((".ctp", ".ctpb")): continue
+                    src = os.path.join(root, name)
+                    rel = os.path.relpath(src, path)
+                    sources.setdefault(os.path.normcase(os.path.abspath(src)), (src, os.path.join(out_dir, rel) if out_dir else src))
+        else:
+            sources.setdefault(os.path.normcase(os.path.abspath(path)), (path, os.path.join(out_dir, os.path.basename(path)) if out_dir else path))
+    stem = lambda base: os.path.normcase(os.path.abspath(os.path.splitext(base)[0]))
+    counts = Counter(stem(base) for _, base in sources.values())
+    jobs = [(src, (os.path.splitext(base)[0] if counts[stem(base)] == 1 else base) + ext) for src, base in sources.values()]
+    seen = {}
+    for src, dst in jobs:
+        other = seen.setdefault(os.path.normcase(os.path.abspath(dst)), src)
+        if other != src: raise ValueError(f"{other} and {src} would both be written to {dst}")
+    return jobs
+
+def run_render_command(args):
+    try: jobs = collect_render_jobs(args.paths, args.output)
+    except ValueError as e:
+        print(f"ERROR   {e}")
+        return 1
+    if not jobs:
+        print("No project files found.")
+        return 1
+    start = time.perf_counter()
+    failed = 0
+    def report(src, future_or_result):
+        nonlocal failed
+        try: src, dst, status, elapsed = future_or_result()
+        except Exception as e:
+            failed += 1
+            print(f"ERROR   {src}: {e}")
+            return
+        print(f"{status:<7} {elapsed * 1000:8.1f} ms  {src} -> {dst}")
+    workers = max(1, args.jobs)
+    if workers == 1 or len(jobs) == 1:
+        for src, dst in jobs:
+            report(src, lambda: render_ctp_file(src, dst, args.check, args.force))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [(src, pool.submit(render_ctp_file, src, dst, args.check, args.force)) for src, dst in jobs]
+            for src, future in futures: report(src, future.result)
+    print(f"{len(jobs)} files, {failed} failed, {time.perf_counter() - start:.2f} s total")
+    return 1 if failed else 0
+
+def run_wav_command(args):
+    # ファイルは順に処理し、1曲の中をチャンクに分けて並列に合成する
+    if load_numpy() is None:
+        print("numpy is required for WAV rendering (pip install numpy).")
+        return 1
+    try: jobs = collect_render_jobs(args.paths, args.output, ".wav")
+    except ValueError as e:
+        print(f"ERROR   {e}")
+        return 1
+    if not jobs:
+        print("No project files found.")
+        return 1
+    start = time.perf_counter()
+    failed = 0
+    for src, dst in jobs:
+        t = time.perf_counter()
+        try:
+            os.makedirs(os.path.dirname(dst) or ".", exist_ok=True)
+            seconds = render_project_audio(read_project_file(src), dst, max(1, args.jobs))
+        except Exception as e:
+            failed += 1
+            print(f"ERROR   {src}: {e}")
+            continue
+        print(f"render  {(time.perf_counter() - t) * 1000:8.1f} ms  {src} -> {dst} ({seconds:.1f} s audio)")
+    print(f"{len(jobs)} files, {failed} failed, {time.perf_counter() - start:.2f} s total")
+    return 1 if failed else 0
+
+def run_convert_command(args):
+    dst = args.dst or os.path.splitext(args.src)[0] + (".ctp" if is_binary_project(args.src) else ".ctpb")
+    start = time.perf_counter()
+    write_project_file(dst, read_project_file(args.src))
+    print(f"{args.src} -> {dst} ({(time.perf_counter() - start) * 1000:.1f} ms)")
+    return 0
+
+def main(argv=None):
+    global PROFILE_STARTUP
+    start = profile_step("module init (chord table, regexes)", IMPORTS_DONE)
+    parser = argparse.ArgumentParser(prog="chordthinker", description="CHORD THINKER (引数なしでGUIを起動)")
+    sub = parser.add_subparsers(dest="command")
+    render = sub.add_parser("render", help=".ctp を .mid に一括変換 (GUI不要)")
+    render.add_argument("paths", nargs="+", help=".ctp ファイルまたはディレクトリ")
+    render.add_argument("-o", "--output", help="出力ディレクトリ (省略時は .ctp と同じ場所)")
+    render.add_argument("-j", "--jobs", type=int, default=os.cpu_count() or 1, help="並列プロセス数")
+    render.add_argument("--check", choices=["mtime", "hash"], default="mtime", help="最新判定の方法")
+    render.add_argument("-f", "--force", action="store_true", help="最新でも再変換する")
+    wav = sub.add_parser("wav", help=".ctp を内蔵シンセで .wav に書き出す (numpy が必要)")
+    wav.add_argument("paths", nargs="+", help=".ctp ファイルまたはディレクトリ")
+    wav.add_argument("-o", "--output", help="出力ディレクトリ (省略時は .ctp と同じ場所)")
+    wav.add_argument("-j", "--jobs", type=int, default=os.cpu_count() or 1, help="1曲を合成する並列プロセス数")
+    convert = sub.add_parser("convert", help=".ctp (JSON) と .ctpb (バイナリ) を相互変換")
+    convert.add_argument("src", help="変換元のプロジェクトファイル")
+    convert.add_argument("dst", nargs="?", help="変換先 (省略時は拡張子を入れ替える)")
+    parser.add_argument("--profile-startup", action="store_true", help="GUI 起動時の import と初期化の内訳を表示する")
+    args = parser.parse_args(argv)
+    if args.command == "render": return run_render_command(args)
+    if args.command == "wav": return run_wav_command(args)
+    if args.command == "convert": return run_convert_command(args)
+    if tk is None:
+        print("tkinter is required for the GUI (render / wav / convert work without it).")
+        return 1
+    PROFILE_STARTUP = args.profile_startup
+    profile_step("argparse", start)
+    app = ChordThinkerApp()
+    app.mainloop()
+    return 0
 
 if __name__ == "__main__":
-    app = ChordThinkerApp()
-    app.mainloop()
\ No newline at end of file
+    # PyInstaller などで固めた exe では、プロセスプールの子プロセスが main() に入らないようにする
+    multiprocessing.freeze_support()
+    sys.exit(main())
\ No newline at end of file
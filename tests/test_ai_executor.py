@@ -0,0 +1,132 @@
+# AIRequestExecutor を LocalStubBackend (ネットワークなし) で動かす
+import threading
+import time
+
+import chordthinker as ct
+
+PROMPT = "Key: C Major. Chords: C, Am"
+
+
+class CountingBackend(ct.LocalStubBackend):
+    # 同時に generate 中の数の最大値を記録する
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.lock = threading.Lock()
+        self.active = 0
+        self.max_active = 0
+
+    def generate(self, prompt, timeout):
+        with self.lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        try: return super().generate(prompt, timeout)
+        finally:
+            with self.lock: self.active -= 1
+
+
+class Results:
+    def __init__(self):
+        self.items = []
+        self.event = threading.Event()
+        self.lock = threading.Lock()
+
+    def __call__(self, text, error):
+        with self.lock: self.items.append((text, error))
+        self.event.set()
+
+    def wait(self, count, timeout=5.0):
+        end = time.monotonic() + timeout
+        while time.monotonic() < end:
+            with self.lock:
+                if len(self.items) >= count: return self.items
+            time.sleep(0.005)
+        return self.items
+
+
+def test_result_is_delivered_once():
+    results = Results()
+    ct.AIRequestExecutor(ct.LocalStubBackend(latency=0.0, seed=0), workers=1, timeout=2.0).submit(PROMPT, results)
+    [(text, error)] = results.wait(1)
+    assert error is None
+    parsed = ct.parse_suggestion_text(text)
+    assert parsed["main"] and parsed["reason"].startswith("(ローカルスタブ)")
+    time.sleep(0.05)
+    assert len(results.items) == 1
+
+
+def test_worker_cap():
+    backend = CountingBackend(latency=0.05, seed=0)
+    executor = ct.AIRequestExecutor(backend, workers=3, timeout=5.0)
+    results = Results()
+    for _ in range(12): executor.submit(PROMPT, results)
+    assert len(results.wait(12)) == 12
+    assert backend.max_active == 3
+    assert len(executor.threads) == 3
+    assert all(error is None for _, error in results.items)
+
+
+def test_deadline_fires_while_call_hangs():
+    backend = ct.LocalStubBackend(latency=30.0)
+    results = Results()
+    start = time.monotonic()
+    ct.AIRequestExecutor(backend, workers=1, timeout=0.2).submit(PROMPT, results)
+    [(text, error)] = results.wait(1)
+    assert text is None and isinstance(error, TimeoutError)
+    assert time.monotonic() - start < 1.0
+    time.sleep(0.3)   # スタブが返ってきた後も callback は1回だけ
+    assert len(results.items) == 1
+
+
+def test_rate_limit_retries_then_fails():
+    backend = ct.LocalStubBackend(latency=0.0, rate_limit_rate=1.0, seed=0)
+    results = Results()
+    start = time.monotonic()
+    ct.AIRequestExecutor(backend, workers=1, timeout=5.0, max_retries=3, backoff=0.01).submit(PROMPT, results)
+    [(text, error)] = results.wait(1)
+    assert text is None and ct.is_rate_limited(error)
+    assert backend.calls == 4
+    assert time.monotonic() - start >= 0.01 + 0.02 + 0.04
+
+
+def test_rate_limit_recovers():
+    backend = ct.LocalStubBackend(latency=0.0, rate_limit_rate=1.0, seed=0)
+    results = Results()
+    ct.AIRequestExecutor(backend, workers=1, timeout=5.0, max_retries=3, backoff=0.05).submit(PROMPT, results)
+    time.sleep(0.02)
+    backend.rate_limit_rate = 0.0
+    [(text, error)] = results.wait(1)
+    assert error is None and text.startswith("Main:")
+    assert backend.calls == 2
+
+
+def test_backoff_longer_than_deadline_fails_immediately():
+    backend = ct.LocalStubBackend(latency=0.0, rate_limit_rate=1.0, seed=0)
+    results = Results()
+    ct.AIRequestExecutor(backend, workers=1, timeout=0.5, backoff=10.0).submit(PROMPT, results)
+    [(text, error)] = results.wait(1, timeout=0.4)
+    assert ct.is_rate_limited(error) and backend.calls == 1
+
+
+def test_cancel_suppresses_callback():
+    results = Results()
+    executor = ct.AIRequestExecutor(ct.LocalStubBackend(latency=0.1), workers=1, timeout=0.3)
+    executor.submit(PROMPT, results).cancel()
+    executor.submit(PROMPT, results).cancel()
+    time.sleep(0.5)   # 結果もタイムアウトも届かない
+    assert results.items == []
+
+
+def test_cancel_during_backoff_frees_worker():
+    backend = ct.LocalStubBackend(latency=0.0, rate_limit_rate=1.0, seed=0)
+    executor = ct.AIRequestExecutor(backend, workers=1, timeout=30.0, backoff=10.0)
+    first, second = Results(), Results()
+    request = executor.submit(PROMPT, first)
+    while backend.calls == 0: time.sleep(0.005)
+    time.sleep(0.02)   # バックオフで待機中
+    backend.rate_limit_rate = 0.0
+    request.cancel()
+    start = time.monotonic()
+    executor.submit(PROMPT, second)
+    [(text, error)] = second.wait(1)
+    assert error is None and time.monotonic() - start < 1.0
+    assert first.items == []
@@ -0,0 +1,74 @@
+# 内蔵シンセ: チャンク分割 (並列) の合成が一括の合成と同じになること、ループ用の書き出しが区間ちょうどの長さになること
+import io
+import random
+import wave
+
+import pytest
+
+import chordthinker as ct
+
+np = pytest.importorskip("numpy")
+
+
+def read_wav(data):
+    with wave.open(io.BytesIO(data), "rb") as w:
+        assert (w.getnchannels(), w.getsampwidth(), w.getframerate()) == (1, 2, ct.AUDIO_SAMPLE_RATE)
+        return np.frombuffer(w.readframes(w.getnframes()), dtype="<i2").astype(np.int32)
+
+
+def random_events(seed, count):
+    rng = random.Random(seed)
+    names = list(ct.CHORD_BY_NAME)
+    return [(ct.get_chord(rng.choice(names)).notes, rng.choice([0.125, 0.25, 0.5, 1.0, 0.3])) for _ in range(count)]
+
+
+@pytest.mark.parametrize("program,bpm,workers", [(0, 120.0, 1), (48, 97.0, 1), (88, 180.0, 2)])
+def test_chunked_render_matches_single_chunk(monkeypatch, program, bpm, workers):
+    events = random_events(program, 40)
+    monkeypatch.setattr(ct, "AUDIO_CHUNK_CHORDS", 7)
+    buffer = io.BytesIO()
+    seconds = ct.render_audio(events, program, bpm, buffer, workers=workers)
+    chunked = read_wav(buffer.getvalue())
+    monkeypatch.setattr(ct, "AUDIO_CHUNK_CHORDS", 10 ** 9)
+    whole = read_wav(ct.render_audio_bytes(events, program, bpm))
+    offsets = ct.audio_event_offsets(events, bpm)
+    timbre = ct.AUDIO_TIMBRES[program // 8]
+    assert len(chunked) == len(whole) == offsets[-1] + int(timbre[4] * ct.AUDIO_SAMPLE_RATE)
+    assert seconds == offsets[-1] / ct.AUDIO_SAMPLE_RATE
+    assert np.abs(chunked - whole).max() <= 1   # 足し合わせる順の違いによる丸めだけ
+    assert np.abs(whole).max() > 1000
+
+
+@pytest.mark.parametrize("events,bpm", [
+    (random_events(1, 12), 120.0),
+    ([((60, 64, 67), 0.125)], 200.0),   # 余韻 (0.3 秒) が区間 (0.15 秒) より長い: 何周分も先頭に重なる
+    ([((), 1.0), ((57, 60, 64), 0.5)], 90.0),
+])
+def test_loop_buffer_has_exact_loop_length(monkeypatch, events, bpm):
+    monkeypatch.setattr(ct, "AUDIO_CHUNK_CHORDS", 5)
+    loop = read_wav(ct.render_audio_bytes(events, 0, bpm, loop=True))
+    plain = read_wav(ct.render_audio_bytes(events, 0, bpm))
+    length = ct.audio_event_offsets(events, bpm)[-1]
+    assert len(loop) == length
+    folded = np.zeros(length, dtype=np.int32)
+    for start in range(0, len(plain), length):   # 余韻を区間の長さごとに先頭へ畳み込む
+        piece = plain[start:start + length]
+        folded[:len(piece)] += piece
+    assert np.abs(loop - folded).max() <= 1 + len(plain) // length   # 16bit への丸めが重なった分だけ
+
+
+def test_snapshot_wav_loop_matches_snapshot_total():
+    prog = ct.Progression.from_dicts([{"name": "C_Maj", "duration": 1.0}, {"name": "F_Maj", "duration": 0.5}, {"name": "G_7", "duration": 0.25}])
+    snap = ct.PlaybackSnapshot(prog, 133.0, 0, kind="wav")
+    frames = len(read_wav(snap.render(loop=True)))
+    assert frames / ct.AUDIO_SAMPLE_RATE == pytest.approx(snap.total, abs=1 / ct.AUDIO_SAMPLE_RATE)
+
+
+def test_synth_chord_lengths():
+    timbre = ct.AUDIO_TIMBRES[0]
+    release = int(timbre[4] * ct.AUDIO_SAMPLE_RATE)
+    block = ct.synth_chord((60, 64, 67), 1000, timbre)
+    assert block.dtype == np.float32 and len(block) == 1000 + release
+    assert abs(block[-1]) < 1e-3   # release の終わりで消える
+    assert not ct.synth_chord((), 1000, timbre).any()
+    assert len(ct.synth_chord((60,), 0, timbre)) == release
@@ -0,0 +1,104 @@
+# parse_chord_name のファジング: 表記ゆれの網羅、でたらめな入力で落ちないこと、以前の normalize_chord_name との一致
+import random
+
+import pytest
+
+import chordthinker as ct
+
+PALETTE = {f"{r}_{t}" for r in ct.ROOTS for t in ct.CHORD_TYPES if t != 'Rest'}
+LETTERS = {'C': 0, 'D': 2, 'E': 4, 'F': 5, 'G': 7, 'A': 9, 'B': 11}
+ACCIDENTALS = {'': 0, '#': 1, '♯': 1, 'b': -1, '♭': -1}
+
+ENHARMONIC_MAP = {
+    'Db': 'C#', 'Eb': 'D#', 'Gb': 'F#', 'Ab': 'G#', 'Bb': 'A#',
+    'DB': 'C#', 'EB': 'D#', 'GB': 'F#', 'AB': 'G#', 'BB': 'A#'
+}
+
+
+def baseline_split(s):
+    # 以前の手順でルートと種類に分ける。"_" を含む場合は分けずに (全体, None)
+    s = s.strip().replace(" ", "")
+    for flat, sharp in ENHARMONIC_MAP.items():
+        if s.startswith(flat): s = s.replace(flat, sharp, 1); break
+    if "_" in s: return s, None
+    if len(s) > 1 and s[1] == '#': return s[:2], s[2:]
+    return s[:1], s[1:]
+
+
+def baseline_normalize(chord_str):
+    # 置き換え前の ChordThinkerApp.normalize_chord_name (パレットの判定を PALETTE にしたもの)
+    if not chord_str: return None
+    s, type_part = baseline_split(chord_str)
+    if type_part is not None:
+        root = s
+        if type_part.lower() == "dim7": type_part = "dim7"
+        elif type_part.lower() == "dim": type_part = "dim"
+        elif type_part.lower() in ["maj", "major"]: type_part = "Maj"
+        elif type_part.lower() in ["min", "minor", "m"]: type_part = "Min"
+        elif type_part == "7": type_part = "7"
+        elif type_part.lower() == "aug": type_part = "aug"
+        s = f"{root}_{type_part}"
+    if s in PALETTE: return s
+    return None
+
+
+def all_spellings():
+    for letter, pc in LETTERS.items():
+        for acc, shift in ACCIDENTALS.items():
+            root = ct.ROOTS[(pc + shift) % 12]
+            for alias, ctype in ct.CHORD_SUFFIXES.items():
+                if not acc and alias[:1] in "#b": continue   # "C#5" は C# + 5 と読むのが正しい
+                yield letter + acc + alias, f"{root}_{ctype}"
+
+
+def test_every_root_and_suffix_alias():
+    for text, expected in all_spellings():
+        assert ct.parse_chord_name(text) == expected, text
+
+
+def test_separators_bass_and_lowercase_root():
+    rng = random.Random(0)
+    for text, expected in rng.sample(list(all_spellings()), 2000):
+        root, rest = (text[:2], text[2:]) if text[1:2] in ACCIDENTALS and text[1:2] else (text[:1], text[1:])
+        variant = rng.choice([root + "_" + rest, " " + root + " " + rest + " ", text + "/" + rng.choice("CDEFGAB") + rng.choice(["", "#", "b"]), text + "。"])
+        assert ct.parse_chord_name(variant) == expected, variant
+        assert ct.parse_chord_name(text[0].lower() + text[1:]) == expected, text
+
+
+def test_upper_case_flat_root():
+    assert ct.parse_chord_name("DBMAJ7") == "C#_Maj7"
+    assert ct.parse_chord_name("BBM7") == "A#_Maj7"
+    assert ct.parse_chord_name("EB") == "D#_Maj"
+
+
+@pytest.mark.parametrize("text", [None, "", "   ", "?", "H7", "Cxyz", "C/", "C7/H", "__", "C__Maj", "N.C.", "Rest_Rest", "C_Rest"])
+def test_rejects(text):
+    assert ct.parse_chord_name(text) is None
+
+
+def test_garbage_never_crashes():
+    rng = random.Random(1)
+    alphabet = "ABCDEFGHabcdefgmMj#♯b♭_/-+°øΔ()0123456789 .,。susdimaugaddmajmin\t\n\\\"'{}"
+    for _ in range(20000):
+        text = "".join(rng.choice(alphabet) for _ in range(rng.randint(0, 12)))
+        result = ct.parse_chord_name(text)
+        assert result is None or result in PALETTE, (text, result)
+
+
+def test_agrees_with_baseline_where_it_accepted():
+    # 以前は "CM" (大文字 M) を lower() してマイナー扱いしていた。M は一般にメジャーなので意図的に変えている
+    rng = random.Random(2)
+    types = ct.CHORD_TYPES + ["maj", "MAJ", "major", "Major", "min", "MIN", "minor", "m", "M", "DIM", "Dim7", "AUG", ""]
+    roots = [l + a for l in LETTERS for a in ["", "#", "b", "B"]]
+    checked = 0
+    for _ in range(20000):
+        text = rng.choice(roots) + rng.choice(["", "_", " "]) + rng.choice(types)
+        if rng.random() < 0.1: text = text[:rng.randint(0, len(text))] + rng.choice("#b_ xM") + text[rng.randint(0, len(text)):]
+        expected = baseline_normalize(text)
+        if expected is None: continue
+        checked += 1
+        if baseline_split(text)[1] == "M":
+            assert ct.parse_chord_name(text) == expected.replace("_Min", "_Maj"), text
+            continue
+        assert ct.parse_chord_name(text) == expected, text
+    assert checked > 5000
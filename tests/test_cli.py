@@ -0,0 +1,111 @@
+# ヘッドレス CLI (render / wav / convert): 出力先の決め方と、最新判定 (mtime / hash) による省略
+import os
+
+import pytest
+
+import chordthinker as ct
+
+SONG = {"bpm": "120", "instrument": "Grand Piano", "progression": [{"name": "C_Maj", "duration": 1.0}, {"name": "A_Min", "duration": 0.5}]}
+
+
+def write(path, data=SONG):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    ct.write_project_file(str(path), data)
+    return str(path)
+
+
+def test_collect_jobs_from_directory_and_files(tmp_path):
+    a = write(tmp_path / "in" / "a.ctp")
+    b = write(tmp_path / "in" / "sub" / "b.ctpb")
+    (tmp_path / "in" / "notes.txt").write_text("x")
+    assert ct.collect_render_jobs([str(tmp_path / "in")]) == [(a, a[:-4] + ".mid"), (b, b[:-5] + ".mid")]
+    out = str(tmp_path / "out")
+    assert ct.collect_render_jobs([str(tmp_path / "in")], out, ".wav") == [
+        (a, os.path.join(out, "a.wav")), (b, os.path.join(out, "sub", "b.wav"))]
+    assert ct.collect_render_jobs([b], out) == [(b, os.path.join(out, "b.mid"))]
+
+
+def test_same_stem_keeps_source_extension(tmp_path):
+    ctp = write(tmp_path / "song.ctp")
+    ctpb = write(tmp_path / "song.ctpb")
+    other = write(tmp_path / "other.ctp")
+    jobs = ct.collect_render_jobs([str(tmp_path)])
+    assert sorted(jobs) == sorted([(ctp, ctp + ".mid"), (ctpb, ctpb + ".mid"), (other, other[:-4] + ".mid")])
+    out = str(tmp_path / "out")
+    assert sorted(dst for _, dst in ct.collect_render_jobs([ctp, ctpb], out, ".wav")) == [
+        os.path.join(out, "song.ctp.wav"), os.path.join(out, "song.ctpb.wav")]
+
+
+def test_same_file_twice_is_one_job(tmp_path):
+    song = write(tmp_path / "song.ctp")
+    assert ct.collect_render_jobs([str(tmp_path), song]) == [(song, song[:-4] + ".mid")]
+
+
+def test_unresolvable_clash_is_an_error(tmp_path):
+    a = write(tmp_path / "a" / "song.ctp")
+    b = write(tmp_path / "b" / "song.ctp")
+    with pytest.raises(ValueError): ct.collect_render_jobs([a, b], str(tmp_path / "out"))
+    assert ct.main(["render", a, b, "-o", str(tmp_path / "out"), "-j", "1"]) == 1
+    assert not os.path.exists(tmp_path / "out")
+
+
+def test_render_writes_both_outputs_for_same_stem(tmp_path, capsys):
+    write(tmp_path / "song.ctp")
+    write(tmp_path / "song.ctpb", {**SONG, "bpm": "90"})
+    assert ct.main(["render", str(tmp_path), "-j", "2"]) == 0
+    ctp_midi = (tmp_path / "song.ctp.mid").read_bytes()
+    ctpb_midi = (tmp_path / "song.ctpb.mid").read_bytes()
+    assert ctp_midi == ct.render_project_midi(SONG)[0]
+    assert ctpb_midi == ct.render_project_midi({**SONG, "bpm": "90"})[0]
+    assert not (tmp_path / "song.mid").exists()
+    assert "2 files, 0 failed" in capsys.readouterr().out
+
+
+def test_mtime_skip_and_force(tmp_path):
+    src = write(tmp_path / "song.ctp")
+    dst = str(tmp_path / "song.mid")
+    assert ct.render_ctp_file(src, dst)[2] == "render"
+    os.utime(dst, (os.path.getmtime(src) + 10,) * 2)
+    assert ct.render_ctp_file(src, dst)[2] == "skip"
+    assert ct.render_ctp_file(src, dst, force=True)[2] == "render"
+    os.utime(src, (os.path.getmtime(dst) + 10,) * 2)   # 元ファイルの方が新しい
+    assert ct.render_ctp_file(src, dst)[2] == "render"
+
+
+def test_hash_skip_only_when_output_matches(tmp_path):
+    src = write(tmp_path / "song.ctp")
+    dst = str(tmp_path / "song.mid")
+    assert ct.render_ctp_file(src, dst, "hash")[2] == "render"
+    os.utime(src, (os.path.getmtime(dst) + 10,) * 2)   # 新しくても中身が同じなら省略
+    assert ct.render_ctp_file(src, dst, "hash")[2] == "skip"
+    with open(dst, "ab") as f: f.write(b"\0")
+    assert ct.render_ctp_file(src, dst, "hash")[2] == "render"
+    assert open(dst, "rb").read() == ct.render_project_midi(SONG)[0]
+    write(tmp_path / "song.ctp", {**SONG, "bpm": "140"})
+    assert ct.render_ctp_file(src, dst, "hash")[2] == "render"
+    assert ct.render_ctp_file(src, dst, "hash", force=True)[2] == "render"
+
+
+def test_failed_file_is_named(tmp_path, capsys):
+    bad = tmp_path / "bad.ctp"
+    bad.write_text("{not json")
+    write(tmp_path / "good.ctp")
+    assert ct.main(["render", str(tmp_path), "-j", "1"]) == 1
+    out = capsys.readouterr().out
+    assert f"ERROR   {bad}:" in out and "2 files, 1 failed" in out
+    assert (tmp_path / "good.mid").exists()
+
+
+def test_wav_same_stem(tmp_path):
+    pytest.importorskip("numpy")
+    write(tmp_path / "song.ctp")
+    write(tmp_path / "song.ctpb")
+    assert ct.main(["wav", str(tmp_path), "-j", "1"]) == 0
+    assert (tmp_path / "song.ctp.wav").exists() and (tmp_path / "song.ctpb.wav").exists()
+
+
+def test_convert_round_trip(tmp_path):
+    src = write(tmp_path / "song.ctp")
+    assert ct.main(["convert", src]) == 0
+    data = ct.read_project_file(str(tmp_path / "song.ctpb"))
+    assert data["bpm"] == "120" and data["progression"].to_dicts() == SONG["progression"]
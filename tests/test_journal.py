@@ -0,0 +1,213 @@
+# 編集ログ (EditJournal / compact_journal / replay_journal) のクラッシュ耐性
+import json
+import os
+import threading
+import time
+
+import pytest
+
+import chordthinker as ct
+
+BASE = {"bpm": "120", "instrument": "Grand Piano", "key_root": "C", "key_scale": "Major",
+        "progression": [{"name": "C_Maj", "duration": 1.0}, {"name": "G_Maj", "duration": 1.0}]}
+META = {k: v for k, v in BASE.items() if k != "progression"}
+
+
+def insert(index, name):
+    return {"op": "insert", "index": index, "items": [{"name": name, "duration": 1.0}]}
+
+
+def names(data):
+    return ct.Progression.from_dicts(data["progression"]).names()
+
+
+@pytest.fixture
+def base(tmp_path):
+    path = str(tmp_path / "song.ctp")
+    ct.write_project_file(path, BASE)
+    return path
+
+
+def open_journal(tmp_path, base):
+    return ct.EditJournal(str(tmp_path / "song.journal"), base, ct.file_sha256(base), META)
+
+
+def test_batched_fsync(tmp_path, base, monkeypatch):
+    syncs = []
+    real_fsync = os.fsync
+    monkeypatch.setattr(ct.os, "fsync", lambda fd: (syncs.append(fd), real_fsync(fd)))
+    journal = open_journal(tmp_path, base)
+    for i in range(ct.JOURNAL_BATCH_OPS - 1): assert journal.append(insert(0, "A_Min")) is False
+    assert not os.path.exists(journal.path) and syncs == []   # まだ書いていない
+    assert journal.append(insert(0, "A_Min")) is True         # 呼び出し側が flush する合図
+    journal.flush()
+    journal.flush()   # 書くものが無ければ fsync しない
+    assert len(syncs) == 1
+    with open(journal.path, encoding="utf-8") as f: lines = f.read().splitlines()
+    assert json.loads(lines[0])["base"] == base and len(lines) == 1 + ct.JOURNAL_BATCH_OPS
+    journal.append(insert(0, "F_Maj"))
+    journal.close()
+    assert len(syncs) == 2
+    data, _, ops = ct.replay_journal(journal.path)
+    assert len(ops) == ct.JOURNAL_BATCH_OPS + 1 and names(data)[0] == "F_Maj"
+
+
+def test_torn_last_line_is_ignored(tmp_path, base):
+    journal = open_journal(tmp_path, base)
+    journal.append(insert(2, "A_Min"))
+    journal.append({"op": "resize", "index": 0, "old": 1.0, "new": 0.5})
+    journal.close()
+    with open(journal.path, "a", encoding="utf-8") as f: f.write(json.dumps(insert(0, "D_Min"))[:25])
+    data, base_path, ops = ct.replay_journal(journal.path)
+    assert base_path == base and len(ops) == 2
+    assert names(data) == ["C_Maj", "G_Maj", "A_Min"]
+    assert ct.Progression.from_dicts(data["progression"]).durations[0] == 0.5
+
+
+def test_compaction_applies_saved_ops_only(tmp_path, base):
+    journal = open_journal(tmp_path, base)
+    journal.append(insert(2, "A_Min"))
+    journal.append({"op": "meta", "old": META, "new": {**META, "bpm": "90"}})
+    journal.commit()
+    journal.append(insert(0, "F_Maj"))   # 未保存
+    journal.flush()
+    ct.compact_journal(journal)
+    saved = ct.read_project_file(base)
+    assert names(saved) == ["C_Maj", "G_Maj", "A_Min"] and saved["bpm"] == "90"
+    assert journal.base_sha == ct.file_sha256(base)
+    data, _, ops = ct.replay_journal(journal.path)
+    assert ops == [insert(0, "F_Maj")]
+    assert names(data) == ["F_Maj", "C_Maj", "G_Maj", "A_Min"] and data["bpm"] == "90"
+
+
+def test_crash_before_replace_reapplies_everything(tmp_path, base, monkeypatch):
+    journal = open_journal(tmp_path, base)
+    journal.append(insert(2, "A_Min"))
+    journal.commit()
+    real_replace = os.replace
+    def crash(src, dst):
+        if dst == base: raise OSError("crash")
+        real_replace(src, dst)
+    monkeypatch.setattr(ct.os, "replace", crash)
+    with pytest.raises(OSError): ct.compact_journal(journal)
+    journal.close()
+    assert names(ct.read_project_file(base)) == ["C_Maj", "G_Maj"]   # 元ファイルはそのまま
+    data, _, ops = ct.replay_journal(journal.path)   # 印はあるがハッシュが合わない
+    assert len(ops) == 1 and names(data) == ["C_Maj", "G_Maj", "A_Min"]
+
+
+def test_crash_after_replace_skips_compacted_ops(tmp_path, base, monkeypatch):
+    journal = open_journal(tmp_path, base)
+    journal.append(insert(2, "A_Min"))
+    journal.commit()
+    journal.append(insert(0, "F_Maj"))
+    monkeypatch.setattr(journal, "mark_compacted", lambda count, sha: (_ for _ in ()).throw(OSError("crash")))
+    with pytest.raises(OSError): ct.compact_journal(journal)
+    journal.close()
+    assert names(ct.read_project_file(base)) == ["C_Maj", "G_Maj", "A_Min"]
+    data, _, ops = ct.replay_journal(journal.path)   # 反映済みの insert を二重に適用しない
+    assert ops == [insert(0, "F_Maj")]
+    assert names(data) == ["F_Maj", "C_Maj", "G_Maj", "A_Min"]
+
+
+def test_untitled_journal_replays_from_header(tmp_path):
+    journal = ct.EditJournal(str(tmp_path / ct.UNTITLED_JOURNAL), None, None, META)
+    journal.append(insert(0, "D_Min"))
+    journal.append(insert(1, "G_7"))
+    journal.close()
+    data, base_path, ops = ct.replay_journal(journal.path)
+    assert base_path is None and len(ops) == 2
+    assert names(data) == ["D_Min", "G_7"] and data["key_root"] == "C"
+
+
+class JournalApp:
+    # ChordThinkerApp の編集ログ周りだけを Tk なしで動かす
+    start_journal = ct.ChordThinkerApp.start_journal
+    compact_in_background = ct.ChordThinkerApp.compact_in_background
+    record_edit = ct.ChordThinkerApp.record_edit
+    flush_journal = ct.ChordThinkerApp.flush_journal
+    on_meta_changed = ct.ChordThinkerApp.on_meta_changed
+
+    def __init__(self, tmp_path, base):
+        self.journal_dir = str(tmp_path)
+        self.current_file_path = base
+        self.meta = dict(META)
+        self.history = ct.UndoHistory()
+        self.journal = None
+        self.journal_meta = None
+        self.journal_flush_job = None
+        self.compact_thread = None
+        self.loading_project = False
+        self.loop_uids = None
+
+    def get_journal_path(self, file_path):
+        return os.path.join(self.journal_dir, "song.journal")
+
+    def get_project_meta(self):
+        return dict(self.meta)
+
+    def mark_modified(self):
+        pass
+
+    def after(self, ms, func):
+        return "job"
+
+    def after_cancel(self, job):
+        pass
+
+    def save(self):
+        # save_project_overwrite の編集ログ部分
+        self.journal_flush_job = None
+        self.journal.commit()
+        self.compact_in_background()
+
+
+def test_second_save_during_compaction_is_not_lost(tmp_path, base, monkeypatch):
+    real_compact = ct.compact_journal
+    def slow_compact(journal):
+        time.sleep(0.1)
+        real_compact(journal)
+    monkeypatch.setattr(ct, "compact_journal", slow_compact)
+    app = JournalApp(tmp_path, base)
+    app.start_journal()
+    app.record_edit(insert(2, "A_Min"))
+    app.save()
+    app.record_edit(insert(3, "F_Maj"))
+    app.save()   # 1回目の反映がまだ走っている
+    app.record_edit(insert(0, "E_Min"))   # 未保存の操作は新規作成で捨てる
+    app.current_file_path = None
+    app.start_journal()
+    assert names(ct.read_project_file(base)) == ["C_Maj", "G_Maj", "A_Min", "F_Maj"]
+    assert not os.path.exists(os.path.join(str(tmp_path), "song.journal"))
+    assert app.journal.base_path is None and app.journal.ops == []
+
+
+def test_failed_compaction_keeps_journal(tmp_path, base, monkeypatch):
+    app = JournalApp(tmp_path, base)
+    app.start_journal()
+    app.record_edit(insert(2, "A_Min"))
+    app.journal.commit()
+    monkeypatch.setattr(ct, "compact_journal", lambda journal: (_ for _ in ()).throw(OSError("disk full")))
+    old_path = app.journal.path
+    app.current_file_path = None
+    app.get_journal_path = lambda file_path: os.path.join(str(tmp_path), ct.UNTITLED_JOURNAL)
+    app.start_journal()
+    data, _, ops = ct.replay_journal(old_path)   # 次回起動時に復元できる
+    assert len(ops) == 1 and names(data) == ["C_Maj", "G_Maj", "A_Min"]
+
+
+def test_meta_change_is_journaled_immediately(tmp_path, base):
+    app = JournalApp(tmp_path, base)
+    app.start_journal()
+    app.meta["bpm"] = "140"
+    app.on_meta_changed()
+    app.on_meta_changed()   # 変化が無ければ記録しない
+    app.loading_project = True
+    app.meta["key_root"] = "D"
+    app.on_meta_changed()   # 読み込み中の変更は記録しない
+    app.loading_project = False
+    app.flush_journal()     # 保存せずにクラッシュ
+    data, _, ops = ct.replay_journal(app.journal.path)
+    assert [op["op"] for op in ops] == ["meta"]
+    assert data["bpm"] == "140" and data["key_root"] == "C"
+    assert app.history.undo() is None   # 元に戻す対象にはしない
@@ -0,0 +1,59 @@
+# render_midi_bytes が以前の mido による書き出し (generate_midi) とバイト単位で一致することを確かめる
+import io
+import random
+
+import pytest
+
+import chordthinker as ct
+
+mido = pytest.importorskip("mido")
+
+
+def mido_reference(events, program, bpm):
+    # 置き換え前の generate_midi と同じ手順
+    mid = mido.MidiFile()
+    track = mido.MidiTrack()
+    mid.tracks.append(track)
+    track.append(mido.Message('program_change', program=program, time=0))
+    track.append(mido.MetaMessage('set_tempo', tempo=mido.bpm2tempo(bpm)))
+    ticks_per_bar = mid.ticks_per_beat * 4
+    for notes, dur in events:
+        wait_ticks = int(ticks_per_bar * dur)
+        if not notes:
+            track.append(mido.Message('note_off', note=0, velocity=0, time=wait_ticks))
+            continue
+        for n in notes: track.append(mido.Message('note_on', note=n, velocity=90, time=0))
+        track.append(mido.Message('note_off', note=notes[0], velocity=90, time=wait_ticks))
+        for n in notes[1:]: track.append(mido.Message('note_off', note=n, velocity=90, time=0))
+    buffer = io.BytesIO()
+    mid.save(file=buffer)
+    return buffer.getvalue()
+
+
+def random_events(rng, count):
+    names = list(ct.CHORD_BY_NAME)
+    durations = list(ct.DURATION_OPTIONS.values()) + [0.3, 1.5, 3.0, 0.01]
+    events = []
+    for _ in range(count):
+        notes = list(ct.get_chord(rng.choice(names)).notes)
+        if notes and rng.random() < 0.3: notes = sorted(rng.randrange(128) for _ in range(rng.randint(1, 6)))
+        events.append((notes, rng.choice(durations)))
+    return events
+
+
+@pytest.mark.parametrize("seed", range(300))
+def test_random_progressions_match_mido(seed):
+    rng = random.Random(seed)
+    events = random_events(rng, rng.randint(1, 60))
+    program = rng.choice(list(ct.INSTRUMENT_MAP.values()))
+    bpm = rng.choice([60.0, 90.0, 120.0, 133.3, 180.0])
+    assert ct.render_midi_bytes(events, program, bpm) == mido_reference(events, program, bpm)
+
+
+def test_empty_progression_matches_mido():
+    assert ct.render_midi_bytes([], 0, 120.0) == mido_reference([], 0, 120.0)
+
+
+def test_repeated_chords_use_running_status_like_mido():
+    events = [((60, 64, 67), 1.0)] * 50 + [((), 0.5)] + [((60, 64, 67), 1.0)] * 50
+    assert ct.render_midi_bytes(events, 0, 120.0) == mido_reference(events, 0, 120.0)
@@ -0,0 +1,67 @@
+# Progression (列データ) と .ctp / .ctpb の往復で内容が変わらないことを確かめる
+import random
+
+import pytest
+
+import chordthinker as ct
+
+
+def random_dicts(rng, count):
+    names = list(ct.CHORD_BY_NAME)
+    dicts = []
+    for _ in range(count):
+        item = {'name': rng.choice(names), 'duration': rng.choice([0.25, 0.5, 1.0, 2.0, 0.3])}
+        if rng.random() < 0.3: item['voicing'] = sorted(rng.randrange(24, 100) for _ in range(rng.randint(0, 5)))
+        dicts.append(item)
+    return dicts
+
+
+def test_progression_round_trip():
+    dicts = random_dicts(random.Random(1), 500)
+    prog = ct.Progression.from_dicts(dicts)
+    assert len(prog) == len(dicts)
+    assert prog.to_dicts() == dicts
+    assert prog.names() == [d['name'] for d in dicts]
+    assert list(prog.events()) == [(d.get('voicing', ct.get_chord(d['name']).notes), d['duration']) for d in dicts]
+    assert len(set(prog.uids)) == len(prog)
+
+
+def test_progression_edits_keep_columns_aligned():
+    prog = ct.Progression.from_dicts(random_dicts(random.Random(2), 20))
+    expected = prog.to_dicts()
+    item = ct.ProgressionItem.from_dict({'name': 'C_Maj', 'duration': 1.0, 'voicing': [48, 55, 64]})
+    prog.insert(3, item)
+    expected.insert(3, item.to_dict())
+    expected.insert(10, expected.pop(0))
+    prog.move(0, 10)
+    prog.set_duration(5, 0.5)
+    expected[5]['duration'] = 0.5
+    prog.set_voicing(6, None)
+    expected[6].pop('voicing', None)
+    assert prog.pop(7).to_dict() == expected.pop(7)
+    assert prog.to_dicts() == expected
+    assert len(prog.chord_ids) == len(prog.durations) == len(prog.voicings) == len(prog.uids)
+
+
+@pytest.mark.parametrize("ext", [".ctp", ".ctpb"])
+def test_project_file_round_trip(tmp_path, ext):
+    dicts = random_dicts(random.Random(3), 300)
+    data = {"bpm": "96", "instrument": "Strings", "progression": ct.Progression.from_dicts(dicts), "memo": "メモ"}
+    path = str(tmp_path / ("song" + ext))
+    ct.write_project_file(path, data)
+    loaded = ct.read_project_file(path)
+    assert list(loaded) == list(data)
+    assert ct.Progression.from_dicts(loaded["progression"]).to_dicts() == dicts
+    assert {k: v for k, v in loaded.items() if k != "progression"} == {"bpm": "96", "instrument": "Strings", "memo": "メモ"}
+
+
+def test_empty_binary_project(tmp_path):
+    path = str(tmp_path / "empty.ctpb")
+    ct.write_project_file(path, {"bpm": "120", "progression": []})
+    assert len(ct.read_project_file(path)["progression"]) == 0
+
+
+def test_bad_binary_project(tmp_path):
+    path = tmp_path / "bad.ctpb"
+    path.write_bytes(b"NOPE" + b"\0" * 40)
+    with pytest.raises(ValueError): ct.read_project_file(str(path))
@@ -0,0 +1,76 @@
+# 続きの生成: 幅無制限のビームサーチが全探索と一致すること、探索木の使い回しで結果が変わらないこと
+import heapq
+
+import pytest
+
+import chordthinker as ct
+
+CASES = [((), "C", "Major"), (("C_Maj", "A_Min"), "C", "Major"), (("D_m7", "G_7"), "C", "Major"),
+         (("A_Min",), "A", "Minor"), (("F#_Maj", "Rest_Rest"), "F#", "Major")]
+
+
+def exhaustive(context, key_root, scale_mode, length, top_k, spice):
+    context = tuple(c for c in context if c != "Rest_Rest")[-ct.PHRASE_CONTEXT:]
+    tonic = {f"{ct.ROOTS[ct.NOTE_MAP[key_root]]}_{t}" for t in ct.TONIC_TYPES[scale_mode]}
+    results = []
+    def walk(score, path):
+        if len(path) == length:
+            results.append((score + (ct.PHRASE_CADENCE_BONUS if path[-1] in tonic else 0.0), path))
+            return
+        last = path[-1] if path else (context[-1] if context else None)
+        for name, step in ct.phrase_transitions(last, key_root, scale_mode, spice):
+            if name == last: continue
+            walk(score + step - (ct.PHRASE_REPEAT_PENALTY if name in context + path else 0.0), path + (name,))
+    walk(0.0, ())
+    return sorted(results, key=lambda e: -e[0])[:top_k]
+
+
+@pytest.mark.parametrize("context,key_root,scale_mode", CASES)
+@pytest.mark.parametrize("length", [1, 3, 4])
+def test_unbounded_beam_matches_exhaustive(context, key_root, scale_mode, length):
+    ct.PHRASE_TREES.clear()
+    got = ct.generate_phrases(context, key_root, scale_mode, length, beam=10 ** 9, top_k=8, spice=0.5)
+    expected = exhaustive(context, key_root, scale_mode, length, 8, 0.5)
+    assert [score for score, _ in got] == pytest.approx([score for score, _ in expected])
+    assert len({path for _, path in got}) == len(got)
+    every = {path: score for score, path in exhaustive(context, key_root, scale_mode, length, 10 ** 9, 0.5)}
+    for score, path in got:   # 同点の並びは違ってもよいが、点数は進行から一意に決まる
+        assert score == pytest.approx(every[path])
+
+
+def test_cache_reuse_gives_same_results_as_fresh_search():
+    calls = [((("C_Maj",), "C", "Major"), dict(length=4, beam=3)),
+             ((("C_Maj",), "C", "Major"), dict(length=6, beam=8)),
+             ((("C_Maj",), "C", "Major"), dict(length=2, beam=20)),
+             ((("C_Maj",), "C", "Major"), dict(length=5, beam=5, spice=1.0)),
+             ((("C_Maj",), "C", "Major"), dict(length=4, beam=3))]
+    ct.PHRASE_TREES.clear()
+    warm = [ct.generate_phrases(*args, **kwargs) for args, kwargs in calls]
+    for (args, kwargs), result in zip(calls, warm):
+        ct.PHRASE_TREES.clear()
+        assert ct.generate_phrases(*args, **kwargs) == result
+
+
+def test_results_do_not_alias_cache():
+    ct.PHRASE_TREES.clear()
+    first = ct.generate_phrases(("C_Maj",), "C", "Major", 4, 8)
+    snapshot = list(first)
+    first.clear()
+    assert ct.generate_phrases(("C_Maj",), "C", "Major", 4, 8) == snapshot
+
+
+def test_tree_cache_is_bounded():
+    ct.PHRASE_TREES.clear()
+    for root in ct.ROOTS:
+        for scale in ("Major", "Minor"):
+            for spice in (0.0, 0.5, 1.0):
+                ct.generate_phrases((), root, scale, 2, 4, spice=spice)
+    assert len(ct.PHRASE_TREES) == ct.PHRASE_TREE_MAX
+    assert ((), "B", "Minor", 1.0) in ct.PHRASE_TREES   # 最近使ったものが残る
+
+
+def test_phrases_avoid_immediate_repeats_and_are_valid():
+    for context, key_root, scale_mode in CASES:
+        for score, path in ct.generate_phrases(context, key_root, scale_mode, 6, 8):
+            assert len(path) == 6 and all(name in ct.CHORD_BY_NAME for name in path)
+            assert all(a != b for a, b in zip(path, path[1:]))
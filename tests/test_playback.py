@@ -0,0 +1,213 @@
+# 再生位置の計算 (PlaybackClock / PlaybackSnapshot) と、偽の時計・偽のイベントループでのカーソル移動
+import heapq
+import io
+import itertools
+import random
+
+import pytest
+
+import chordthinker as ct
+
+
+class FakeClock:
+    def __init__(self):
+        self.t = 100.0
+
+    def __call__(self):
+        return self.t
+
+
+def progression(durations, names=("C_Maj", "A_Min", "F_Maj", "G_7")):
+    return ct.Progression.from_dicts([{"name": names[i % len(names)], "duration": d} for i, d in enumerate(durations)])
+
+
+def test_clock_start_pause_resume():
+    now = FakeClock()
+    clock = ct.PlaybackClock(now)
+    assert not clock.running and clock.position() == 0.0
+    clock.start(2.0)
+    now.t += 1.5
+    assert clock.running and clock.position() == pytest.approx(3.5)
+    clock.pause()
+    now.t += 10
+    assert not clock.running and clock.position() == pytest.approx(3.5)
+    clock.pause()   # 二重の一時停止は何もしない
+    clock.resume()
+    clock.resume()  # 再開中の再開で原点をずらさない
+    now.t += 0.25
+    assert clock.position() == pytest.approx(3.75)
+
+
+def test_clock_does_not_drift():
+    now = FakeClock()
+    clock = ct.PlaybackClock(now)
+    clock.start()
+    for _ in range(100000): now.t += 0.033
+    assert clock.position() == pytest.approx(3300.0, abs=1e-6)
+
+
+def test_snapshot_positions():
+    snap = ct.PlaybackSnapshot(progression([1.0, 0.5, 0.25, 2.0]), 120.0, 0)
+    assert len(snap) == 4
+    assert snap.starts == pytest.approx([0.0, 2.0, 3.0, 3.5])
+    assert snap.total == pytest.approx(7.5)
+    assert [snap.index_at(t) for t in (0.0, 1.999, 2.0, 3.49, 3.5, 7.49, 7.5, 100.0)] == [0, 0, 1, 2, 3, 3, -1, -1]
+    assert snap.index_at(-1.0) == 0
+    assert ct.PlaybackSnapshot(ct.Progression(), 120.0, 0).index_at(0.0) == -1
+
+
+def test_snapshot_is_frozen_and_keyed_by_content():
+    prog = progression([1.0, 1.0, 1.0])
+    snap = ct.PlaybackSnapshot(prog, 90.0, 0)
+    events = snap.events
+    ct.apply_edit_op(prog, {"op": "resize", "index": 0, "old": 1.0, "new": 2.0})
+    assert snap.events == events and snap.total == pytest.approx(3 * 4 * 60 / 90)
+    again = ct.PlaybackSnapshot(prog, 90.0, 0)
+    assert again.cache_key() != snap.cache_key()
+    ct.apply_edit_op(prog, {"op": "resize", "index": 0, "old": 2.0, "new": 1.0})
+    assert ct.PlaybackSnapshot(prog, 90.0, 0).cache_key() == snap.cache_key()
+    assert ct.PlaybackSnapshot(prog, 90.0, 0, kind="wav").cache_key() != snap.cache_key()
+
+
+def test_loop_section_snapshot():
+    prog = progression([1.0, 0.5, 0.5, 1.0, 2.0])
+    section = ct.PlaybackSnapshot(prog, 120.0, 0, 1, 4)
+    assert section.base == 1 and len(section) == 3
+    assert section.starts == pytest.approx([0.0, 1.0, 2.0]) and section.total == pytest.approx(4.0)
+    ct.apply_edit_op(prog, {"op": "insert", "index": 0, "items": [{"name": "D_Min", "duration": 1.0}]})
+    shifted = ct.PlaybackSnapshot(prog, 120.0, 0, 2, 5)   # 区間より前の編集: 中身は同じで位置だけずれる
+    assert shifted.cache_key() == section.cache_key() and shifted.base == 2
+
+
+class FakeTimeline:
+    def __init__(self):
+        self.active = -1
+        self.moves = []
+        self.updates = []
+
+    def set_active(self, index):
+        self.active = index
+        self.moves.append(index)
+
+    def update(self, progression, selection, active_index=-1):
+        self.active = active_index
+        self.updates.append(active_index)
+
+
+class PlaybackApp:
+    # ChordThinkerApp の再生カーソル周りだけを、偽の時計と after キューで動かす
+    tick_playback = ct.ChordThinkerApp.tick_playback
+    stop_preview = ct.ChordThinkerApp.stop_preview
+    draw_progression = ct.ChordThinkerApp.draw_progression
+
+    def __init__(self, prog):
+        self.now = FakeClock()
+        self.jobs = []
+        self.job_ids = itertools.count()
+        self.cancelled = set()
+        self.progression = prog
+        self.selection = set()
+        self.timeline = FakeTimeline()
+        self.playback = None
+        self.playback_clock = ct.PlaybackClock(self.now)
+        self.playback_job = None
+        self.playback_index = -1
+        self.is_playing = False
+        self.loop_uids = None
+        self.loop_pending = None
+        self.loop_generation = 0
+        self.loop_swap_job = None
+
+    def after(self, ms, func, *args):
+        job = next(self.job_ids)
+        heapq.heappush(self.jobs, (self.now.t + ms / 1000, job, func, args))
+        return job
+
+    def after_cancel(self, job):
+        self.cancelled.add(job)
+
+    def run_until(self, t):
+        # (時刻, カーソル位置) の変化を返す
+        changes = []
+        while self.jobs and self.jobs[0][0] <= t:
+            due, job, func, args = heapq.heappop(self.jobs)
+            if job in self.cancelled: continue
+            self.now.t = max(self.now.t, due)
+            before = self.timeline.active
+            func(*args)
+            if self.timeline.active != before: changes.append((self.now.t, self.timeline.active))
+        self.now.t = t
+        return changes
+
+    def play(self, snapshot, loop=False):
+        self.playback = snapshot
+        self.is_playing = True
+        if loop: self.loop_uids = (self.progression.uids[snapshot.base], self.progression.uids[snapshot.base + len(snapshot) - 1])
+        self.playback_clock.start(0.0)
+        start = self.now.t
+        self.tick_playback()
+        return start
+
+
+def test_cursor_follows_clock_and_stops_at_end():
+    app = PlaybackApp(progression([1.0, 0.5, 0.25, 1.0]))
+    start = app.play(ct.PlaybackSnapshot(app.progression, 120.0, 0))
+    changes = app.run_until(start + 10)
+    assert [index for _, index in changes] == [1, 2, 3, -1]
+    frame = ct.PLAYBACK_FRAME_MS / 1000
+    for (t, _), expected in zip(changes, [2.0, 3.0, 3.5, 5.5]):
+        assert expected <= t - start < expected + frame + 1e-9
+    assert app.timeline.moves[0] == 0 and not app.is_playing and app.jobs == []
+
+
+def test_pause_holds_cursor():
+    app = PlaybackApp(progression([1.0, 1.0]))
+    start = app.play(ct.PlaybackSnapshot(app.progression, 120.0, 0))
+    app.run_until(start + 1.0)
+    app.playback_clock.pause()
+    app.after_cancel(app.playback_job)
+    app.run_until(start + 30)
+    assert app.timeline.active == 0 and app.is_playing
+    app.playback_clock.resume()
+    app.tick_playback()
+    assert [index for _, index in app.run_until(app.now.t + 3.5)] == [1, -1]
+
+
+def test_loop_cursor_wraps_with_base():
+    app = PlaybackApp(progression([1.0, 0.5, 0.5, 1.0]))
+    start = app.play(ct.PlaybackSnapshot(app.progression, 120.0, 0, 1, 3), loop=True)
+    changes = app.run_until(start + 6.5)   # 区間は 2 秒
+    assert [index for _, index in changes] == [2, 1, 2, 1, 2, 1]
+    assert app.is_playing
+
+
+def test_redraw_during_playback_keeps_cursor():
+    app = PlaybackApp(progression([1.0, 1.0, 1.0]))
+    start = app.play(ct.PlaybackSnapshot(app.progression, 120.0, 0))
+    app.run_until(start + 2.5)
+    app.draw_progression()   # 編集や選択による再描画
+    assert app.timeline.updates[-1] == 1 and app.timeline.active == 1
+    app.run_until(start + 10)
+    app.draw_progression()
+    assert app.timeline.updates[-1] == -1
+
+
+@pytest.mark.parametrize("bpm", [60.0, 97.0, 120.0, 133.3, 200.0])
+def test_snapshot_seconds_match_mido(bpm):
+    # 書き出した MIDI を mido で読み、各コードの鳴り始めと全体の長さが PlaybackSnapshot と一致する
+    mido = pytest.importorskip("mido")
+    rng = random.Random(int(bpm))
+    durations = [rng.choice([0.25, 0.5, 1.0, 2.0, 0.3, 1.0 / 3]) for _ in range(40)]
+    prog = progression(durations)
+    ct.apply_edit_op(prog, {"op": "insert", "index": 5, "items": [{"name": "Rest_Rest", "duration": 0.5}]})
+    snap = ct.PlaybackSnapshot(prog, bpm, 0)
+    for start_index in (0, 7, len(snap) - 1):   # シーク: その位置から書き出した MIDI も同じ時刻で鳴る
+        midi = mido.MidiFile(file=io.BytesIO(snap.render(start_index)))
+        onsets, t, chord_start = [], 0.0, True
+        for msg in midi:
+            t += msg.time
+            if msg.type == "note_on" and chord_start: onsets.append(t); chord_start = False
+            elif msg.type == "note_off": chord_start = True
+        expected = [s - snap.starts[start_index] for i, s in enumerate(snap.starts[start_index:], start_index) if snap.events[i][0]]
+        assert onsets == pytest.approx(expected, abs=1e-9)
+        assert midi.length == pytest.approx(snap.total - snap.starts[start_index], abs=1e-9)
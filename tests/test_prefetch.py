@@ -0,0 +1,143 @@
+# AI 提案の先読み: 世代番号で古い文脈の結果を捨て、待っている「AIに聞く」には渡す (スタブバックエンドで Tk なし)
+import queue
+import time
+
+import chordthinker as ct
+
+
+class FakeLabel:
+    def config(self, **kwargs):
+        self.kwargs = kwargs
+
+
+class PrefetchApp:
+    schedule_prefetch = ct.ChordThinkerApp.schedule_prefetch
+    start_prefetch = ct.ChordThinkerApp.start_prefetch
+    finish_prefetch = ct.ChordThinkerApp.finish_prefetch
+    ask_gemini = ct.ChordThinkerApp.ask_gemini
+
+    def __init__(self, tmp_path, latency=0.0):
+        self.config = {"ai_prefetch": True}
+        self.api_key = None
+        self.use_stub_model = True
+        self.backend = ct.LocalStubBackend(latency=latency, seed=0)
+        self.ai_executor = ct.AIRequestExecutor(self.backend, workers=2, timeout=5.0)
+        self.ai_cache = ct.SuggestionCache(str(tmp_path / "ai_cache.json"))
+        self.ai_waiting_key = None
+        self.prefetch_job = None
+        self.prefetch_generation = 0
+        self.prefetch_inflight = None
+        self.is_thinking = False
+        self.advice_label = FakeLabel()
+        self.progression = ct.Progression()
+        self.key = ("C", "Major")
+        self.jobs = queue.Queue()   # after(0, ...) はワーカースレッドからも呼ばれる
+        self.shown = []
+        self.errors = []
+
+    def get_ai_context(self):
+        context = self.progression.names()[-ct.AI_CONTEXT_CHORDS:]
+        cache_key = ct.SuggestionCache.make_key(*self.key, context)
+        return f"{self.key[0]} {self.key[1]}", context, cache_key
+
+    def after(self, ms, func, *args):
+        self.jobs.put((ms, func, args))
+        return object()
+
+    def after_cancel(self, job):
+        pass
+
+    def run_pending(self, delayed=False):
+        # after のキューを実行する。delayed=False なら先読み開始の遅延タイマーは実行しない
+        held = []
+        while True:
+            try: ms, func, args = self.jobs.get_nowait()
+            except queue.Empty: break
+            if ms and not delayed: held.append((ms, func, args))
+            else: func(*args)
+        for job in held: self.jobs.put(job)
+
+    def wait_results(self, count, timeout=5.0):
+        # ワーカーが after(0, finish_prefetch) を積むまで待つ (実行はしない)
+        end = time.monotonic() + timeout
+        while self.jobs.qsize() < count and time.monotonic() < end: time.sleep(0.005)
+
+    def add(self, name):
+        self.progression.append(ct.ProgressionItem(ct.get_chord(name), 1.0))
+        self.schedule_prefetch()
+
+    def key_for(self):
+        return self.get_ai_context()[2]
+
+    def parse_gemini_response(self, text, cache_key=None):
+        self.is_thinking = False
+        self.shown.append((cache_key, text))
+
+    def show_ai_suggestion(self, result, from_cache=False):
+        self.shown.append(("cache", result))
+
+    def show_api_error(self, error):
+        self.is_thinking = False
+        self.errors.append(error)
+
+
+def test_prefetch_fills_cache(tmp_path):
+    app = PrefetchApp(tmp_path)
+    app.add("C_Maj")
+    app.run_pending(delayed=True)   # 遅延後に先読み開始
+    app.wait_results(1)
+    app.run_pending()
+    key = app.key_for()
+    assert app.ai_cache.contains(key) and app.prefetch_inflight is None
+    app.ask_gemini()
+    assert app.shown[-1][0] == "cache" and app.backend.calls == 1
+
+
+def test_superseded_result_is_dropped(tmp_path):
+    app = PrefetchApp(tmp_path)
+    app.add("C_Maj")
+    app.run_pending(delayed=True)
+    old_key = app.key_for()
+    app.wait_results(1)   # 結果は届いたが、UI スレッドが処理する前に次の編集が入った
+    app.add("G_7")
+    app.run_pending()
+    assert not app.ai_cache.contains(old_key)
+    app.run_pending(delayed=True)
+    app.wait_results(1)
+    app.run_pending()
+    assert app.ai_cache.contains(app.key_for()) and len(app.ai_cache.entries) == 1
+
+
+def test_edit_cancels_inflight_prefetch(tmp_path):
+    app = PrefetchApp(tmp_path, latency=0.2)
+    app.add("C_Maj")
+    app.run_pending(delayed=True)
+    request = app.prefetch_inflight[2]
+    app.add("A_Min")
+    assert request.cancelled and app.prefetch_inflight is None
+    time.sleep(0.3)
+    app.run_pending()
+    assert app.jobs.qsize() == 1 and app.ai_cache.entries == {}   # 残っているのは次の先読みの開始だけ
+
+
+def test_waiting_ask_receives_prefetch_after_later_edit(tmp_path):
+    app = PrefetchApp(tmp_path, latency=0.1)
+    app.add("C_Maj")
+    app.run_pending(delayed=True)
+    key = app.key_for()
+    app.ask_gemini()   # 同じ文脈の先読みが走っているので、その結果を待つ
+    assert app.ai_waiting_key == key and app.is_thinking
+    app.add("F_Maj")   # 待っている先読みは取り消さない
+    assert app.prefetch_inflight is not None and not app.prefetch_inflight[2].cancelled
+    app.wait_results(2)
+    app.run_pending()
+    assert app.shown == [(key, app.shown[0][1])] and app.shown[0][1].startswith("Main:")
+    assert app.ai_waiting_key is None and not app.is_thinking
+    assert app.backend.calls == 1   # 待つ側は同じリクエストをもう一度送らない
+
+
+def test_prefetch_disabled(tmp_path):
+    app = PrefetchApp(tmp_path)
+    app.config["ai_prefetch"] = False
+    app.add("C_Maj")
+    assert app.jobs.empty() and app.prefetch_generation == 0
@@ -0,0 +1,96 @@
+# 理論エンジン: 表引きの suggest_chords が、以前の update_suggestions_logic の if 文と同じ提案を返す
+import pytest
+
+import chordthinker as ct
+
+
+def baseline_suggestions(last_chord, key_root, scale_mode):
+    # 置き換え前の ChordThinkerApp.update_suggestions_logic からボタンの色付けを除いたもの
+    ROOTS, NOTE_MAP = ct.ROOTS, ct.NOTE_MAP
+    key_offset = NOTE_MAP.get(key_root, 0)
+    sug_main = set()
+    sug_spice = set()
+    advice_text = "理論ロジック: "
+    if not last_chord or last_chord == "Rest_Rest":
+        if scale_mode == "Major":
+            for d, t in [(0, 'Maj'), (5, 'Maj'), (7, 'Maj'), (9, 'Min')]: sug_main.add(f"{ROOTS[(key_offset+d)%12]}_{t}")
+            advice_text += "キーの主要コードから開始。"
+        else:
+            for d, t in [(0, 'Min'), (5, 'Min'), (7, 'Maj'), (8, 'Maj')]: sug_main.add(f"{ROOTS[(key_offset+d)%12]}_{t}")
+            advice_text += "キーの主要コードから開始。"
+    else:
+        try:
+            root_str, type_str = last_chord.split('_')
+            if root_str not in NOTE_MAP: raise ValueError
+            root_idx = NOTE_MAP[root_str]
+            degree = (root_idx - key_offset) % 12
+            if scale_mode == "Major":
+                if degree == 0:
+                    sug_main.update([f"{ROOTS[(key_offset+d)%12]}_{t}" for d,t in [(7,'Maj'),(5,'Maj'),(9,'Min')]])
+                    sug_spice.add(f"{ROOTS[(key_offset+1)%12]}_dim7")
+                    advice_text += "I度。展開へ。"
+                elif degree == 2:
+                    sug_main.add(f"{ROOTS[(key_offset+7)%12]}_Maj")
+                    sug_spice.add(f"{ROOTS[(key_offset+7)%12]}_7")
+                    advice_text += "ii度。V度へ。"
+                elif degree == 4:
+                    sug_main.add(f"{ROOTS[(key_offset+9)%12]}_Min")
+                    sug_main.add(f"{ROOTS[(key_offset+5)%12]}_Maj")
+                    advice_text += "iii度。vi度へ。"
+                elif degree == 5:
+                    sug_main.update([f"{ROOTS[(key_offset+d)%12]}_{t}" for d,t in [(7,'Maj'),(0,'Maj'),(2,'Min')]])
+                    sug_spice.add(f"{ROOTS[(key_offset+6)%12]}_dim7")
+                    sug_spice.add(f"{ROOTS[(key_offset+5)%12]}_Min")
+                    advice_text += "IV度。展開。"
+                elif degree == 7:
+                    sug_main.update([f"{ROOTS[(key_offset+d)%12]}_{t}" for d,t in [(0,'Maj'),(9,'Min')]])
+                    sug_spice.add(f"{root_str}_aug")
+                    sug_spice.add(f"{root_str}_sus4")
+                    advice_text += "V度。解決か偽終止。"
+                elif degree == 9:
+                    sug_main.update([f"{ROOTS[(key_offset+d)%12]}_{t}" for d,t in [(5,'Maj'),(2,'Min'),(4,'Min')]])
+                    advice_text += "vi度。IVやiiへ。"
+            else:
+                if degree == 0:
+                    sug_main.update([f"{ROOTS[(key_offset+d)%12]}_{t}" for d,t in [(5,'Min'),(8,'Maj'),(10,'Maj')]])
+                    advice_text += "i度。展開へ。"
+                elif degree == 7:
+                    sug_main.add(f"{ROOTS[(key_offset+0)%12]}_Min")
+                    sug_spice.add(f"{root_str}_aug")
+                    advice_text += "V度。i度へ解決。"
+                else:
+                    sug_main.add(f"{ROOTS[(key_offset+7)%12]}_Maj")
+                    advice_text += "ドミナントを目指して。"
+            if type_str in ['7', 'aug', 'sus4']:
+                target_root = ROOTS[(root_idx + 5) % 12]
+                sug_main.add(f"{target_root}_{'Min' if scale_mode=='Minor' else 'Maj'}")
+            if type_str in ['dim', 'dim7']:
+                target_root = ROOTS[(root_idx + 1) % 12]
+                sug_main.add(f"{target_root}_{'Min' if scale_mode=='Major' else 'Maj'}")
+        except:
+            advice_text = "特殊なコードです。"
+    return sug_main, sug_spice, advice_text
+
+
+LAST_CHORDS = [None, "", "Rest_Rest"] + [f"{r}_{t}" for r in ct.ROOTS for t in ct.CHORD_TYPES if t != 'Rest']
+ODD_CHORDS = ["H_Maj", "Cb_Maj", "X_unknown", "C_foo", "G_weird7"]
+
+
+@pytest.mark.parametrize("scale_mode", ["Major", "Minor"])
+@pytest.mark.parametrize("key_root", ct.ROOTS)
+def test_table_matches_if_chain(key_root, scale_mode):
+    for last in LAST_CHORDS + ODD_CHORDS:
+        main, spice, advice = ct.suggest_chords(last, key_root, scale_mode)
+        assert (set(main), set(spice), advice) == baseline_suggestions(last, key_root, scale_mode), last
+
+
+def test_unknown_key_falls_back_to_c():
+    for last in ("G_7", None, "A_Min"):
+        assert ct.suggest_chords(last, "H", "Major") == ct.suggest_chords(last, "C", "Major")
+
+
+def test_suggestions_are_palette_chords():
+    palette = {f"{r}_{t}" for r in ct.ROOTS for t in ct.CHORD_TYPES if t != 'Rest'}
+    for per_key in ct.SUGGESTION_TABLE.values():
+        for main, spice, _ in per_key:
+            assert main <= palette and spice <= palette
@@ -0,0 +1,61 @@
+# PositionIndex の二分探索が、以前の全ブロック走査と同じ結果を返すことを確かめる
+import random
+
+import chordthinker as ct
+
+
+def build(rng, count):
+    index = ct.PositionIndex(20, 2)
+    blocks = []
+    for _ in range(count):
+        dur = rng.choice(list(ct.DURATION_OPTIONS.values()))
+        width = 80 * dur
+        index.append(width, dur)
+        blocks.append((index.starts[-1], index.ends[-1], index.times[-1], dur))
+    return index, blocks
+
+
+def linear_index_at_x(blocks, x):
+    for i, (x1, x2, _, _) in enumerate(blocks):
+        if x1 <= x <= x2: return i
+    return -1
+
+
+def linear_index_at_time(blocks, t):
+    for i, (_, _, start, dur) in enumerate(blocks):
+        if start <= t < start + dur: return i
+    return -1
+
+
+def linear_drop_index(blocks, x):
+    for i, (x1, x2, _, _) in enumerate(blocks):
+        if x < (x1 + x2) / 2: return i
+    return len(blocks)
+
+
+def test_lookups_match_linear_scan():
+    rng = random.Random(5)
+    index, blocks = build(rng, 300)
+    for _ in range(3000):
+        x = rng.uniform(-10, index.end_x() + 10)
+        t = rng.uniform(-1, index.total_time() + 1)
+        assert index.index_at_x(x) == linear_index_at_x(blocks, x)
+        assert index.index_at_time(t) == linear_index_at_time(blocks, t)
+        assert index.drop_index(x) == linear_drop_index(blocks, x)
+
+
+def test_truncate_and_append_matches_rebuild():
+    rng = random.Random(7)
+    index, _ = build(rng, 200)
+    widths = [e - s for s, e in zip(index.starts, index.ends)]
+    durs = list(index.durations)
+    for _ in range(50):
+        k = rng.randrange(len(durs) + 1)
+        dur = rng.choice([0.25, 0.5, 1.0, 2.0])
+        widths[k:] = [80 * dur] + widths[k:][1:]
+        durs[k:] = [dur] + durs[k:][1:]
+        index.truncate(k)
+        for w, d in zip(widths[k:], durs[k:]): index.append(w, d)
+        fresh = ct.PositionIndex(20, 2)
+        for w, d in zip(widths, durs): fresh.append(w, d)
+        assert (index.starts, index.ends, index.times) == (fresh.starts, fresh.ends, fresh.times)
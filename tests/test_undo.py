@@ -0,0 +1,156 @@
+# UndoHistory: ランダムな操作列で、元に戻す / やり直しが途中の状態をすべて再現することを確かめる
+import json
+import random
+
+import chordthinker as ct
+
+NAMES = [n for n in ct.CHORD_BY_NAME if n != "Rest_Rest"] + ["Rest_Rest"]
+
+
+def random_item(rng):
+    item = {"name": rng.choice(NAMES), "duration": rng.choice([0.25, 0.5, 1.0, 2.0])}
+    if rng.random() < 0.2: item["voicing"] = sorted(rng.sample(range(40, 80), 3))
+    return item
+
+
+def random_op(rng, prog):
+    # アプリと同じ形の操作を作る (old / items は適用前の値)
+    n = len(prog)
+    kind = rng.choice(["insert", "insert", "delete", "move", "resize", "voicing", "voicings"]) if n else "insert"
+    if kind == "insert":
+        return {"op": "insert", "index": rng.randint(0, n), "items": [random_item(rng) for _ in range(rng.randint(1, 3))]}
+    if kind == "delete":
+        indices = sorted(rng.sample(range(n), rng.randint(1, min(3, n))))
+        return {"op": "delete", "indices": indices, "items": [prog[i].to_dict() for i in indices]}
+    if kind == "move":
+        return {"op": "move", "from": rng.randrange(n), "to": rng.randrange(n)}
+    if kind == "resize":
+        i = rng.randrange(n)
+        return {"op": "resize", "index": i, "old": prog.durations[i], "new": rng.choice([0.25, 0.5, 1.0, 2.0])}
+    if kind == "voicing":
+        i = rng.randrange(n)
+        return {"op": "voicing", "index": i, "old": prog.voicings[i], "new": rng.choice([None, sorted(rng.sample(range(40, 80), 4))])}
+    indices = sorted(rng.sample(range(n), rng.randint(1, min(4, n))))
+    return {"op": "voicing", "indices": indices, "old": [prog.voicings[i] for i in indices],
+            "new": [sorted(rng.sample(range(40, 80), 3)) for _ in indices]}
+
+
+def apply(prog, ops):
+    for op in ops: ct.apply_edit_op(prog, op)
+
+
+def test_inverse_ops():
+    rng = random.Random(0)
+    for _ in range(500):
+        prog = ct.Progression.from_dicts([random_item(rng) for _ in range(rng.randint(0, 8))])
+        before = prog.to_dicts()
+        op = random_op(rng, prog)
+        ct.apply_edit_op(prog, op)
+        ct.apply_edit_op(prog, ct.invert_edit_op(op))
+        assert prog.to_dicts() == before, op
+
+
+def test_random_undo_redo_restores_every_state():
+    rng = random.Random(1)
+    prog = ct.Progression()
+    history = ct.UndoHistory(max_bytes=1 << 30)
+    states = [prog.to_dicts()]
+    for _ in range(500):
+        if rng.random() < 0.2:   # ドラッグ: 同じコードへの連続したボイシング変更などを1ステップに
+            history.begin_group()
+            for _ in range(rng.randint(1, 5)):
+                op = random_op(rng, prog)
+                ct.apply_edit_op(prog, op)
+                history.push(op)
+            history.end_group()
+        else:
+            op = random_op(rng, prog)
+            ct.apply_edit_op(prog, op)
+            history.push(op)
+        states.append(prog.to_dicts())
+    for expected in reversed(states[:-1]):
+        apply(prog, history.undo())
+        assert prog.to_dicts() == expected
+    assert history.undo() is None
+    for expected in states[1:]:
+        apply(prog, history.redo())
+        assert prog.to_dicts() == expected
+    assert history.redo() is None
+
+
+def test_new_edit_after_undo_drops_redo():
+    rng = random.Random(2)
+    prog = ct.Progression()
+    history = ct.UndoHistory()
+    for _ in range(10):
+        op = random_op(rng, prog)
+        ct.apply_edit_op(prog, op)
+        history.push(op)
+    apply(prog, history.undo())
+    apply(prog, history.undo())
+    before = prog.to_dicts()
+    op = random_op(rng, prog)
+    ct.apply_edit_op(prog, op)
+    history.push(op)
+    assert history.redo() is None
+    apply(prog, history.undo())
+    assert prog.to_dicts() == before
+    assert history.total_bytes == sum(size for _, size in history.undo_steps) + sum(size for _, size in history.redo_steps)
+
+
+def test_drag_merges_voicing_changes():
+    prog = ct.Progression.from_dicts([{"name": "C_Maj", "duration": 1.0}, {"name": "F_Maj", "duration": 1.0}])
+    history = ct.UndoHistory()
+    history.begin_group()
+    old = None
+    for voicing in ([48, 52, 55], [49, 52, 55], [50, 52, 55], [50, 53, 55]):
+        op = {"op": "voicing", "index": 0, "old": old, "new": voicing}
+        ct.apply_edit_op(prog, op)
+        history.push(op)
+        old = voicing
+    history.push({"op": "resize", "index": 1, "old": 1.0, "new": 0.5})
+    ct.apply_edit_op(prog, {"op": "resize", "index": 1, "old": 1.0, "new": 0.5})
+    history.end_group()
+    [(ops, _)] = history.undo_steps
+    assert ops[0] == {"op": "voicing", "index": 0, "old": None, "new": [50, 53, 55]} and len(ops) == 2
+    apply(prog, history.undo())
+    assert prog.voicings == [None, None] and list(prog.durations) == [1.0, 1.0]
+    apply(prog, history.redo())
+    assert prog.voicings[0] == [50, 53, 55] and prog.durations[1] == 0.5
+
+
+def test_empty_group_adds_no_step():
+    history = ct.UndoHistory()
+    history.begin_group()
+    history.end_group()
+    assert history.undo() is None
+
+
+def test_memory_cap_evicts_oldest_steps():
+    rng = random.Random(3)
+    prog = ct.Progression()
+    cap = 4000
+    history = ct.UndoHistory(max_bytes=cap)
+    states = [prog.to_dicts()]
+    for _ in range(300):
+        op = random_op(rng, prog)
+        ct.apply_edit_op(prog, op)
+        history.push(op)
+        states.append(prog.to_dicts())
+        assert history.total_bytes <= cap or len(history.undo_steps) == 1
+        assert history.total_bytes == sum(size for _, size in history.undo_steps)
+    kept = len(history.undo_steps)
+    assert 1 <= kept < 300
+    assert sum(len(json.dumps(op)) for ops, _ in history.undo_steps for op in ops) == history.total_bytes
+    for expected in reversed(states[-kept - 1:-1]):   # 残っている分だけ正しく戻れる
+        apply(prog, history.undo())
+        assert prog.to_dicts() == expected
+    assert history.undo() is None
+
+
+def test_single_step_larger_than_cap_is_kept():
+    history = ct.UndoHistory(max_bytes=10)
+    op = {"op": "insert", "index": 0, "items": [{"name": "C_Maj", "duration": 1.0}] * 5}
+    history.push(op)
+    history.push(op)
+    assert len(history.undo_steps) == 1
@@ -0,0 +1,121 @@
+# 自動ボイシング: 候補の妥当性、Viterbi が全探索と同じ最小コストになること、まとめたボイシング操作の元に戻す
+import itertools
+import random
+
+import pytest
+
+import chordthinker as ct
+
+NAMES = [n for n in ct.CHORD_BY_NAME if n != "Rest_Rest"]
+REST = ct.CHORD_BY_NAME["Rest_Rest"].id
+
+
+def chord_id(name):
+    return ct.CHORD_BY_NAME[name].id
+
+
+def cost(a, b):
+    return sum(min(abs(x - y) for y in b) for x in a) + sum(min(abs(x - y) for x in a) for y in b)
+
+
+def unary(v):
+    center = sum(ct.VOICING_RANGE) / 2
+    return abs(sum(v) / len(v) - center) * ct.VOICING_REGISTER_WEIGHT
+
+
+def total(seq):
+    return sum(unary(v) for v in seq) + sum(cost(a, b) for a, b in zip(seq, seq[1:]))
+
+
+def movement(prog):
+    voiced = [item.notes for item in prog if item.notes]
+    return sum(cost(a, b) for a, b in zip(voiced, voiced[1:]))
+
+
+def brute_force(ids, before=None, after=None):
+    fixed_before = [tuple(before)] if before else []
+    fixed_after = [tuple(after)] if after else []
+    return min(total(fixed_before + list(combo) + fixed_after) for combo in itertools.product(*(ct.voicing_candidates(i) for i in ids)))
+
+
+def test_candidates_keep_pitch_classes_and_range():
+    low, high = ct.VOICING_RANGE
+    for name in NAMES:
+        chord = ct.CHORD_BY_NAME[name]
+        candidates = ct.voicing_candidates(chord.id)
+        assert chord.notes in candidates, name
+        assert len(set(candidates)) == len(candidates)
+        pitch_classes = {n % 12 for n in chord.notes}
+        for v in candidates:
+            assert {n % 12 for n in v} == pitch_classes and len(v) == len(chord.notes)
+            assert list(v) == sorted(v) and low <= v[0] and v[-1] <= high
+            assert v[-1] - v[0] < 12 + max(chord.notes) - min(chord.notes)   # 密集配置
+    assert ct.voicing_candidates(REST) == ()
+    assert ct.voicing_candidates(ct.get_chord("X_unknown").id) == ()
+
+
+def test_viterbi_matches_brute_force():
+    pytest.importorskip("numpy")
+    rng = random.Random(3)
+    for _ in range(60):
+        ids = [chord_id(rng.choice(NAMES)) for _ in range(rng.randint(1, 4))]
+        before = ct.CHORD_BY_NAME[rng.choice(NAMES)].notes if rng.random() < 0.5 else None
+        after = ct.CHORD_BY_NAME[rng.choice(NAMES)].notes if rng.random() < 0.5 else None
+        result = ct.optimize_voicings(ids, before, after)
+        assert all(v in ct.voicing_candidates(i) for i, v in zip(ids, result))
+        seq = ([tuple(before)] if before else []) + result + ([tuple(after)] if after else [])
+        assert total(seq) == pytest.approx(brute_force(ids, before, after), abs=1e-6)
+
+
+def test_chunked_costs_match_single_chunk(monkeypatch):
+    pytest.importorskip("numpy")
+    rng = random.Random(4)
+    ids = [chord_id(rng.choice(NAMES)) for _ in range(50)]
+    whole = ct.optimize_voicings(ids)
+    monkeypatch.setattr(ct, "VOICING_CHUNK", 7)
+    assert ct.optimize_voicings(ids) == whole
+
+
+def test_rests_are_skipped():
+    pytest.importorskip("numpy")
+    result = ct.optimize_voicings([chord_id("C_Maj"), REST, chord_id("F_Maj")])
+    assert result[1] is None and result[0] and result[2]
+    assert ct.optimize_voicings([REST, REST]) == [None, None]
+    assert ct.optimize_voicings([]) == []
+
+
+def test_voice_lead_progression_range_and_fixed_neighbours():
+    pytest.importorskip("numpy")
+    rng = random.Random(5)
+    prog = ct.Progression.from_dicts([{"name": rng.choice(NAMES + ["Rest_Rest"]), "duration": 1.0} for _ in range(200)])
+    prog.set_voicing(3, [40, 47, 52])   # 範囲外に置いた手動ボイシング
+    full = ct.voice_lead_progression(prog)
+    assert len(full) == len(prog)
+    for i, v in enumerate(full):
+        if prog.chord(i).name == "Rest_Rest": assert v == prog.voicings[i]
+        elif v is not None: assert tuple(v) in ct.voicing_candidates(prog.chord_ids[i]) and tuple(v) != prog.chord(i).notes
+    for i, v in enumerate(full): prog.set_voicing(i, v)
+    plain = ct.Progression.from_dicts([{"name": x.name, "duration": 1.0} for x in prog])
+    assert movement(prog) < movement(plain)
+    # 最適な列の一部を前後固定で選び直しても変わらない (後ろだけ実行し直せる)
+    assert ct.voice_lead_progression(prog, 120) == full[120:]
+    assert ct.voice_lead_progression(prog, 50, 80) == full[50:80]
+
+
+def test_batched_voicing_op_undo_round_trip():
+    pytest.importorskip("numpy")
+    prog = ct.Progression.from_dicts([{"name": "C_Maj", "duration": 1.0}, {"name": "G_7", "duration": 1.0},
+                                      {"name": "Rest_Rest", "duration": 1.0}, {"name": "A_Min", "duration": 1.0, "voicing": [57, 60, 64]}])
+    old = list(prog.voicings)
+    new = ct.voice_lead_progression(prog)
+    changed = [i for i, v in enumerate(new) if v != old[i]]
+    assert changed
+    op = {"op": "voicing", "indices": changed, "old": [old[i] for i in changed], "new": [new[i] for i in changed]}
+    history = ct.UndoHistory()
+    ct.apply_edit_op(prog, op)
+    history.push(op)
+    assert prog.voicings == new
+    for inverse in history.undo(): ct.apply_edit_op(prog, inverse)
+    assert prog.voicings == old
+    for redo in history.redo(): ct.apply_edit_op(prog, redo)
+    assert prog.voicings == new